@@ -0,0 +1,223 @@
+"""
+Benchmark suite for the palette pipeline.
+
+Generates deterministic synthetic images (gradient, noise, photo-like
+mixture) at several sizes, then times every quantization method and N for
+three paths: preview (decode at preview size + palette + render), composite
+export and bar-only export (both full resolution). Wall time, tracemalloc
+peak and peak RSS are recorded per case and written as JSON.
+
+    python benchmarks/bench_palette.py -o bench.json
+    python benchmarks/bench_palette.py --sizes 1 4 --baseline bench.json --threshold 0.25
+
+With --baseline the run is compared case by case and exits with status 1 if
+any case got slower than the threshold allows.
+"""
+import argparse
+import gc
+import json
+import os
+import platform
+import resource
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+from PIL import Image
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import main  # noqa: E402
+
+METHODS = ('MedianCut', 'FastOctree', 'KMeans')
+KINDS = ('gradient', 'noise', 'photo')
+PATHS = ('preview', 'composite', 'bar')
+PREVIEW_MAXSIDE = 1400
+
+
+# ------------------------------
+# Synthetic images
+# ------------------------------
+
+def synth_image(kind, mpx, seed=0):
+    """Deterministic 3:2 RGB image of about `mpx` megapixels, generated in row blocks."""
+    w = int(round((mpx * 1e6 * 1.5) ** 0.5))
+    h = max(1, int(round(mpx * 1e6 / w)))
+    rng = np.random.default_rng(seed)
+    out = np.empty((h, w, 3), dtype=np.uint8)
+    xx = np.arange(w, dtype=np.float32)[None, :]
+    blobs = [(rng.uniform(0, h), rng.uniform(0, w), rng.uniform(0.05, 0.25) * min(w, h),
+              rng.integers(0, 256, 3)) for _ in range(8)]
+    step = max(1, (1 << 20) // w)
+    for y0 in range(0, h, step):
+        y1 = min(h, y0 + step)
+        yy = np.arange(y0, y1, dtype=np.float32)[:, None]
+        if kind == 'noise':
+            out[y0:y1] = rng.integers(0, 256, (y1 - y0, w, 3), dtype=np.uint8)
+            continue
+        block = np.empty((y1 - y0, w, 3), dtype=np.float32)
+        block[..., 0] = xx / w * 255
+        block[..., 1] = yy / h * 255
+        block[..., 2] = (xx + yy) / (w + h) * 255
+        if kind == 'photo':
+            block += rng.normal(0, 12, block.shape).astype(np.float32)
+            for cy, cx, r, rgb in blobs:
+                mask = (yy - cy) ** 2 + (xx - cx) ** 2 < r * r
+                block[mask] = 0.6 * block[mask] + 0.4 * rgb
+        np.clip(block, 0, 255, out=block)
+        out[y0:y1] = block.astype(np.uint8)
+    return Image.fromarray(out)
+
+
+# ------------------------------
+# Measurement
+# ------------------------------
+
+def _reset_peak_rss():
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+        return True
+    except OSError:
+        return False
+
+
+def _peak_rss_mb():
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 1024.0
+    except OSError:
+        pass
+    # ru_maxrss is the lifetime peak (KB on Linux, bytes on macOS)
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss / (1024.0 * 1024.0) if sys.platform == 'darwin' else rss / 1024.0
+
+
+def measure(fn, repeat=1):
+    """
+    Best wall time over `repeat` untraced runs and the RSS peak of the last
+    of them, then one extra run under tracemalloc for the Python-heap peak
+    (tracing slows allocation, so it is kept out of the timed runs).
+    """
+    best = float('inf')
+    for _ in range(repeat):
+        gc.collect()
+        _reset_peak_rss()
+        t0 = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - t0)
+    rss_peak = _peak_rss_mb()
+    gc.collect()
+    tracemalloc.start()
+    try:
+        fn()
+        traced_peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    return {
+        'seconds': best,
+        'tracemalloc_peak_mb': traced_peak / (1024.0 * 1024.0),
+        'rss_peak_mb': rss_peak,
+    }
+
+
+def run_case(path, src_path, method, N):
+    kw = dict(N=N, method=method, swatch_aspect=1.0)
+    if path == 'preview':
+        def fn():
+            src = main.ImageSource(src_path).preview(PREVIEW_MAXSIDE)
+            main.build_palette_bar(src, cache=None, **kw)
+    else:
+        def fn():
+            main.export_image(main.ImageSource(src_path), bar_only=(path == 'bar'), cache=None, **kw)
+    return fn
+
+
+def run_suite(sizes, methods, ns, kinds, paths, repeat, workdir, log=print):
+    results = []
+    for mpx in sizes:
+        for kind in kinds:
+            src_path = os.path.join(workdir, f"{kind}_{mpx:g}mp.jpg")
+            if not os.path.exists(src_path):
+                synth_image(kind, mpx).save(src_path, quality=92)
+            for method in methods:
+                for N in ns:
+                    for path in paths:
+                        case = f"{path}/{method}/N{N}/{kind}/{mpx:g}MP"
+                        m = measure(run_case(path, src_path, method, N), repeat=repeat)
+                        m['case'] = case
+                        results.append(m)
+                        log(f"{case:<40} {m['seconds'] * 1000:9.1f} ms  "
+                            f"traced {m['tracemalloc_peak_mb']:8.1f} MB  rss {m['rss_peak_mb']:8.1f} MB")
+    return results
+
+
+def compare(results, baseline, threshold, log=print):
+    """Return the cases whose time exceeds baseline * (1 + threshold)."""
+    base = {r['case']: r for r in baseline.get('results', [])}
+    regressions = []
+    for r in results:
+        b = base.get(r['case'])
+        if b is None or b['seconds'] <= 0:
+            continue
+        ratio = r['seconds'] / b['seconds']
+        if ratio > 1.0 + threshold:
+            regressions.append((r['case'], b['seconds'], r['seconds'], ratio))
+    for case, old, new, ratio in regressions:
+        log(f"REGRESSION {case}: {old * 1000:.1f} ms -> {new * 1000:.1f} ms ({ratio:.2f}x)")
+    if not regressions:
+        log(f"no regressions beyond {threshold:.0%} against baseline")
+    return regressions
+
+
+def main_cli(argv=None):
+    p = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    p.add_argument('--sizes', type=float, nargs='+', default=[1, 4, 12, 24, 50], help="megapixels")
+    p.add_argument('--methods', nargs='+', default=list(METHODS), choices=METHODS)
+    p.add_argument('--N', type=int, nargs='+', default=[3, 8, 16, 32], dest='ns')
+    p.add_argument('--kinds', nargs='+', default=list(KINDS), choices=KINDS)
+    p.add_argument('--paths', nargs='+', default=list(PATHS), choices=PATHS)
+    p.add_argument('--repeat', type=int, default=1)
+    p.add_argument('--workdir', default=None, help="where synthetic images are cached (default: temp dir)")
+    p.add_argument('-o', '--output', default=None, help="write results JSON here")
+    p.add_argument('--baseline', default=None, help="results JSON to compare against")
+    p.add_argument('--threshold', type=float, default=0.25, help="allowed slowdown, e.g. 0.25 = +25%%")
+    args = p.parse_args(argv)
+
+    tmp = None
+    workdir = args.workdir
+    if workdir is None:
+        tmp = tempfile.TemporaryDirectory(prefix="palette-bench-")
+        workdir = tmp.name
+    os.makedirs(workdir, exist_ok=True)
+    try:
+        results = run_suite(args.sizes, args.methods, args.ns, args.kinds, args.paths, args.repeat, workdir)
+    finally:
+        if tmp is not None:
+            tmp.cleanup()
+    report = {
+        'meta': {
+            'python': platform.python_version(),
+            'numpy': np.__version__,
+            'pillow': Image.__version__,
+            'platform': platform.platform(),
+            'cpus': os.cpu_count(),
+        },
+        'results': results,
+    }
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        if compare(results, baseline, args.threshold):
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    raise SystemExit(main_cli())
@@ -0,0 +1,85 @@
+"""
+Startup-time check for the headless core (`import main`).
+
+Runs `python -X importtime -c "import main"` in fresh interpreters and takes
+the best cumulative time of the `main` entry. The check fails (exit status
+1) if that exceeds --budget-ms, or if the import pulled in any of the heavy
+modules that are meant to load lazily (NumPy, Pillow, Tk). Process-pool
+workers and the palette service pay this cost on every start.
+
+    python benchmarks/import_time.py
+    python benchmarks/import_time.py --budget-ms 60 --top 10 -o import.json
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+HEAVY = ('numpy', 'PIL', 'tkinter', '_tkinter')
+BUDGET_MS = 60.0
+
+
+def importtime(module, python=sys.executable):
+    """{module: (self_us, cumulative_us)} for one `python -X importtime -c "import module"` run."""
+    proc = subprocess.run([python, '-X', 'importtime', '-c', f"import {module}"], cwd=ROOT,
+                          capture_output=True, text=True, check=True)
+    out = {}
+    for line in proc.stderr.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        self_us, cum_us, name = line[len('import time:'):].split('|')
+        out.setdefault(name.strip(), (int(self_us), int(cum_us)))
+    return out
+
+
+def loaded_heavy(module, python=sys.executable):
+    """The HEAVY modules present in sys.modules right after `import module`."""
+    code = f"import sys, {module}; print(' '.join(m for m in {HEAVY!r} if m in sys.modules))"
+    proc = subprocess.run([python, '-c', code], cwd=ROOT, capture_output=True, text=True, check=True)
+    return proc.stdout.split()
+
+
+def main_cli(argv=None):
+    p = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    p.add_argument('--module', default='main')
+    p.add_argument('--repeat', type=int, default=5, help="fresh interpreters to run; the best is kept")
+    p.add_argument('--budget-ms', type=float, default=BUDGET_MS)
+    p.add_argument('--top', type=int, default=0, help="also list the slowest N imports of the best run")
+    p.add_argument('-o', '--output', default=None, help="write the report JSON here")
+    args = p.parse_args(argv)
+
+    importtime(args.module)  # warm-up: writes the bytecode cache so compiling isn't measured
+    runs = [importtime(args.module) for _ in range(max(1, args.repeat))]
+    best = min(runs, key=lambda r: r[args.module][1])
+    ms = best[args.module][1] / 1000.0
+    heavy = loaded_heavy(args.module)
+    report = {
+        'module': args.module,
+        'python': sys.version.split()[0],
+        'best_ms': ms,
+        'runs_ms': [r[args.module][1] / 1000.0 for r in runs],
+        'budget_ms': args.budget_ms,
+        'heavy_loaded': heavy,
+        'slowest': sorted(((name, cum / 1000.0) for name, (_s, cum) in best.items() if name != args.module),
+                          key=lambda kv: -kv[1])[:args.top],
+    }
+    print(f"import {args.module}: {ms:.1f} ms (best of {len(runs)}, budget {args.budget_ms:.0f} ms)")
+    for name, cum in report['slowest']:
+        print(f"  {name:<40} {cum:8.1f} ms")
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    failed = False
+    if heavy:
+        print(f"FAIL: importing {args.module} loaded {', '.join(heavy)}")
+        failed = True
+    if ms > args.budget_ms:
+        print(f"FAIL: {ms:.1f} ms is over the {args.budget_ms:.0f} ms budget")
+        failed = True
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    raise SystemExit(main_cli())
@@ -0,0 +1,191 @@
+"""
+Load test for the local palette service (python main.py serve).
+
+Opens --concurrency keep-alive connections and sends --requests palette
+requests in total, cycling over the given images (uploaded as bytes, or
+sent as ?path= with --by-path). Reports p50/p90/p99 latency, requests/s and
+how the service answered (computed / coalesced / cached). --bar-png K
+turns every K-th request into a bar=png request (a large rendered bar), and
+latencies are also reported per kind, so a slow bar render that held up the
+JSON requests shows in their p99.
+
+    python main.py serve --port 8765 &
+    python benchmarks/load_palette_service.py --port 8765 photos/*.jpg
+
+    # spawn a private instance on a Unix socket and use synthetic images
+    python benchmarks/load_palette_service.py --spawn --unix /tmp/palette.sock --synthetic 8
+    python benchmarks/load_palette_service.py --spawn --synthetic 8 --bar-png 4 --bar-size 8192x1024
+"""
+import argparse
+import asyncio
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+from collections import Counter
+from urllib.parse import quote, urlencode
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def percentile(sorted_vals, p):
+    if not sorted_vals:
+        return float('nan')
+    i = min(len(sorted_vals) - 1, max(0, int(round(p / 100.0 * (len(sorted_vals) - 1)))))
+    return sorted_vals[i]
+
+
+async def _open(args):
+    if args.unix:
+        return await asyncio.open_unix_connection(args.unix)
+    return await asyncio.open_connection(args.host, args.port)
+
+
+async def request(reader, writer, method, target, body=b''):
+    writer.write(f"{method} {target} HTTP/1.1\r\nHost: localhost\r\nContent-Length: {len(body)}\r\n\r\n".encode()
+                 + body)
+    await writer.drain()
+    head = await reader.readuntil(b'\r\n\r\n')
+    lines = head.decode('latin-1').split('\r\n')
+    status = int(lines[0].split(' ', 2)[1])
+    length = 0
+    for line in lines[1:]:
+        if line.lower().startswith('content-length:'):
+            length = int(line.split(':', 1)[1])
+    return status, await reader.readexactly(length)
+
+
+async def run_load(args, items):
+    queue = asyncio.Queue()
+    for i in range(args.requests):
+        target, body = items[i % len(items)]
+        if args.bar_png and i % args.bar_png == args.bar_png - 1:
+            bw, bh = args.bar_size.lower().split('x')
+            queue.put_nowait((f"{target}&bar=png&bar_width={int(bw)}&bar_height={int(bh)}", body, 'png'))
+        else:
+            queue.put_nowait((target, body, 'json'))
+    latencies = []
+    by_kind = {}
+    outcomes = Counter()
+
+    async def client():
+        reader, writer = await _open(args)
+        try:
+            while True:
+                try:
+                    target, body, kind = queue.get_nowait()
+                except asyncio.QueueEmpty:
+                    return
+                t0 = time.perf_counter()
+                status, payload = await request(reader, writer, 'POST' if body else 'GET', target, body)
+                latencies.append(time.perf_counter() - t0)
+                by_kind.setdefault(kind, []).append(latencies[-1])
+                if status == 200 and payload[:1] == b'{':
+                    outcomes[json.loads(payload).get('source', 'ok')] += 1
+                elif status == 200 and payload[:8] == b'\x89PNG\r\n\x1a\n':
+                    outcomes['png'] += 1
+                else:
+                    outcomes[f"http {status}"] += 1
+        finally:
+            writer.close()
+
+    t0 = time.perf_counter()
+    await asyncio.gather(*(client() for _ in range(args.concurrency)))
+    elapsed = time.perf_counter() - t0
+    latencies.sort()
+    return {
+        'requests': len(latencies),
+        'concurrency': args.concurrency,
+        'seconds': elapsed,
+        'requests_per_s': len(latencies) / elapsed if elapsed > 0 else float('nan'),
+        'p50_ms': percentile(latencies, 50) * 1000,
+        'p90_ms': percentile(latencies, 90) * 1000,
+        'p99_ms': percentile(latencies, 99) * 1000,
+        'max_ms': (latencies[-1] if latencies else float('nan')) * 1000,
+        'by_kind': {kind: {'requests': len(vals), 'p50_ms': percentile(sorted(vals), 50) * 1000,
+                           'p99_ms': percentile(sorted(vals), 99) * 1000}
+                    for kind, vals in by_kind.items()},
+        'outcomes': dict(outcomes),
+    }
+
+
+async def wait_ready(args, timeout=30.0):
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            reader, writer = await _open(args)
+            await request(reader, writer, 'GET', '/stats')
+            writer.close()
+            return
+        except OSError:
+            if time.monotonic() > deadline:
+                raise
+            await asyncio.sleep(0.1)
+
+
+def main_cli(argv=None):
+    p = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    p.add_argument('images', nargs='*', help="image files to send")
+    p.add_argument('--host', default='127.0.0.1')
+    p.add_argument('--port', type=int, default=8765)
+    p.add_argument('--unix', default=None, help="connect to a Unix socket instead of TCP")
+    p.add_argument('--spawn', action='store_true', help="start a private `main.py serve` for the run")
+    p.add_argument('--synthetic', type=int, default=0, help="add this many generated 2 MP images")
+    p.add_argument('--by-path', action='store_true', help="send ?path= instead of uploading the bytes")
+    p.add_argument('--requests', type=int, default=500)
+    p.add_argument('--concurrency', type=int, default=16)
+    p.add_argument('--params', default='N=16&method=MedianCut', help="extra query string for /palette")
+    p.add_argument('--bar-png', type=int, default=0, metavar='K',
+                   help="make every K-th request a bar=png request (0: none)")
+    p.add_argument('--bar-size', default='8192x1024', help="bar size of the bar=png requests, WxH")
+    p.add_argument('-o', '--output', default=None, help="write the report JSON here")
+    args = p.parse_args(argv)
+
+    tmp = tempfile.TemporaryDirectory(prefix="palette-load-")
+    paths = [os.path.abspath(x) for x in args.images]
+    if args.synthetic:
+        sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+        from bench_palette import synth_image
+        for i in range(args.synthetic):
+            path = os.path.join(tmp.name, f"synth_{i}.jpg")
+            synth_image(('gradient', 'noise', 'photo')[i % 3], 2, seed=i).save(path, quality=90)
+            paths.append(path)
+    if not paths:
+        p.error("no images: pass files or --synthetic N")
+    items = []
+    for path in paths:
+        if args.by_path:
+            items.append((f"/palette?{args.params}&{urlencode({'path': path}, quote_via=quote)}", b''))
+        else:
+            with open(path, 'rb') as f:
+                items.append((f"/palette?{args.params}", f.read()))
+
+    proc = None
+    if args.spawn:
+        cmd = [sys.executable, os.path.join(ROOT, 'main.py'), 'serve']
+        cmd += ['--unix', args.unix] if args.unix else ['--host', args.host, '--port', str(args.port)]
+        proc = subprocess.Popen(cmd, stdout=subprocess.DEVNULL)
+    try:
+        asyncio.run(wait_ready(args))
+        report = asyncio.run(run_load(args, items))
+    finally:
+        if proc is not None:
+            proc.terminate()
+            proc.wait()
+        tmp.cleanup()
+    print(f"{report['requests']} requests, concurrency {report['concurrency']}: "
+          f"{report['requests_per_s']:.1f} req/s | p50 {report['p50_ms']:.1f} ms | "
+          f"p90 {report['p90_ms']:.1f} ms | p99 {report['p99_ms']:.1f} ms | {report['outcomes']}")
+    if len(report['by_kind']) > 1:
+        for kind, r in sorted(report['by_kind'].items()):
+            print(f"  {kind:<5} {r['requests']:6d} requests | p50 {r['p50_ms']:.1f} ms | p99 {r['p99_ms']:.1f} ms")
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    return 0
+
+
+if __name__ == '__main__':
+    raise SystemExit(main_cli())
@@ -0,0 +1,664 @@
+"""
+Tk front end of the palette bar generator: `python main.py` (no subcommand)
+opens it, and everything headless stays importable from main without Tk.
+"""
+from collections import OrderedDict
+import os
+import sqlite3
+import threading
+import tkinter as tk
+from tkinter import filedialog, messagebox
+
+from PIL import Image, ImageTk
+
+from main import (MAX_TREE_COLORS, PALETTE_CACHE, DiskPaletteCache, ImageSource, PipelineTrace,
+                  compute_bar_height, compute_export_size, default_cache_path, export_image, export_targets,
+                  extract_palette, parse_aspect, parse_export_target, render_palette_bar, save_image)
+
+# ------------------------------
+# Background compute engine
+# ------------------------------
+
+class BackgroundEngine:
+    """
+    Runs palette jobs on worker threads (NumPy and Pillow release the GIL in
+    their heavy loops) and hands results back to the caller's thread.
+
+    Each job belongs to a `tag`. Submitting with replace=True bumps that tag's
+    generation: older queued jobs are cancelled and older results dropped, so
+    only the newest request for e.g. the preview is ever delivered. Callbacks
+    run inside poll(), which the owner calls from its own (UI) thread.
+    """
+
+    def __init__(self, max_workers=2):
+        from concurrent.futures import ThreadPoolExecutor
+        import queue
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="palette")
+        self._done = queue.Queue()
+        self._lock = threading.Lock()
+        self._generation = {}
+        self._pending = {}  # future -> (tag, gen, replace, on_result, on_error)
+
+    def submit(self, fn, *args, tag='default', replace=True, on_result=None, on_error=None, **kwargs):
+        with self._lock:
+            gen = self._generation.get(tag, 0) + 1
+            self._generation[tag] = gen
+            if replace:
+                for fut, (t, _g, r, _ok, _err) in list(self._pending.items()):
+                    if t == tag and r and fut.cancel():
+                        del self._pending[fut]
+            fut = self._executor.submit(fn, *args, **kwargs)
+            self._pending[fut] = (tag, gen, replace, on_result, on_error)
+        fut.add_done_callback(self._done.put)
+        return gen
+
+    def is_current(self, tag, gen):
+        with self._lock:
+            return self._generation.get(tag, 0) == gen
+
+    def busy(self):
+        with self._lock:
+            return bool(self._pending)
+
+    def poll(self):
+        """Deliver finished, non-stale results; returns the number delivered."""
+        import queue
+        delivered = 0
+        while True:
+            try:
+                fut = self._done.get_nowait()
+            except queue.Empty:
+                return delivered
+            with self._lock:
+                meta = self._pending.pop(fut, None)
+                if meta is None or fut.cancelled():
+                    continue
+                tag, gen, replace, on_result, on_error = meta
+                stale = replace and self._generation.get(tag, 0) != gen
+            if stale:
+                continue
+            exc = fut.exception()
+            if exc is not None:
+                if on_error is not None:
+                    on_error(exc)
+            elif on_result is not None:
+                on_result(fut.result())
+            delivered += 1
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+
+# ------------------------------
+# GUI
+# ------------------------------
+
+class App(tk.Tk):
+    def __init__(self):
+        super().__init__()
+        self.title("调色盘横条生成器 | Palette Bar Generator")
+        self._refresh_job = None
+        self._poll_job = None
+        self.PREVIEW_MAXSIDE = 1400  # Max long side for preview computation
+        self.COARSE_MAXSIDE = 256    # Max long side for the instant coarse pass
+        self._preview_req = 0        # id of the latest preview request
+        self._preview_fine_req = 0   # id of the latest request whose fine pass is shown
+        self._tree_state = None      # (path, method) whose fine palette tree is cached
+        self.engine = BackgroundEngine()
+        try:
+            # palettes persist across sessions, so reopening a photo skips quantization
+            self.cache = DiskPaletteCache(default_cache_path())
+        except (OSError, sqlite3.Error):
+            self.cache = PALETTE_CACHE
+        self._stage_text = ""         # stage timings of the last finished job
+        self._progress_text = ""      # set by export worker threads, shown while busy
+        self.protocol("WM_DELETE_WINDOW", self._on_close)
+
+        # State
+        self.source = None             # ImageSource of the loaded file
+        self.preview_image = None      # Composite PIL image for display
+        self.tk_preview = None         # Tk PhotoImage reference to avoid GC
+        self._display_key = None       # (w, h, quality) currently shown in tk_preview
+        self._display_cache = OrderedDict()  # (w, h) -> LANCZOS-fitted preview, LRU
+        self._canvas_item = None
+        self._settle_job = None
+        self.current_path = None
+
+        # Controls (left)
+        ctrl = tk.Frame(self)
+        ctrl.pack(side=tk.LEFT, fill=tk.Y, padx=10, pady=10)
+
+        # File selection
+        tk.Button(ctrl, text="选择图片…", command=self.choose_image).pack(fill=tk.X)
+        self.path_label = tk.Label(ctrl, text="未选择", wraplength=260, anchor='w', justify='left')
+        self.path_label.pack(fill=tk.X, pady=(4, 8))
+
+        # Params
+        self.N_var = tk.IntVar(value=16)
+        self.sep_var = tk.IntVar(value=2)
+        self.border_var = tk.IntVar(value=2)
+        self.sort_var = tk.BooleanVar(value=True)
+        self.hier_var = tk.BooleanVar(value=True)
+        self.poster_var = tk.BooleanVar(value=False)
+        # palette method & aspect ratio
+        self.method_var = tk.StringVar(value="MedianCut")
+        self.saspect_var = tk.StringVar(value="1:1")
+
+        self._add_labeled_spin(ctrl, "色块数量 N", self.N_var, 3, 32, 1)
+        # 生成方法
+        mf = tk.Frame(ctrl)
+        mf.pack(fill=tk.X, pady=2)
+        tk.Label(mf, text="生成方法", width=14, anchor='w').pack(side=tk.LEFT)
+        tk.OptionMenu(mf, self.method_var, "MedianCut", "FastOctree", "KMeans", command=lambda *_: self._request_preview()).pack(side=tk.LEFT, fill=tk.X, expand=True)
+        # 色块宽高比（W:H）
+        af = tk.Frame(ctrl)
+        af.pack(fill=tk.X, pady=2)
+        tk.Label(af, text="色块宽高比", width=14, anchor='w').pack(side=tk.LEFT)
+        tk.OptionMenu(af, self.saspect_var, "5:4", "4:3", "3:2", "1:1", "2:3", "3:4", "4:5", command=lambda *_: self._request_preview()).pack(side=tk.LEFT, fill=tk.X, expand=True)
+        # 导出格式
+        self.export_format_var = tk.StringVar(value="JPEG")
+
+        self._add_labeled_spin(ctrl, "分隔线(px)", self.sep_var, 0, 8, 1)
+        self._add_labeled_spin(ctrl, "外边框(px)", self.border_var, 0, 8, 1)
+
+        tk.Checkbutton(ctrl, text="按亮度从暗到亮排序", variable=self.sort_var, command=self._request_preview).pack(anchor='w', pady=(6, 0))
+        tk.Checkbutton(ctrl, text="层级调色盘（切换色块数无需重算）", variable=self.hier_var, command=self._request_preview).pack(anchor='w')
+        tk.Checkbutton(ctrl, text="色调分离（图像映射到调色盘颜色）", variable=self.poster_var, command=self._request_preview).pack(anchor='w', pady=(0, 10))
+
+        self.export_scale_var = tk.IntVar(value=100)   # 导出缩放百分比（仅JPEG）
+        self.jpeg_quality_var = tk.IntVar(value=100)   # JPEG质量（1-100）
+
+        # 导出设置（JPEG）
+        sep = tk.Frame(ctrl, height=1, bg="#ddd")
+        sep.pack(fill=tk.X, pady=(8,6))
+
+        # 导出设置行（包含导出格式下拉）
+        self.settings_row = tk.Frame(ctrl)
+        self.settings_row.pack(fill=tk.X)
+        tk.Label(self.settings_row, text="导出格式", width=14, anchor='w').pack(side=tk.LEFT)
+        tk.OptionMenu(self.settings_row, self.export_format_var, "JPEG", "PNG", command=lambda *_: self._on_export_format_change()).pack(side=tk.LEFT, fill=tk.X, expand=True)
+
+        # 导出模式（放在导出缩放之上）
+        self.export_mode_var = tk.StringVar(value="percent")  # percent | longedge
+        self.long_edge_var = tk.IntVar(value=2048)
+
+        self.mode_row = tk.Frame(ctrl)
+        self.mode_row.pack(fill=tk.X, pady=(4,2))
+        tk.Label(self.mode_row, text="缩放模式", width=14, anchor='w').pack(side=tk.LEFT)
+        modes = tk.Frame(self.mode_row)
+        modes.pack(side=tk.LEFT, fill=tk.X, expand=True)
+        tk.Radiobutton(modes, text="百分比", value="percent", variable=self.export_mode_var, command=self._on_export_mode_change).pack(side=tk.LEFT)
+        tk.Radiobutton(modes, text="长边像素", value="longedge", variable=self.export_mode_var, command=self._on_export_mode_change).pack(side=tk.LEFT)
+
+        # 具体像素参数（仅长边像素）
+        self.longedge_row = tk.Frame(ctrl)
+        self.longedge_row.pack(fill=tk.X, pady=2)
+        tk.Label(self.longedge_row, text="长边像素", width=14, anchor='w').pack(side=tk.LEFT)
+        tk.Spinbox(self.longedge_row, from_=256, to=12000, textvariable=self.long_edge_var, increment=64, width=8, command=self._update_export_dim).pack(side=tk.LEFT)
+
+        # 导出缩放与质量滑块
+        self.export_scale_row = self._add_labeled_scale(ctrl, "导出缩放(%)", self.export_scale_var, 25, 200, 5, fmt="{:.0f}", affects_preview=False)
+        # 导出尺寸显示（移动到导出缩放条下方）
+        self.export_dim_label = tk.Label(ctrl, text="导出尺寸：—", anchor='w')
+        self.export_dim_label.pack(fill=tk.X, pady=(6,0))
+        # JPEG 质量（可能被隐藏）
+        self.jpeg_quality_row = self._add_labeled_scale(ctrl, "JPEG质量", self.jpeg_quality_var, 0, 100, 1, fmt="{:.0f}", affects_preview=False)
+
+        # PNG 选项
+        self.png_compress_var = tk.IntVar(value=6)
+        # self.png_label = tk.Label(ctrl, text="PNG 选项", anchor='w')
+        self.png_compress_row = self._add_labeled_scale(ctrl, "压缩等级(0-9)", self.png_compress_var, 0, 9, 1, fmt="{:.0f}", affects_preview=False)
+
+        # 操作按钮
+        self.btns_frame = tk.Frame(ctrl)
+        self.btns_frame.pack(fill=tk.X, pady=(8,6))
+        tk.Button(self.btns_frame, text="预览/刷新", command=self.refresh_preview).pack(side=tk.LEFT, expand=True, fill=tk.X)
+        tk.Button(self.btns_frame, text="保存成品…", command=self.save_composite).pack(side=tk.LEFT, expand=True, fill=tk.X, padx=(6, 0))
+
+        # 独立的“保存仅色条…”按钮
+        tk.Button(ctrl, text="保存仅色条…", command=self.save_bar).pack(fill=tk.X)
+
+        # 多目标导出：一次渲染，按“格式:尺寸:质量”列表并行写出多个文件
+        self.targets_var = tk.StringVar(value="jpeg:100%:95, png:2048px:6")
+        self.targets_bar_var = tk.BooleanVar(value=False)
+        tf = tk.Frame(ctrl)
+        tf.pack(fill=tk.X, pady=(8, 0))
+        tk.Label(tf, text="多目标", width=14, anchor='w').pack(side=tk.LEFT)
+        tk.Entry(tf, textvariable=self.targets_var, width=18).pack(side=tk.LEFT, fill=tk.X, expand=True)
+        tf2 = tk.Frame(ctrl)
+        tf2.pack(fill=tk.X)
+        tk.Checkbutton(tf2, text="仅色条", variable=self.targets_bar_var).pack(side=tk.LEFT)
+        tk.Button(tf2, text="多目标导出…", command=self.save_targets).pack(side=tk.LEFT, expand=True, fill=tk.X)
+
+        # 后台计算状态
+        self.status_label = tk.Label(ctrl, text="", anchor='w', justify='left', fg="#888", wraplength=260)
+        self.status_label.pack(fill=tk.X, pady=(6, 0))
+
+        # Preview (right)
+        prev = tk.Frame(self)
+        prev.pack(side=tk.RIGHT, fill=tk.BOTH, expand=True)
+        self.canvas = tk.Canvas(prev, background="#222")
+        self.canvas.pack(fill=tk.BOTH, expand=True)
+        self.canvas.bind("<Configure>", self._on_canvas_configure)
+
+        # 初始化导出模式与格式相关控件的可见性
+        self._on_export_mode_change()
+        self._on_export_format_change()
+
+    # ----- UI helpers -----
+    def _add_labeled_spin(self, parent, label, var, frm, to, step):
+        f = tk.Frame(parent)
+        f.pack(fill=tk.X, pady=2)
+        tk.Label(f, text=label, width=14, anchor='w').pack(side=tk.LEFT)
+        sb = tk.Spinbox(f, from_=frm, to=to, textvariable=var, increment=step, width=7, command=self._request_preview)
+        sb.pack(side=tk.LEFT)
+
+    def _add_labeled_scale(self, parent, label, var, frm, to, res, fmt="{:.2f}", affects_preview=True):
+        f = tk.Frame(parent)
+        f.pack(fill=tk.X, pady=2)
+        top = tk.Frame(f)
+        top.pack(fill=tk.X)
+        tk.Label(top, text=label, anchor='w').pack(side=tk.LEFT)
+        val_lbl = tk.Label(top, text=fmt.format(var.get()), anchor='e')
+        val_lbl.pack(side=tk.RIGHT)
+        if affects_preview:
+            cmd = lambda _=None: (val_lbl.config(text=fmt.format(var.get())), self._request_preview())
+        else:
+            cmd = lambda _=None: (val_lbl.config(text=fmt.format(var.get())), self._update_export_dim())
+        s = tk.Scale(f, from_=frm, to=to, resolution=res, orient=tk.HORIZONTAL, variable=var, command=cmd)
+        s.pack(fill=tk.X)
+        return f
+
+    def _on_export_format_change(self):
+        fmt = self.export_format_var.get()
+        # 先隐藏所有相关控件
+        try:
+            if hasattr(self, 'jpeg_quality_row') and self.jpeg_quality_row is not None:
+                self.jpeg_quality_row.pack_forget()
+        except Exception:
+            pass
+        for w in ('png_label', 'png_compress_row'):
+            try:
+                ww = getattr(self, w, None)
+                if ww is not None:
+                    ww.pack_forget()
+            except Exception:
+                pass
+        try:
+            if hasattr(self, 'fmt_spacer_row') and self.fmt_spacer_row is not None:
+                self.fmt_spacer_row.pack_forget()
+        except Exception:
+            pass
+        # 再按顺序显示需要的控件（保证位置在按钮上方，且相对顺序稳定）
+        if fmt == 'JPEG':
+            if hasattr(self, 'jpeg_quality_row') and self.jpeg_quality_row is not None:
+                try:
+                    self.jpeg_quality_row.pack(before=self.mode_row, fill=tk.X, pady=(8,0))
+                except Exception:
+                    self.jpeg_quality_row.pack(fill=tk.X, pady=(8,0))
+        else:  # PNG
+            if hasattr(self, 'png_label') and self.png_label is not None:
+                try:
+                    self.png_label.pack(before=self.mode_row, fill=tk.X, pady=(8,0))
+                except Exception:
+                    self.png_label.pack(fill=tk.X, pady=(8,0))
+            if hasattr(self, 'png_compress_row') and self.png_compress_row is not None:
+                try:
+                    self.png_compress_row.pack(before=self.mode_row, fill=tk.X, pady=2)
+                except Exception:
+                    self.png_compress_row.pack(fill=tk.X, pady=2)
+            # 无优化选项
+        
+    def _on_export_mode_change(self):
+        mode = self.export_mode_var.get()
+        # 统一先隐藏两组控件
+        try:
+            if hasattr(self, 'export_scale_row') and self.export_scale_row is not None:
+                self.export_scale_row.pack_forget()
+        except Exception:
+            pass
+        try:
+            if hasattr(self, 'longedge_row') and self.longedge_row is not None:
+                self.longedge_row.pack_forget()
+        except Exception:
+            pass
+        # 按模式显示对应控件，并放在导出尺寸标签之前，保证顺序
+        if mode == 'percent':
+            try:
+                self.export_scale_row.pack(before=self.export_dim_label, fill=tk.X, pady=2)
+            except Exception:
+                self.export_scale_row.pack(fill=tk.X, pady=2)
+        else:  # longedge
+            try:
+                self.longedge_row.pack(before=self.export_dim_label, fill=tk.X, pady=2)
+            except Exception:
+                self.longedge_row.pack(fill=tk.X, pady=2)
+        # 更新尺寸显示
+        self._update_export_dim()
+    def _request_preview(self):
+        if self._refresh_job is not None:
+            try:
+                self.after_cancel(self._refresh_job)
+            except Exception:
+                pass
+        self._refresh_job = self.after(120, self.refresh_preview)
+
+    def _update_export_dim(self):
+        if self.preview_image is None or self.source is None:
+            return
+        # Size of the full-resolution composite after export scaling
+        w, h = self.source.size
+        p = self._palette_params()
+        bar_h = compute_bar_height(w, h, N=p['N'], separator=p['separator'], border_px=p['border_px'],
+                                   swatch_aspect=p['swatch_aspect'])
+        ew, eh = self._compute_export_size(w, h + bar_h)
+        self.export_dim_label.config(text=f"导出尺寸：{ew}×{eh}px")
+
+    def _parse_aspect(self, s: str) -> float:
+        return parse_aspect(s)
+
+    def _export_kw(self):
+        return dict(
+            mode=self.export_mode_var.get(),
+            scale_pct=self.export_scale_var.get(),
+            long_edge=self.long_edge_var.get(),
+        )
+
+    def _compute_export_size(self, base_w: int, base_h: int):
+        return compute_export_size(base_w, base_h, **self._export_kw())
+
+    # ----- Actions -----
+    def choose_image(self):
+        path = filedialog.askopenfilename(title="选择图片", filetypes=[
+            ("Image Files", "*.png *.jpg *.jpeg *.bmp *.tif *.tiff"),
+            ("All Files", "*.*"),
+        ])
+        if not path:
+            return
+        try:
+            self.source = ImageSource(path)
+            self.current_path = path
+            self.path_label.config(text=path)
+            self.refresh_preview()
+        except Exception as e:
+            messagebox.showerror("读取失败", f"无法打开图片：\n{e}")
+
+    def _palette_params(self):
+        # Read Tk variables on the main thread; workers only see plain values
+        return dict(
+            N=int(self.N_var.get()),
+            swatch_aspect=self._parse_aspect(self.saspect_var.get()),
+            separator=int(self.sep_var.get()),
+            border_px=int(self.border_var.get()),
+            sort_by_luma=bool(self.sort_var.get()),
+            method=self.method_var.get(),
+            hierarchical=bool(self.hier_var.get()),
+            posterize=bool(self.poster_var.get()),
+        )
+
+    def _submit(self, fn, *args, tag, replace=True, on_result=None, on_error=None):
+        self.engine.submit(fn, *args, tag=tag, replace=replace, on_result=on_result, on_error=on_error)
+        self.status_label.config(text="计算中…")
+        if self._poll_job is None:
+            self._poll_job = self.after(15, self._poll_engine)
+
+    def _poll_engine(self):
+        self._poll_job = None
+        self.engine.poll()
+        if self.engine.busy():
+            if self._progress_text:
+                self.status_label.config(text=self._progress_text)
+            self._poll_job = self.after(15, self._poll_engine)
+        else:
+            self.status_label.config(text=self._stage_text)
+
+    def _show_trace(self, what, trace):
+        self._stage_text = f"{what}：{trace.summary(limit=4)}"
+
+    def _on_close(self):
+        self.engine.shutdown()
+        self.destroy()
+
+    def refresh_preview(self):
+        """
+        Coarse-to-fine preview: a palette from a tiny thumbnail is drawn first,
+        then replaced by the palette of the PREVIEW_MAXSIDE source, which is
+        warm-started from the coarse centers. Decoding of both levels happens
+        on the workers, once per file; JPEGs decode the thumbnail on its own
+        (DCT scaling), other formats downsize it from the fine level. In hierarchical mode the fine palette
+        tree is cached, so when only N changed the coarse pass is skipped and
+        the fine pass is just a cut and a redraw.
+        """
+        self._refresh_job = None
+        source = self.source
+        if source is None:
+            return
+        fine_side, coarse_side = self.PREVIEW_MAXSIDE, self.COARSE_MAXSIDE
+        has_coarse = source.preview_size(coarse_side) != source.preview_size(fine_side)
+        params = self._palette_params()
+        hier = params['hierarchical']
+        tree_state = (source.path, params['method']) if hier else None
+        self._preview_req += 1
+        req = self._preview_req
+        on_error = lambda e: messagebox.showerror("处理失败", str(e))
+
+        def coarse_palette(n=params['N']):
+            return extract_palette(source.preview(coarse_side, base_side=fine_side), n, params['method'],
+                                   cache=self.cache, fingerprint=source.fingerprint(coarse_side),
+                                   hierarchical=hier)
+
+        def coarse_job():
+            pal = coarse_palette()
+            out, _bar = render_palette_bar(source.preview(coarse_side), pal, **self._render_params(params))
+            return out
+
+        def fine_job():
+            trace = PipelineTrace()
+            init = None
+            if params['method'] == 'KMeans' and has_coarse:
+                # a tree is warm-started from all of the coarse tree's leaves
+                init = coarse_palette(max(params['N'], MAX_TREE_COLORS) if hier else params['N']).colors
+            im = source.preview(fine_side, trace)
+            pal = extract_palette(im, params['N'], params['method'], cache=self.cache,
+                                  fingerprint=source.fingerprint(fine_side), init_centers=init, trace=trace,
+                                  hierarchical=hier)
+            out, _bar = render_palette_bar(im, pal, trace=trace, **self._render_params(params))
+            return out, trace
+
+        def on_fine(result):
+            self._tree_state = tree_state
+            self._on_preview_ready(result[0], req, fine=True, trace=result[1])
+
+        if has_coarse and (tree_state is None or tree_state != self._tree_state):
+            self._submit(coarse_job, tag='preview_coarse',
+                         on_result=lambda out: self._on_preview_ready(out, req, fine=False), on_error=on_error)
+        self._submit(fine_job, tag='preview', on_result=on_fine, on_error=on_error)
+
+    @staticmethod
+    def _render_params(params):
+        return {k: v for k, v in params.items() if k not in ('method', 'hierarchical')}
+
+    def _on_preview_ready(self, out, req, fine, trace=None):
+        if req != self._preview_req or (not fine and self._preview_fine_req == req):
+            return  # superseded, or the fine pass already landed
+        if fine:
+            self._preview_fine_req = req
+        if trace is not None:
+            self._show_trace("预览", trace)
+        self.preview_image = out
+        self._display_cache.clear()
+        self._display_key = None
+        self._update_export_dim()
+        self._draw_preview()
+
+    DISPLAY_CACHE_SIZE = 4  # fitted previews kept for sizes seen recently (e.g. maximize/restore)
+
+    def _on_canvas_configure(self, _event):
+        # Cheap resample while the window is being dragged, LANCZOS once it settles
+        self._draw_preview(fast=True)
+        if self._settle_job is not None:
+            self.after_cancel(self._settle_job)
+        self._settle_job = self.after(150, self._draw_preview)
+
+    def _draw_preview(self, fast=False):
+        if not fast:
+            self._settle_job = None
+        if self.preview_image is None:
+            self.canvas.delete("all")
+            self._canvas_item = None
+            self._display_key = None
+            return
+        cw = self.canvas.winfo_width()
+        ch = self.canvas.winfo_height()
+        if cw < 2 or ch < 2:
+            return
+        # Fit preview to canvas while preserving aspect
+        img = self.preview_image
+        iw, ih = img.size
+        scale = min(cw / iw, ch / ih)
+        size = (max(1, int(iw * scale)), max(1, int(ih * scale)))
+        shown = self._display_key
+        if shown is not None and shown[:2] == size and (fast or shown[2] == 'fine'):
+            # Same fitted size: only re-center the existing PhotoImage
+            self.canvas.coords(self._canvas_item, cw // 2, ch // 2)
+            return
+        disp = self._display_cache.get(size)
+        if disp is not None:
+            self._display_cache.move_to_end(size)
+            quality = 'fine'
+        elif size == img.size:
+            disp, quality = img, 'fine'
+        elif fast:
+            # NEAREST is ~1 ms for a 1400 px preview vs ~35 ms for LANCZOS
+            disp, quality = img.resize(size, Image.NEAREST), 'fast'
+        else:
+            disp, quality = img.resize(size, Image.LANCZOS), 'fine'
+            self._display_cache[size] = disp
+            while len(self._display_cache) > self.DISPLAY_CACHE_SIZE:
+                self._display_cache.popitem(last=False)
+        if shown is not None and shown[:2] == size:
+            self.tk_preview.paste(disp)  # upgrade fast -> fine in place
+        else:
+            self.tk_preview = ImageTk.PhotoImage(disp)
+        self._display_key = (size[0], size[1], quality)
+        if self._canvas_item is None:
+            self._canvas_item = self.canvas.create_image(cw // 2, ch // 2, image=self.tk_preview)
+        else:
+            self.canvas.itemconfigure(self._canvas_item, image=self.tk_preview)
+            self.canvas.coords(self._canvas_item, cw // 2, ch // 2)
+
+    def save_composite(self):
+        if self.preview_image is None:
+            messagebox.showinfo("提示", "请先选择图片并生成预览。")
+            return
+        default = "output_with_palette.jpg"
+        if self.current_path:
+            base = os.path.splitext(os.path.basename(self.current_path))[0]
+            default = f"{base}_with_palette.jpg"
+        fmt = self.export_format_var.get()
+        if fmt == "PNG":
+            defext = ".png"; ftypes = [("PNG", ".png"), ("All Files", "*.*")]
+        else:
+            defext = ".jpg"; ftypes = [("JPEG", ".jpg"), ("PNG", ".png"), ("All Files", "*.*")]
+        path = filedialog.asksaveasfilename(title="保存成品", defaultextension=defext,
+                                            initialfile=default, filetypes=ftypes)
+        if not path:
+            return
+        self._submit_save(path, bar_only=False)
+
+    def save_bar(self):
+        if self.source is None:
+            messagebox.showinfo("提示", "请先选择图片并生成预览。")
+            return
+        default = "palette_bar.png"
+        if self.current_path:
+            base = os.path.splitext(os.path.basename(self.current_path))[0]
+            default = f"{base}_palette_bar.png"
+        fmt = self.export_format_var.get()
+        if fmt == "PNG":
+            defext = ".png"; ftypes = [("PNG", ".png"), ("All Files", "*.*")]
+        else:
+            defext = ".jpg"; ftypes = [("JPEG", ".jpg"), ("PNG", ".png"), ("All Files", "*.*")]
+        path = filedialog.asksaveasfilename(title="保存仅色条", defaultextension=defext,
+                                            initialfile=default, filetypes=ftypes)
+        if not path:
+            return
+        self._submit_save(path, bar_only=True)
+
+    def _submit_save(self, path, bar_only):
+        # Recompute at full quality using current params on original (not the resized preview)
+        source = self.source
+        params = self._palette_params()
+        export_kw = self._export_kw()
+        quality = self.jpeg_quality_var.get()
+        compress = self.png_compress_var.get()
+
+        def job():
+            trace = PipelineTrace()
+            img = export_image(source, bar_only=bar_only, cache=self.cache, trace=trace, **export_kw, **params)
+            save_image(img, path, quality, compress, trace=trace)
+            return path, trace
+
+        def done(result):
+            p, trace = result
+            self._show_trace("保存", trace)
+            messagebox.showinfo("已保存", p)
+
+        self._submit(job, tag='save', replace=False,
+                     on_result=done,
+                     on_error=lambda e: messagebox.showerror("保存失败", str(e)))
+
+
+    def save_targets(self):
+        if self.source is None:
+            messagebox.showinfo("提示", "请先选择图片并生成预览。")
+            return
+        try:
+            targets = [parse_export_target(t) for t in self.targets_var.get().split(',') if t.strip()]
+        except ValueError as e:
+            messagebox.showerror("多目标格式错误", f"应为 格式:尺寸:质量，如 jpeg:100%:95, png:2048px:6\n{e}")
+            return
+        if not targets:
+            return
+        out_dir = filedialog.askdirectory(title="选择导出目录")
+        if not out_dir:
+            return
+        bar_only = bool(self.targets_bar_var.get())
+        base = os.path.splitext(os.path.basename(self.current_path))[0]
+        base = os.path.join(out_dir, base + ("_palette_bar" if bar_only else "_with_palette"))
+        outputs = list(OrderedDict((t.output_path(base), t) for t in targets).items())
+        source = self.source
+        params = self._palette_params()
+
+        def progress(done, total, path):
+            self._progress_text = f"导出 {done}/{total}：{os.path.basename(path)}"
+
+        def job():
+            trace = PipelineTrace()
+            paths = export_targets(source, outputs, bar_only=bar_only, cache=self.cache, progress=progress,
+                                   trace=trace, **params)
+            return paths, trace
+
+        def done(result):
+            paths, trace = result
+            self._progress_text = ""
+            self._show_trace("多目标导出", trace)
+            messagebox.showinfo("已保存", "\n".join(paths))
+
+        def failed(e):
+            self._progress_text = ""
+            messagebox.showerror("保存失败", str(e))
+
+        self._progress_text = f"导出 0/{len(outputs)}…"
+        self._submit(job, tag='save', replace=False, on_result=done, on_error=failed)
+
+
+def run():
+    app = App()
+    app.geometry("1200x700")
+    app.mainloop()
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(run())
@@ -1,577 +1,3169 @@
-from PIL import Image, ImageDraw, ImageTk
-import numpy as np
-import tkinter as tk
-from tkinter import filedialog, messagebox
+from __future__ import annotations
+
+from collections import OrderedDict
+from typing import NamedTuple
+import hashlib
+import importlib
+import io
+import json
 import os
+import sqlite3
+import struct
+import sys
+import threading
+import time
+import tracemalloc
+import zlib
+
+
+class _LazyModule:
+    """
+    Stand-in for a heavy module that imports it on first attribute access
+    and rebinds the global to the real module. `import main` then costs a
+    few milliseconds and pulls in neither NumPy nor Pillow until a palette
+    is actually computed, which matters for short-lived pool workers and
+    tools that only need the CLI or a cache lookup. The Tk front end lives
+    in gui.py.
+    """
+
+    def __init__(self, name, alias):
+        self._name = name
+        self._alias = alias
+
+    def __getattr__(self, attr):
+        mod = importlib.import_module(self._name)
+        globals()[self._alias] = mod
+        return getattr(mod, attr)
+
+
+np = _LazyModule('numpy', 'np')
+Image = _LazyModule('PIL.Image', 'Image')
+
+# ------------------------------
+# Pipeline instrumentation
+# ------------------------------
+
+
+def _buffer_bytes(obj):
+    """Approximate buffer size of a stage result (PIL image, ndarray or tuple of them)."""
+    if isinstance(obj, np.ndarray):
+        return obj.nbytes
+    if isinstance(obj, Image.Image):
+        bands = len(obj.getbands())
+        return obj.size[0] * obj.size[1] * (4 if bands >= 3 else bands)  # Pillow pads RGB to 4 bytes
+    if isinstance(obj, (tuple, list)):
+        return sum(_buffer_bytes(o) for o in obj)
+    if isinstance(obj, (bytes, bytearray)):
+        return len(obj)
+    return 0
+
+
+_OPEN_STAGES = set()  # memory-tracked stages between __enter__ and __exit__, across threads
+_OPEN_STAGES_LOCK = threading.Lock()
+
+
+class _Stage:
+    __slots__ = ('trace', 'rec', '_t0', '_mem0', '_peak')
+
+    def __init__(self, trace, name, pixels):
+        self.trace = trace
+        self.rec = {'stage': name, 'seconds': 0.0, 'pixels': int(pixels), 'bytes': 0}
+
+    def __enter__(self):
+        self._mem0 = None
+        if self.trace.track_memory and tracemalloc.is_tracing():
+            # tracemalloc has one process-wide peak: fold it into every stage still
+            # open (enclosing ones, other threads', other traces') before resetting
+            # it, so each stage keeps the high-water mark it has seen so far.
+            with _OPEN_STAGES_LOCK:
+                cur, peak = tracemalloc.get_traced_memory()
+                for st in _OPEN_STAGES:
+                    st._peak = max(st._peak, peak)
+                tracemalloc.reset_peak()
+                self._mem0 = self._peak = cur
+                _OPEN_STAGES.add(self)
+        self._t0 = time.perf_counter()
+        return self
+
+    def out(self, obj):
+        """Count `obj` as output of this stage and return it."""
+        self.rec['bytes'] += _buffer_bytes(obj)
+        return obj
+
+    def count(self, pixels):
+        """Add pixels processed by a stage whose size is only known as it runs."""
+        self.rec['pixels'] += int(pixels)
+
+    def __exit__(self, *exc):
+        self.rec['seconds'] = time.perf_counter() - self._t0
+        if self._mem0 is not None:
+            with _OPEN_STAGES_LOCK:
+                _OPEN_STAGES.discard(self)
+                peak = max(self._peak, tracemalloc.get_traced_memory()[1]) if tracemalloc.is_tracing() else self._peak
+            self.rec['peak_alloc_bytes'] = max(0, peak - self._mem0)
+        self.trace.add(self.rec)
+        return False
+
+
+class _NoStage:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def out(self, obj):
+        return obj
+
+    def count(self, pixels):
+        pass
+
+
+_NO_STAGE = _NoStage()
+
+
+def _stage(trace, name, pixels=0):
+    """trace.stage(...) or a shared no-op when tracing is off."""
+    return _NO_STAGE if trace is None else _Stage(trace, name, pixels)
+
+
+class PipelineTrace:
+    """
+    Opt-in per-stage instrumentation. Pass an instance as `trace=` to
+    build_palette_bar, export_image, save_image and the functions they call;
+    every stage (decode, convert, fingerprint, histogram, quantize, sort,
+    draw, resize, composite, encode) appends a record with its wall time,
+    pixel count and output buffer size in bytes. With track_memory=True the
+    peak bytes allocated during the stage (tracemalloc: NumPy and Python
+    objects, not Pillow's own buffers) are recorded too, at the usual
+    tracemalloc slowdown. The peak is taken over the whole process, relative
+    to the traced memory when the stage began, so stages that overlap in
+    other threads count towards each other's peaks. With trace=None each stage costs one no-op
+    context manager.
+    """
+
+    def __init__(self, track_memory=False):
+        self.track_memory = track_memory
+        self.records = []
+        self.totals = {}  # stage -> {'calls', 'seconds', 'pixels', 'bytes'}
+        self._lock = threading.Lock()
+        self._owns_tracemalloc = track_memory and not tracemalloc.is_tracing()
+        if self._owns_tracemalloc:
+            tracemalloc.start()
+
+    def stage(self, name, pixels=0):
+        """Context manager timing one stage; its out(obj) records the result size."""
+        return _Stage(self, name, pixels)
+
+    def add(self, rec):
+        with self._lock:
+            self.records.append(rec)
+            tot = self.totals.setdefault(rec['stage'], {'calls': 0, 'seconds': 0.0, 'pixels': 0, 'bytes': 0})
+            tot['calls'] += 1
+            tot['seconds'] += rec['seconds']
+            tot['pixels'] += rec['pixels']
+            tot['bytes'] += rec['bytes']
+            if 'peak_alloc_bytes' in rec:
+                tot['peak_alloc_bytes'] = max(tot.get('peak_alloc_bytes', 0), rec['peak_alloc_bytes'])
+
+    def extend(self, records):
+        """Add records produced elsewhere (e.g. another process's to_dict()['stages'])."""
+        for rec in records:
+            self.add(rec)
+
+    def close(self):
+        if self._owns_tracemalloc:
+            tracemalloc.stop()
+            self._owns_tracemalloc = False
+
+    def to_dict(self):
+        with self._lock:
+            return {
+                'seconds': sum(t['seconds'] for t in self.totals.values()),
+                'stages': [dict(r) for r in self.records],
+                'totals': {k: dict(v) for k, v in self.totals.items()},
+            }
+
+    def to_json(self, **kw):
+        return json.dumps(self.to_dict(), **kw)
+
+    def summary(self, limit=5):
+        """One-line summary of the slowest stages, e.g. "decode 120ms · histogram 41ms · total 190ms"."""
+        with self._lock:
+            items = sorted(self.totals.items(), key=lambda kv: -kv[1]['seconds'])
+        parts = [f"{name} {t['seconds'] * 1000:.0f}ms" for name, t in items[:limit]]
+        parts.append(f"total {sum(t['seconds'] for _n, t in items) * 1000:.0f}ms")
+        return " · ".join(parts)
+
+
+# ------------------------------
+# Core image processing routine
+# ------------------------------
+
+KMEANS_MEM_BUDGET_MB = 64  # default peak size of the per-chunk temporaries
+HIST_BITS = 6  # bits per channel of the color histogram grid (8 = exact colors)
+TILE_PIXELS = 1 << 22  # decode budget per tile for extract_palette_tiled
+MAX_TREE_COLORS = 32  # palette trees answer every N up to this from one quantization
+KMEANS_WORKERS = os.cpu_count() or 1  # default thread count of the KMeans assignment step
+ASSIGN_BLOCK_ROWS = 1 << 15  # rows per assignment shard; fixed so results don't depend on the worker count
+
+
+def as_rgb(im: Image.Image, trace=None) -> Image.Image:
+    """`im` in RGB mode, without the copy convert() makes for images already in RGB."""
+    if im.mode == "RGB":
+        return im
+    with _stage(trace, 'convert', im.size[0] * im.size[1]) as st:
+        return st.out(im.convert("RGB"))
+
+
+def iter_rgb_strips(im: Image.Image, max_pixels=1 << 20):
+    """Yield the pixels of `im` as (n x 3) uint8 blocks of whole rows, at most ~max_pixels each."""
+    w, h = im.size
+    rows = max(1, int(max_pixels) // max(1, w))
+    for y in range(0, h, rows):
+        strip = im.crop((0, y, w, min(h, y + rows)))
+        yield np.asarray(as_rgb(strip), dtype=np.uint8).reshape(-1, 3)
+
+
+class ColorHistogram:
+    """
+    Incremental weighted color histogram. Feed (n x 3) uint8 pixel blocks to
+    add(), then call result() for (colors, counts): `colors` is an (m x 3)
+    uint8 array and `counts` the int64 pixel count per row.
+
+    With bits=8 every distinct 24-bit color is kept (packed + np.unique); with
+    fewer bits colors are binned on a 2^bits grid per channel via np.bincount,
+    and each bin is represented by the mean color of its pixels.
+    """
+
+    def __init__(self, bits=HIST_BITS):
+        self.bits = max(1, min(8, int(bits)))
+        self.pixels = 0
+        if self.bits == 8:
+            self._keys = []
+            self._counts = []
+            self._pending = 0
+        else:
+            nbins = 1 << (3 * self.bits)
+            self._bin_counts = np.zeros(nbins, dtype=np.int64)
+            self._bin_sums = np.zeros((nbins, 3), dtype=np.float64)
+
+    def add(self, pixels: np.ndarray):
+        pixels = pixels.reshape(-1, 3)
+        self.pixels += pixels.shape[0]
+        r = pixels[:, 0].astype(np.uint32)
+        g = pixels[:, 1].astype(np.uint32)
+        bl = pixels[:, 2].astype(np.uint32)
+        if self.bits == 8:
+            keys, counts = np.unique((r << 16) | (g << 8) | bl, return_counts=True)
+            self._keys.append(keys)
+            self._counts.append(counts.astype(np.int64))
+            self._pending += keys.size
+            if self._pending > (1 << 22):
+                self._merge()
+            return
+        shift = 8 - self.bits
+        packed = ((r >> shift) << (2 * self.bits)) | ((g >> shift) << self.bits) | (bl >> shift)
+        nbins = self._bin_counts.size
+        self._bin_counts += np.bincount(packed, minlength=nbins)
+        for ch, v in enumerate((r, g, bl)):
+            self._bin_sums[:, ch] += np.bincount(packed, weights=v, minlength=nbins)
+
+    def _merge(self):
+        if len(self._keys) > 1:
+            keys, inv = np.unique(np.concatenate(self._keys), return_inverse=True)
+            counts = np.bincount(inv, weights=np.concatenate(self._counts)).astype(np.int64)
+            self._keys, self._counts = [keys], [counts]
+        self._pending = self._keys[0].size if self._keys else 0
+
+    def merge(self, other: "ColorHistogram"):
+        """Add the counts of another histogram with the same `bits`."""
+        if other.bits != self.bits:
+            raise ValueError(f"cannot merge {other.bits}-bit histogram into {self.bits}-bit")
+        self.pixels += other.pixels
+        if self.bits == 8:
+            self._keys.extend(other._keys)
+            self._counts.extend(other._counts)
+            self._pending += sum(k.size for k in other._keys)
+            if self._pending > (1 << 22):
+                self._merge()
+        else:
+            self._bin_counts += other._bin_counts
+            self._bin_sums += other._bin_sums
+
+    def result(self):
+        if self.bits == 8:
+            self._merge()
+            if not self._keys:
+                return np.zeros((0, 3), dtype=np.uint8), np.zeros(0, dtype=np.int64)
+            keys, counts = self._keys[0], self._counts[0]
+            colors = np.stack([(keys >> 16) & 255, (keys >> 8) & 255, keys & 255], axis=1).astype(np.uint8)
+            return colors, counts
+        used = np.flatnonzero(self._bin_counts)
+        counts = self._bin_counts[used]
+        colors = np.clip(np.rint(self._bin_sums[used] / counts[:, None]), 0, 255).astype(np.uint8)
+        return colors, counts
+
+
+def color_histogram(im: Image.Image, bits=HIST_BITS):
+    """Weighted color histogram of `im` (see ColorHistogram), built strip by strip."""
+    acc = ColorHistogram(bits)
+    for block in iter_rgb_strips(im):
+        acc.add(block)
+    return acc.result()
+
+
+_POOLS = {}
+_POOLS_LOCK = threading.Lock()
+
+
+def _thread_pool(workers):
+    """Shared ThreadPoolExecutor per worker count (a forked child gets its own)."""
+    from concurrent.futures import ThreadPoolExecutor
+    key = (os.getpid(), workers)
+    with _POOLS_LOCK:
+        pool = _POOLS.get(key)
+        if pool is None:
+            pool = _POOLS[key] = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="assign")
+        return pool
+
+
+def _bounded_map(pool, fn, items, inflight):
+    """Ordered map over `pool` with at most `inflight` tasks submitted at a time."""
+    from collections import deque
+    pending = deque()
+    for item in items:
+        if len(pending) >= inflight:
+            yield pending.popleft().result()
+        pending.append(pool.submit(fn, item))
+    while pending:
+        yield pending.popleft().result()
+
+
+def _assign_block(x, c, c2, k, weights, labels_out, want_sums):
+    """Assign one shard; returns its (counts, sums or None). Labels go to `labels_out` if given."""
+    x = x.astype(np.float32)
+    d2 = x @ c.T
+    d2 *= -2.0
+    d2 += c2
+    lab = d2.argmin(axis=1)
+    if weights is None:
+        counts = np.bincount(lab, minlength=k)
+    else:
+        counts = np.rint(np.bincount(lab, weights=weights, minlength=k)).astype(np.int64)
+    if labels_out is not None:
+        labels_out[:] = lab
+    sums = None
+    if want_sums:
+        sums = np.stack([np.bincount(lab, weights=x[:, ch] if weights is None else x[:, ch] * weights,
+                                     minlength=k) for ch in range(3)], axis=1)
+    return counts, sums
+
+
+def assign_to_centers(pixels: np.ndarray, centers: np.ndarray, mem_budget_mb=KMEANS_MEM_BUDGET_MB,
+                      return_labels=False, weights=None, return_sums=False, workers=None):
+    """
+    Nearest-center assignment of `pixels` (n x 3) to `centers` (k x 3), processed
+    in shards of at most ASSIGN_BLOCK_ROWS rows so the temporaries stay within
+    `mem_budget_mb`.
+
+    Distances use ||x||^2 - 2 x.c + ||c||^2 in float32; ||x||^2 is constant per
+    pixel so it is dropped for the argmin. Returns per-center counts (int64),
+    summing `weights` per row when given, then the labels array when
+    `return_labels` is set, then the (weighted) per-center coordinate sums
+    (k x 3 float64) when `return_sums` is set.
+
+    Shards are spread over `workers` threads (default KMEANS_WORKERS); NumPy
+    releases the GIL in the matmul, argmin and bincount. The shard layout does
+    not depend on `workers` and partial results are reduced in shard order,
+    so the output is identical for any worker count. At most as many shards
+    as fit in `mem_budget_mb` are in flight.
+    """
+    n = pixels.shape[0]
+    k = centers.shape[0]
+    c = np.ascontiguousarray(centers, dtype=np.float32)
+    c2 = (c * c).sum(axis=1)
+    # per row: float32 pixel copy + float32 distance row + int64 label
+    row_bytes = 3 * 4 + k * 4 + 8
+    budget_rows = max(1024, int(mem_budget_mb * 1024 * 1024) // row_bytes)
+    rows = min(ASSIGN_BLOCK_ROWS, budget_rows)
+    labels = np.empty(n, dtype=np.intp) if return_labels else None
+    starts = range(0, n, rows)
+
+    def block(start):
+        stop = min(n, start + rows)
+        return _assign_block(pixels[start:stop], c, c2, k, None if weights is None else weights[start:stop],
+                             None if labels is None else labels[start:stop], return_sums)
+
+    workers = max(1, min(int(workers or KMEANS_WORKERS), len(starts), budget_rows // rows))
+    if workers == 1:
+        parts = map(block, starts)
+    else:
+        parts = _bounded_map(_thread_pool(workers), block, starts, workers)
+    counts = np.zeros(k, dtype=np.int64)
+    sums = np.zeros((k, 3)) if return_sums else None
+    for cnt, sm in parts:
+        counts += cnt
+        if return_sums:
+            sums += sm
+    result = (counts,)
+    if return_labels:
+        result += (labels,)
+    if return_sums:
+        result += (sums,)
+    return result if len(result) > 1 else counts
+
+
+def kmeans_pp_init(sample: np.ndarray, k: int, rng, weights=None) -> np.ndarray:
+    """k-means++ seeding: each new center is drawn with probability ~ w(x) D(x)^2."""
+    n = sample.shape[0]
+    x = sample.astype(np.float32)
+    w = np.ones(n) if weights is None else np.asarray(weights, dtype=np.float64)
+    centers = np.empty((k, 3), dtype=np.float32)
+    cdf = np.cumsum(w)
+    centers[0] = x[min(int(np.searchsorted(cdf, rng.random() * cdf[-1])), n - 1)]
+    d2 = ((x - centers[0]) ** 2).sum(axis=1)
+    for i in range(1, k):
+        cdf = np.cumsum(w * d2)
+        total = float(cdf[-1])
+        if total <= 0:
+            # fewer distinct colors than k: duplicate an existing point
+            centers[i] = x[rng.integers(0, n)]
+            continue
+        j = int(np.searchsorted(cdf, rng.random() * total))
+        centers[i] = x[min(j, n - 1)]
+        np.minimum(d2, ((x - centers[i]) ** 2).sum(axis=1), out=d2)
+    return centers
+
+
+def kmeans_centers(flat: np.ndarray, N: int, seed=42, max_sample=50000, batch_size=2048,
+                   max_iter=100, tol=0.5, mem_budget_mb=KMEANS_MEM_BUDGET_MB, weights=None,
+                   init_centers=None, workers=None) -> np.ndarray:
+    """
+    Deterministic mini-batch K-Means over the RGB rows of `flat`, optionally
+    weighted (e.g. by histogram counts).
+
+    Centers are seeded with k-means++ on a sample drawn from a generator seeded
+    with `seed`, refined with mini-batch updates until no center moves more
+    than `tol` (in RGB units) or `max_iter` batches have run, then polished with
+    one full Lloyd step on the sample. Returns float64 centers (k x 3).
+
+    `init_centers` (e.g. from a coarser image) warm-starts the run in place of
+    k-means++; they then count as several batches of prior evidence, so the
+    mini-batches refine rather than replace them and the run stops early.
+    `workers` threads share the assignment steps (see assign_to_centers).
+    """
+    rng = np.random.default_rng(seed)
+    n = flat.shape[0]
+    if n > max_sample:
+        if weights is None:
+            sample = flat[rng.choice(n, max_sample, replace=False)]
+        else:
+            # weighted draw with replacement == sampling the underlying pixels
+            cdf = np.cumsum(weights, dtype=np.float64)
+            sample = flat[np.searchsorted(cdf, rng.random(max_sample) * cdf[-1])]
+        sw = None
+    else:
+        sample = flat
+        sw = None if weights is None else np.asarray(weights, dtype=np.float64)
+    sample = sample.astype(np.float32)
+    k = min(N, sample.shape[0])
+    bs = min(batch_size, sample.shape[0])
+    if init_centers is not None and len(init_centers) >= k:
+        centers = np.asarray(init_centers, dtype=np.float64)[:k].copy()
+        seen = np.full(k, 8.0 * bs / k)
+    else:
+        centers = kmeans_pp_init(sample, k, rng, weights=sw).astype(np.float64)
+        seen = np.zeros(k)
+    batch_cdf = None if sw is None else np.cumsum(sw)
+    tol2 = tol * tol
+    for _ in range(max_iter):
+        if batch_cdf is None:
+            batch = sample[rng.integers(0, sample.shape[0], bs)]
+        else:
+            batch = sample[np.searchsorted(batch_cdf, rng.random(bs) * batch_cdf[-1])]
+        cnt, sums = assign_to_centers(batch, centers, mem_budget_mb=mem_budget_mb, return_sums=True,
+                                      workers=workers)
+        hit = cnt > 0
+        seen += cnt
+        # per-center learning rate 1/seen: running mean of all points assigned so far
+        new_centers = centers.copy()
+        new_centers[hit] += (sums[hit] - cnt[hit, None] * centers[hit]) / seen[hit, None]
+        shift2 = ((new_centers - centers) ** 2).sum(axis=1).max()
+        centers = new_centers
+        if shift2 < tol2:
+            break
+    # polish: one full Lloyd step on the sample; empty clusters keep their center
+    cnt, sums = assign_to_centers(sample, centers, mem_budget_mb=mem_budget_mb, weights=sw, return_sums=True,
+                                  workers=workers)
+    hit = cnt > 0
+    centers[hit] = sums[hit] / cnt[hit, None]
+    return centers
+
+
+def median_cut_tree(colors: np.ndarray, counts: np.ndarray, max_colors: int) -> "PaletteTree":
+    """
+    Weighted median cut over a color histogram, recorded as a PaletteTree.
+    Repeatedly splits the most populated box along its widest channel at the
+    weighted median, up to `max_colors` boxes. The split order doesn't depend
+    on the target size, so cutting the tree at any N <= max_colors gives
+    exactly the N-box median cut.
+    """
+    x = colors.astype(np.int64)
+    w = counts.astype(np.int64)
+    boxes = [(0, np.arange(x.shape[0]))]  # (node id, member rows)
+    sums = [(x * w[:, None]).sum(axis=0)]
+    pops = [int(w.sum())]
+    splits = []
+    while len(boxes) < max_colors:
+        best, best_pop = -1, -1
+        for i, (node, b) in enumerate(boxes):
+            if b.size > 1 and pops[node] > best_pop:
+                pts = x[b]
+                if (pts.max(axis=0) > pts.min(axis=0)).any():
+                    best, best_pop = i, pops[node]
+        if best < 0:
+            break  # every box holds a single color
+        node, b = boxes.pop(best)
+        pts = x[b]
+        ch = int((pts.max(axis=0) - pts.min(axis=0)).argmax())
+        order = np.argsort(pts[:, ch], kind='stable')
+        cum = np.cumsum(w[b][order])
+        cut = int(np.searchsorted(cum, cum[-1] / 2.0)) + 1
+        cut = max(1, min(b.size - 1, cut))
+        for part in (b[order[:cut]], b[order[cut:]]):
+            boxes.append((len(pops), part))
+            sums.append((x[part] * w[part, None]).sum(axis=0))
+            pops.append(int(w[part].sum()))
+        splits.append(node)
+    return PaletteTree(np.array(sums, dtype=np.float64).reshape(-1, 3), np.array(pops, dtype=np.int64),
+                       np.array(splits, dtype=np.int64))
+
+
+def median_cut_palette(colors: np.ndarray, counts: np.ndarray, N: int):
+    """
+    Weighted median cut to at most N boxes (see median_cut_tree). Returns
+    (palette float64 k x 3 of box mean colors, int64 box populations).
+    """
+    tree = median_cut_tree(colors, counts, N)
+    nodes = tree.boxes(N)
+    pops = tree.counts[nodes]
+    return tree.sums[nodes] / np.maximum(1, pops)[:, None], pops
+
+
+def agglomerative_tree(centers: np.ndarray, pops: np.ndarray) -> "PaletteTree":
+    """
+    PaletteTree over a flat clustering: clusters are merged pairwise by the
+    smallest Ward cost n_a n_b / (n_a + n_b) ||c_a - c_b||^2 (the least
+    increase in squared error) until one is left, and the merges are
+    replayed in reverse as splits. Cutting at N undoes the last N-1 merges.
+    """
+    k = len(pops)
+    w = np.asarray(pops, dtype=np.float64)
+    sums = [np.asarray(c, dtype=np.float64) * n for c, n in zip(centers, w)]
+    counts = [int(n) for n in pops]
+    alive = list(range(k))
+    merges = []  # (a, b, merged node)
+    while len(alive) > 1:
+        best = None
+        for i, a in enumerate(alive):
+            ca = sums[a] / max(counts[a], 1)
+            for b in alive[i + 1:]:
+                d = ca - sums[b] / max(counts[b], 1)
+                na, nb = counts[a], counts[b]
+                cost = (na * nb / (na + nb) if na + nb else 0.0) * float(d @ d)
+                if best is None or cost < best[0]:
+                    best = (cost, a, b)
+        _, a, b = best
+        sums.append(sums[a] + sums[b])
+        counts.append(counts[a] + counts[b])
+        alive = [n for n in alive if n not in (a, b)] + [len(counts) - 1]
+        merges.append((a, b, len(counts) - 1))
+    # renumber so node 0 is the root and split i creates nodes 2i+1, 2i+2
+    ids = {alive[0]: 0} if alive else {}
+    splits = []
+    for i, (a, b, merged) in enumerate(reversed(merges)):
+        splits.append(ids[merged])
+        ids[a], ids[b] = 2 * i + 1, 2 * i + 2
+    order = sorted(ids, key=ids.get)
+    return PaletteTree(np.array([sums[n] for n in order], dtype=np.float64).reshape(-1, 3),
+                       np.array([counts[n] for n in order], dtype=np.int64), np.array(splits, dtype=np.int64))
+
+
+def fast_octree_palette(colors: np.ndarray, counts: np.ndarray, N: int, mem_budget_mb=KMEANS_MEM_BUDGET_MB,
+                        workers=None):
+    """
+    Weighted two-level octree quantizer (same scheme as Pillow's FASTOCTREE):
+    colors are bucketed on a fine 4-bit and a coarse 2-bit grid; the palette is
+    the most popular fine buckets plus the most popular coarse buckets after
+    subtracting the fine ones. Counts come from nearest-color assignment of the
+    histogram. Returns (palette float64 k x 3, int64 counts).
+    """
+    x = colors.astype(np.int64)
+    w = counts.astype(np.float64)
+
+    def buckets(b):
+        key = ((x[:, 0] >> (8 - b)) << (2 * b)) | ((x[:, 1] >> (8 - b)) << b) | (x[:, 2] >> (8 - b))
+        nb = 1 << (3 * b)
+        cnt = np.bincount(key, weights=w, minlength=nb)
+        sums = np.stack([np.bincount(key, weights=x[:, ch] * w, minlength=nb) for ch in range(3)], axis=1)
+        return key, cnt, sums
+
+    fkey, fcnt, fsums = buckets(4)
+    ckey, ccnt, csums = buckets(2)
+    n_coarse = min(int(np.count_nonzero(ccnt)), N)
+    n_fine = N - n_coarse
+    fine_sel = np.argsort(-fcnt, kind='stable')[:n_fine]
+    fine_sel = fine_sel[fcnt[fine_sel] > 0]
+    # subtract the chosen fine buckets from their coarse parents
+    f = fine_sel
+    parent = (((f >> 8) & 15) >> 2 << 4) | (((f >> 4) & 15) >> 2 << 2) | ((f & 15) >> 2)
+    np.subtract.at(ccnt, parent, fcnt[f])
+    np.subtract.at(csums, parent, fsums[f])
+    coarse_sel = np.argsort(-ccnt, kind='stable')[:n_coarse]
+    coarse_sel = coarse_sel[ccnt[coarse_sel] > 0.5]
+    palette = np.concatenate([fsums[fine_sel] / fcnt[fine_sel, None],
+                              csums[coarse_sel] / ccnt[coarse_sel, None]])
+    pops = assign_to_centers(colors, palette, mem_budget_mb=mem_budget_mb, weights=w, workers=workers)
+    return palette, pops
+
+
+class Palette(NamedTuple):
+    """Compact palette: (k x 3) uint8 colors and their int64 pixel counts, most frequent first."""
+    colors: np.ndarray
+    counts: np.ndarray
+
+    def as_list(self):
+        """[((r, g, b), count), ...] as used by the bar renderer."""
+        return [(tuple(int(v) for v in c), int(n)) for c, n in zip(self.colors, self.counts)]
+
+    def to_dict(self):
+        """JSON-serializable form."""
+        return {'colors': self.colors.tolist(), 'counts': self.counts.tolist()}
+
+    @property
+    def percentages(self):
+        """Pixel share of each color in percent (float64)."""
+        total = int(self.counts.sum())
+        return self.counts * (100.0 / total) if total else np.zeros(len(self.counts))
+
+    def hex(self):
+        return ['#%02x%02x%02x' % tuple(int(v) for v in c) for c in self.colors]
+
+    def to_record(self):
+        """to_dict plus hex codes and percentages, as written by `analyze`."""
+        return dict(self.to_dict(), hex=self.hex(), percent=np.round(self.percentages, 4).tolist())
+
+
+class PaletteTree(NamedTuple):
+    """
+    Hierarchical palette: node 0 covers the whole histogram and split i
+    divides node splits[i] into nodes 2i+1 and 2i+2. A node's color is its
+    weighted mean sums / counts, and a parent's sums and counts are those of
+    its children added up, so cutting after N-1 splits yields the N-color
+    palette without re-quantizing.
+    """
+    sums: np.ndarray    # (nodes x 3) float64 count-weighted color sums
+    counts: np.ndarray  # (nodes,) int64 pixel counts
+    splits: np.ndarray  # (max_colors - 1,) int64 node split at each step
+
+    @property
+    def max_colors(self):
+        return len(self.splits) + 1 if len(self.counts) else 0
+
+    def boxes(self, N):
+        """Node ids of the N-color cut, in split order."""
+        if not len(self.counts):
+            return np.zeros(0, dtype=np.int64)
+        nodes = [0]
+        for i, parent in enumerate(self.splits[:max(0, N - 1)]):
+            nodes.remove(int(parent))
+            nodes += [2 * i + 1, 2 * i + 2]
+        return np.array(nodes, dtype=np.int64)
+
+    def cut(self, N) -> Palette:
+        """The N-color Palette (most frequent first)."""
+        nodes = self.boxes(N)
+        pops = self.counts[nodes]
+        centers = self.sums[nodes] / np.maximum(1, pops)[:, None]
+        order = np.argsort(-pops, kind='stable')[:N]
+        return Palette(np.clip(np.rint(centers[order]), 0, 255).astype(np.uint8).reshape(-1, 3), pops[order])
+
+
+def image_fingerprint(im: Image.Image) -> str:
+    """
+    Content hash of an image (mode, size and pixel data). The pixels are fed
+    to the hash in bands of whole rows, so no full-frame copy is made; the
+    digest is the same as hashing im.tobytes() at once.
+    """
+    hsh = hashlib.blake2b(digest_size=16)
+    w, h = im.size
+    hsh.update(f"{im.mode}:{w}x{h}".encode())
+    rows = max(1, (1 << 20) // max(1, w))
+    for y in range(0, h, rows):
+        hsh.update(im.crop((0, y, w, min(h, y + rows))).tobytes())
+    return hsh.hexdigest()
+
+
+class PaletteCache:
+    """
+    Thread-safe LRU cache of Palette results with size-based eviction: the
+    least recently used entries are dropped once the stored arrays exceed
+    `max_bytes`.
+    """
+
+    def __init__(self, max_bytes=8 * 1024 * 1024):
+        self.max_bytes = int(max_bytes)
+        self._data = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def _entry_size(key, pal):
+        return sum(a.nbytes for a in pal) + sys.getsizeof(key)  # Palette or PaletteTree
+
+    def get(self, key):
+        with self._lock:
+            pal = self._data.get(key)
+            if pal is None:
+                self.misses += 1
+                return None
+            self._data.move_to_end(key)
+            self.hits += 1
+            return pal
+
+    def put(self, key, pal):
+        size = self._entry_size(key, pal)
+        with self._lock:
+            old = self._data.pop(key, None)
+            if old is not None:
+                self._bytes -= self._entry_size(key, old)
+            if size > self.max_bytes:
+                return
+            self._data[key] = pal
+            self._bytes += size
+            while self._bytes > self.max_bytes:
+                k, v = self._data.popitem(last=False)
+                self._bytes -= self._entry_size(k, v)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self._bytes = 0
+
+    def __len__(self):
+        return len(self._data)
+
+
+PALETTE_CACHE = PaletteCache()
+
+
+class DiskPaletteCache:
+    """
+    Persistent palette cache in a SQLite file, shared by runs and by batch
+    worker processes, with a small in-memory PaletteCache in front. It is a
+    drop-in `cache=` for extract_palette and friends.
+
+    Rows hold the compact palette (uint8 colors, int64 counts) and a blake2b
+    checksum over key and data; a PaletteTree row keeps its float64 node
+    sums in the colors column and its split order in `splits` (NULL for a
+    Palette). A row that fails the check on read is deleted and treated as
+    a miss. Entries unused for `max_age_days` are
+    dropped and the least recently used ones go once the stored palettes
+    exceed `max_bytes` (checked on open and every EVICT_EVERY writes). A
+    file that isn't a readable SQLite database is moved aside to
+    `<path>.corrupt` and started afresh.
+    """
+
+    EVICT_EVERY = 1024
+    TOUCH_AFTER = 3600.0  # seconds between access-time updates of one row
+
+    def __init__(self, path, max_bytes=256 * 1024 * 1024, max_age_days=90, memory_bytes=8 * 1024 * 1024):
+        self.path = os.path.abspath(path)
+        self.max_bytes = int(max_bytes)
+        self.max_age_days = max_age_days
+        self.memory = PaletteCache(memory_bytes)
+        self.hits = 0
+        self.misses = 0
+        self.corrupt = 0
+        self._puts = 0
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        try:
+            self._conn().execute("SELECT COUNT(*) FROM palettes").fetchone()
+        except sqlite3.DatabaseError:
+            self._local.conn.close()
+            self._local.conn = None
+            os.replace(self.path, self.path + ".corrupt")
+            self._conn()
+        self.evict()
+
+    def _conn(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30)
+            self._local.conn = conn
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute("CREATE TABLE IF NOT EXISTS palettes (key TEXT PRIMARY KEY, colors BLOB NOT NULL, "
+                         "counts BLOB NOT NULL, checksum BLOB NOT NULL, size INTEGER NOT NULL, "
+                         "created REAL NOT NULL, accessed REAL NOT NULL, splits BLOB)")
+            if 'splits' not in [col[1] for col in conn.execute("PRAGMA table_info(palettes)")]:
+                conn.execute("ALTER TABLE palettes ADD COLUMN splits BLOB")  # files from before trees were stored
+            conn.execute("CREATE INDEX IF NOT EXISTS palettes_accessed ON palettes(accessed)")
+            conn.commit()
+        return conn
+
+    @staticmethod
+    def _key(key):
+        return json.dumps(key)
+
+    @staticmethod
+    def _checksum(skey, colors, counts, splits=None):
+        hsh = hashlib.blake2b(skey.encode(), digest_size=16)
+        hsh.update(colors)
+        hsh.update(counts)
+        if splits is not None:
+            hsh.update(b'tree')
+            hsh.update(splits)
+        return hsh.digest()
+
+    @staticmethod
+    def _encode(pal):
+        """(colors, counts, splits) blobs of a Palette or PaletteTree."""
+        counts = np.ascontiguousarray(pal.counts, dtype='<i8').tobytes()
+        if isinstance(pal, PaletteTree):
+            return (np.ascontiguousarray(pal.sums, dtype='<f8').tobytes(), counts,
+                    np.ascontiguousarray(pal.splits, dtype='<i8').tobytes())
+        return np.ascontiguousarray(pal.colors, dtype=np.uint8).tobytes(), counts, None
+
+    @classmethod
+    def _decode_row(cls, skey, colors, counts, checksum, splits=None):
+        if cls._checksum(skey, colors, counts, splits) != checksum or len(counts) % 8:
+            return None
+        nodes = len(counts) // 8
+        if splits is None:
+            if len(colors) != nodes * 3:
+                return None
+            return Palette(np.frombuffer(colors, dtype=np.uint8).reshape(-1, 3),
+                           np.frombuffer(counts, dtype='<i8').astype(np.int64))
+        n_splits, rem = divmod(len(splits), 8)
+        if rem or len(colors) != nodes * 24 or nodes != (2 * n_splits + 1 if nodes else 0):
+            return None  # a tree of k leaves has k - 1 splits and 2k - 1 nodes
+        return PaletteTree(np.frombuffer(colors, dtype='<f8').astype(np.float64).reshape(-1, 3),
+                           np.frombuffer(counts, dtype='<i8').astype(np.int64),
+                           np.frombuffer(splits, dtype='<i8').astype(np.int64))
+
+    def get(self, key):
+        pal = self.memory.get(key)
+        if pal is not None:
+            with self._lock:
+                self.hits += 1
+            return pal
+        skey = self._key(key)
+        conn = self._conn()
+        row = conn.execute("SELECT colors, counts, checksum, accessed, splits FROM palettes WHERE key = ?",
+                           (skey,)).fetchone()
+        pal = None if row is None else self._decode_row(skey, row[0], row[1], row[2], row[4])
+        if row is not None and pal is None:
+            conn.execute("DELETE FROM palettes WHERE key = ?", (skey,))
+            conn.commit()
+            with self._lock:
+                self.corrupt += 1
+        with self._lock:
+            if pal is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+        now = time.time()
+        if now - row[3] > self.TOUCH_AFTER:
+            conn.execute("UPDATE palettes SET accessed = ? WHERE key = ?", (now, skey))
+            conn.commit()
+        self.memory.put(key, pal)
+        return pal
+
+    def put(self, key, pal):
+        self.memory.put(key, pal)
+        skey = self._key(key)
+        colors, counts, splits = self._encode(pal)
+        now = time.time()
+        conn = self._conn()
+        conn.execute("INSERT OR REPLACE INTO palettes (key, colors, counts, checksum, size, created, accessed, "
+                     "splits) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                     (skey, colors, counts, self._checksum(skey, colors, counts, splits),
+                      len(skey) + len(colors) + len(counts) + len(splits or b''), now, now, splits))
+        conn.commit()
+        with self._lock:
+            self._puts += 1
+            due = self._puts % self.EVICT_EVERY == 0
+        if due:
+            self.evict()
+
+    def evict(self):
+        """Drop entries older than max_age_days, then the least recently used down to max_bytes."""
+        conn = self._conn()
+        removed = 0
+        if self.max_age_days is not None:
+            removed += conn.execute("DELETE FROM palettes WHERE accessed < ?",
+                                    (time.time() - self.max_age_days * 86400.0,)).rowcount
+        total = conn.execute("SELECT COALESCE(SUM(size), 0) FROM palettes").fetchone()[0]
+        if total > self.max_bytes:
+            # free down to 90% so eviction doesn't run again on the next write
+            excess = total - int(self.max_bytes * 0.9)
+            doomed = []
+            for skey, size in conn.execute("SELECT key, size FROM palettes ORDER BY accessed"):
+                if excess <= 0:
+                    break
+                doomed.append((skey,))
+                excess -= size
+            conn.executemany("DELETE FROM palettes WHERE key = ?", doomed)
+            removed += len(doomed)
+        conn.commit()
+        if removed:
+            self.memory.clear()
+        return removed
+
+    def check(self):
+        """
+        Full integrity check: SQLite's own quick_check plus every row's
+        checksum. Bad rows are deleted. Returns {'sqlite': str, 'rows': int,
+        'bad_rows': int}.
+        """
+        conn = self._conn()
+        sqlite_ok = conn.execute("PRAGMA quick_check").fetchone()[0]
+        bad = []
+        rows = 0
+        for skey, colors, counts, checksum, splits in conn.execute(
+                "SELECT key, colors, counts, checksum, splits FROM palettes"):
+            rows += 1
+            if self._decode_row(skey, colors, counts, checksum, splits) is None:
+                bad.append((skey,))
+        conn.executemany("DELETE FROM palettes WHERE key = ?", bad)
+        conn.commit()
+        if bad:
+            self.memory.clear()
+        return {'sqlite': sqlite_ok, 'rows': rows, 'bad_rows': len(bad)}
+
+    def stats(self):
+        conn = self._conn()
+        n, total = conn.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM palettes").fetchone()
+        return {'path': self.path, 'entries': n, 'bytes': total, 'max_bytes': self.max_bytes,
+                'hits': self.hits, 'misses': self.misses, 'corrupt': self.corrupt}
+
+    def clear(self):
+        conn = self._conn()
+        conn.execute("DELETE FROM palettes")
+        conn.commit()
+        self.memory.clear()
+
+    def __len__(self):
+        return self._conn().execute("SELECT COUNT(*) FROM palettes").fetchone()[0]
+
+
+def default_cache_path():
+    """Per-user location of the persistent palette cache."""
+    root = os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache')
+    return os.path.join(root, 'palette-bar', 'palettes.sqlite')
+
+
+_DISK_CACHES = {}
+
+
+def open_disk_cache(path, max_bytes=256 * 1024 * 1024, max_age_days=90):
+    """DiskPaletteCache for `path`, opened once per process (batch workers reuse it across files)."""
+    key = (os.getpid(), os.path.abspath(path))
+    cache = _DISK_CACHES.get(key)
+    if cache is None:
+        cache = _DISK_CACHES[key] = DiskPaletteCache(path, max_bytes=max_bytes, max_age_days=max_age_days)
+    return cache
+
+
+def palette_from_histogram(hist_colors: np.ndarray, hist_counts: np.ndarray, N=16, method='MedianCut',
+                           mem_budget_mb=KMEANS_MEM_BUDGET_MB, seed=42, init_centers=None, workers=None) -> Palette:
+    """
+    Quantize a weighted color histogram to at most N colors (most frequent
+    first). `workers` is the thread count of the nearest-center assignment
+    (KMeans and FastOctree); it does not change the result.
+    """
+    centers, pops = _quantize(hist_colors, hist_counts, N, method, mem_budget_mb, seed, init_centers, workers)
+    # keep top-N by count
+    order = np.argsort(-np.asarray(pops), kind='stable')[:N]
+    return Palette(np.clip(np.rint(centers[order]), 0, 255).astype(np.uint8),
+                   np.asarray(pops, dtype=np.int64)[order])
+
+
+def _quantize(hist_colors, hist_counts, N, method, mem_budget_mb, seed, init_centers, workers):
+    """(float64 centers, int64 populations) of the chosen method, unsorted."""
+    method = (method or 'MedianCut')
+    if method == 'KMeans':
+        centers = kmeans_centers(hist_colors, N, seed=seed, mem_budget_mb=mem_budget_mb, weights=hist_counts,
+                                 init_centers=init_centers, workers=workers)
+        pops = assign_to_centers(hist_colors, centers, mem_budget_mb=mem_budget_mb, weights=hist_counts,
+                                 workers=workers)
+    elif method == 'FastOctree':
+        centers, pops = fast_octree_palette(hist_colors, hist_counts, N, mem_budget_mb=mem_budget_mb,
+                                            workers=workers)
+    else:
+        centers, pops = median_cut_palette(hist_colors, hist_counts, N)
+    return centers, pops
+
+
+def palette_tree_from_histogram(hist_colors: np.ndarray, hist_counts: np.ndarray, max_colors=MAX_TREE_COLORS,
+                                method='MedianCut', mem_budget_mb=KMEANS_MEM_BUDGET_MB, seed=42,
+                                init_centers=None, workers=None) -> PaletteTree:
+    """
+    PaletteTree answering every N up to `max_colors` from one quantization:
+    the median-cut split tree itself, or for KMeans/FastOctree the
+    agglomerative merge tree of their `max_colors`-color clustering.
+    """
+    if (method or 'MedianCut') == 'MedianCut':
+        return median_cut_tree(hist_colors, hist_counts, max_colors)
+    centers, pops = _quantize(hist_colors, hist_counts, max_colors, method, mem_budget_mb, seed, init_centers,
+                              workers)
+    return agglomerative_tree(centers, pops)
+
+
+def _palette_key(fingerprint, N, method, hist_bits, seed, init_centers=None):
+    warm = None if init_centers is None else hashlib.blake2b(init_centers.tobytes(), digest_size=8).hexdigest()
+    return (fingerprint, int(N), method, int(hist_bits), int(seed) if method == 'KMeans' else None, warm)
+
+
+def _tree_key(fingerprint, max_colors, method, hist_bits, seed, init_centers=None):
+    return _palette_key(fingerprint, max_colors, method, hist_bits, seed, init_centers) + ('tree',)
+
+
+def lookup_palette(cache, fingerprint, N=16, method='MedianCut', seed=42, hist_bits=HIST_BITS,
+                   hierarchical=False, **_unused):
+    """
+    Cached palette for `fingerprint` and the given quantization parameters,
+    or None; lets callers skip decoding entirely on a hit. Extra keywords
+    (mem_budget_mb, workers) don't affect the result and are ignored.
+    """
+    if cache is None:
+        return None
+    method = method or 'MedianCut'
+    if hierarchical:
+        tree = cache.get(_tree_key(fingerprint, max(N, MAX_TREE_COLORS), method, hist_bits, seed))
+        return None if tree is None else tree.cut(N)
+    return cache.get(_palette_key(fingerprint, N, method, hist_bits, seed))
+
+
+def _memoized(im, key_fn, quantize, hist_bits, cache, fingerprint, trace):
+    """Shared body of extract_palette(_tree): cache lookup, then histogram and `quantize` on a miss."""
+    key = None
+    npix = im.size[0] * im.size[1]
+    if cache is not None:
+        if fingerprint is None:
+            with _stage(trace, 'fingerprint', npix):
+                fingerprint = image_fingerprint(im)
+        key = key_fn(fingerprint)
+        hit = cache.get(key)
+        if hit is not None:
+            with _stage(trace, 'cache_hit'):
+                return hit
+    # Quantize / cluster according to method, working on the weighted color
+    # histogram instead of raw pixels
+    im = as_rgb(im, trace)
+    with _stage(trace, 'histogram', npix) as st:
+        hist_colors, hist_counts = st.out(color_histogram(im, bits=hist_bits))
+    with _stage(trace, 'quantize', npix) as st:
+        result = st.out(quantize(hist_colors, hist_counts))
+    if key is not None:
+        cache.put(key, result)
+    return result
+
+
+def _warm_start(method, init_centers):
+    if method != 'KMeans' or init_centers is None:
+        return None
+    return np.asarray(init_centers, dtype=np.float64)
+
+
+def extract_palette(im: Image.Image, N=16, method='MedianCut', mem_budget_mb=KMEANS_MEM_BUDGET_MB,
+                    seed=42, hist_bits=HIST_BITS, cache=PALETTE_CACHE, fingerprint=None,
+                    init_centers=None, trace=None, workers=None, hierarchical=False) -> Palette:
+    """
+    Quantize `im` to at most N colors and return a Palette (most frequent first).
+
+    Results are memoized in `cache` (pass None to disable), keyed by the image
+    fingerprint plus the parameters that affect the result. Callers that
+    already know the fingerprint can pass it to skip hashing the pixels.
+    `init_centers` warm-starts KMeans (ignored by the other methods).
+    `trace` is an optional PipelineTrace; `workers` sets the assignment
+    thread count (not part of the cache key, the result is the same).
+
+    With hierarchical=True the palette is cut from the image's PaletteTree
+    (see extract_palette_tree), so other N values reuse the cached tree.
+    MedianCut gives the same palette either way.
+    """
+    method = (method or 'MedianCut')
+    if hierarchical:
+        return extract_palette_tree(im, max(N, MAX_TREE_COLORS), method, mem_budget_mb=mem_budget_mb, seed=seed,
+                                    hist_bits=hist_bits, cache=cache, fingerprint=fingerprint,
+                                    init_centers=init_centers, trace=trace, workers=workers).cut(N)
+    init_centers = _warm_start(method, init_centers)
+    return _memoized(
+        im, lambda fp: _palette_key(fp, N, method, hist_bits, seed, init_centers),
+        lambda hc, hn: palette_from_histogram(hc, hn, N, method, mem_budget_mb=mem_budget_mb, seed=seed,
+                                              init_centers=init_centers, workers=workers),
+        hist_bits, cache, fingerprint, trace)
+
+
+def extract_palette_tree(im: Image.Image, max_colors=MAX_TREE_COLORS, method='MedianCut', mem_budget_mb=KMEANS_MEM_BUDGET_MB,
+                         seed=42, hist_bits=HIST_BITS, cache=PALETTE_CACHE, fingerprint=None,
+                         init_centers=None, trace=None, workers=None) -> PaletteTree:
+    """
+    PaletteTree of `im` (see palette_tree_from_histogram), memoized like
+    extract_palette. Any N <= max_colors is then tree.cut(N), which is
+    cheap enough to redo on every redraw.
+    """
+    method = (method or 'MedianCut')
+    init_centers = _warm_start(method, init_centers)
+    return _memoized(
+        im, lambda fp: _tree_key(fp, max_colors, method, hist_bits, seed, init_centers),
+        lambda hc, hn: palette_tree_from_histogram(hc, hn, max_colors, method, mem_budget_mb=mem_budget_mb,
+                                                   seed=seed, init_centers=init_centers, workers=workers),
+        hist_bits, cache, fingerprint, trace)
+
+
+def extract_palette_tiled(path, N=16, method='MedianCut', mem_budget_mb=KMEANS_MEM_BUDGET_MB,
+                          seed=42, hist_bits=HIST_BITS, cache=PALETTE_CACHE, tile_pixels=TILE_PIXELS,
+                          trace=None, workers=None, fingerprint=None, hierarchical=False) -> Palette:
+    """
+    extract_palette for an image file that may not fit in memory: the file is
+    read tile by tile (see iter_image_tiles) into a ColorHistogram, so for
+    strip/tile TIFFs and uncompressed layouts peak memory follows
+    `tile_pixels` rather than the image dimensions (other formats, PNG
+    included, are decoded in full first). The result equals extract_palette
+    on the fully decoded image.
+    """
+    method = (method or 'MedianCut')
+    max_colors = max(N, MAX_TREE_COLORS)
+    key = None
+    if cache is not None:
+        fingerprint = fingerprint or file_fingerprint(path)
+        if hierarchical:
+            key = _tree_key(fingerprint, max_colors, method, hist_bits, seed)
+        else:
+            key = _palette_key(fingerprint, N, method, hist_bits, seed)
+        hit = cache.get(key)
+        if hit is not None:
+            return hit.cut(N) if hierarchical else hit
+    acc = ColorHistogram(hist_bits)
+    # decoding and counting interleave tile by tile, so they are one stage here
+    with _stage(trace, 'decode+histogram') as st:
+        for block in iter_image_tiles(path, tile_pixels):
+            st.count(block.shape[0])
+            for start in range(0, block.shape[0], 1 << 20):
+                acc.add(block[start:start + (1 << 20)])
+        hist_colors, hist_counts = st.out(acc.result())
+    with _stage(trace, 'quantize', int(hist_counts.sum())) as st:
+        if hierarchical:
+            result = palette_tree_from_histogram(hist_colors, hist_counts, max_colors, method,
+                                                 mem_budget_mb=mem_budget_mb, seed=seed, workers=workers)
+        else:
+            result = palette_from_histogram(hist_colors, hist_counts, N, method, mem_budget_mb=mem_budget_mb,
+                                            seed=seed, workers=workers)
+        st.out(result)
+    if key is not None:
+        cache.put(key, result)
+    return result.cut(N) if hierarchical else result
+
+
+def build_palette_bar(im: Image.Image, N=16, bar_h_ratio=0.09, bar_h_min=60, bar_h_max=200,
+                      separator=2, border_px=2, bar_bg=(30, 30, 30),
+                      sep_color=(220, 220, 220), border_color=(190, 190, 190),
+                      sort_by_luma=True, swatch_aspect=None, method='MedianCut',
+                      mem_budget_mb=KMEANS_MEM_BUDGET_MB, seed=42, hist_bits=HIST_BITS,
+                      cache=PALETTE_CACHE, fingerprint=None, composite=True, posterize=False, trace=None,
+                      workers=None):
+    """
+    Given a PIL image `im`, return (composite_image, palette_bar_image) where
+    composite = original stacked over palette bar.
+
+    `mem_budget_mb` caps the temporaries of the KMeans full-image assignment,
+    which runs on `workers` threads (default KMEANS_WORKERS);
+    `seed` makes KMeans palettes reproducible. All methods cluster the color
+    histogram built with `hist_bits` per channel (8 = exact colors). The
+    palette comes from extract_palette (memoized in `cache`), so changing only
+    rendering parameters does not re-quantize. With composite=False only the
+    bar is rendered and the first element of the result is None; with
+    posterize=True the image is remapped to the palette. Pass a
+    PipelineTrace as `trace` to record per-stage timings.
+    """
+    im = as_rgb(im, trace)
+    palette = extract_palette(im, N, method, mem_budget_mb=mem_budget_mb, seed=seed, hist_bits=hist_bits,
+                              cache=cache, fingerprint=fingerprint, trace=trace, workers=workers)
+    return render_palette_bar(im, palette, N=N, bar_h_ratio=bar_h_ratio, bar_h_min=bar_h_min,
+                              bar_h_max=bar_h_max, separator=separator, border_px=border_px,
+                              bar_bg=bar_bg, sep_color=sep_color, border_color=border_color,
+                              sort_by_luma=sort_by_luma, swatch_aspect=swatch_aspect, composite=composite,
+                              posterize=posterize, trace=trace)
+
+
+def _fill_rect(arr, x0, y0, x1, y1, rgb):
+    """Fill the inclusive box [x0, x1] x [y0, y1] of `arr`, clipped like ImageDraw.rectangle."""
+    hh, ww = arr.shape[:2]
+    x0, y0 = max(0, x0), max(0, y0)
+    x1, y1 = min(ww - 1, x1), min(hh - 1, y1)
+    if x1 >= x0 and y1 >= y0:
+        arr[y0:y1 + 1, x0:x1 + 1] = rgb
+
+
+def draw_palette_bar(colors, w, bar_h, N=16, separator=2, border_px=2, bar_bg=(30, 30, 30),
+                     sep_color=(220, 220, 220), border_color=(190, 190, 190), swatch_aspect=None):
+    """
+    Rasterize a palette bar of size w x bar_h into a new (bar_h x w x 3) uint8
+    array using slice assignment. `colors` are [((r, g, b), count), ...] in
+    display order; geometry matches the original ImageDraw rendering pixel
+    for pixel (inclusive rectangles, last swatch stretched to the border).
+    """
+    bar = np.empty((bar_h, w, 3), dtype=np.uint8)
+    bar[:] = bar_bg
+
+    # Outer border
+    if border_px > 0:
+        bp = border_px
+        bar[:bp] = border_color
+        bar[max(0, bar_h - bp):] = border_color
+        bar[:, :bp] = border_color
+        bar[:, max(0, w - bp):] = border_color
+
+    # Inner region
+    inner_left = border_px
+    inner_top = border_px
+    inner_right = w - border_px
+    inner_bottom = bar_h - border_px
+    inner_w = inner_right - inner_left
+
+    # Recompute swatch_h from swatch_aspect so the inner height matches exactly
+    if swatch_aspect:
+        try:
+            aspect = float(swatch_aspect)
+        except Exception:
+            aspect = None
+    else:
+        aspect = None
+    total_separators = (N - 1) * separator
+    swatch_w = max(1, (inner_w - total_separators) // N)
+    if aspect and aspect > 0:
+        swatch_h = max(1, int(round(swatch_w / aspect)))
+        inner_bottom = inner_top + swatch_h
+        if inner_bottom > bar_h - border_px:
+            inner_bottom = bar_h - border_px
+    x = inner_left
+    for i, (rgb, _cnt) in enumerate(colors):
+        if i == N - 1:
+            sw_right = inner_right
+        else:
+            sw_right = x + swatch_w
+        _fill_rect(bar, x, inner_top, sw_right, inner_bottom, tuple(rgb))
+        if i != N - 1 and separator > 0:
+            _fill_rect(bar, sw_right, inner_top, sw_right + separator - 1, inner_bottom, sep_color)
+        x = sw_right + separator
+    return bar
+
+
+def compute_bar_height(w, h, N=16, bar_h_ratio=0.09, bar_h_min=60, bar_h_max=200,
+                       separator=2, border_px=2, swatch_aspect=None) -> int:
+    """Height of the palette bar drawn under a w x h image."""
+    # Compute bar height from single-swatch aspect if provided
+    if swatch_aspect:
+        try:
+            aspect = float(swatch_aspect)
+        except Exception:
+            aspect = None
+        if aspect and aspect > 0:
+            inner_w = max(1, w - 2 * border_px)
+            total_separators = max(0, (N - 1) * separator)
+            swatch_w = max(1, (inner_w - total_separators) // N)
+            swatch_h = max(1, int(round(swatch_w / aspect)))
+            bar_h = swatch_h + 2 * border_px
+        else:
+            bar_h = int(h * bar_h_ratio)
+    else:
+        bar_h = int(h * bar_h_ratio)
+    # If swatch_aspect is specified, honor it fully (no upper cap). Capping to bar_h_max
+    # can flatten swatches on wide images and break requested ratios like 1:1.
+    if swatch_aspect:
+        bar_h = max(2 * border_px + 1, int(bar_h))
+    else:
+        bar_h = min(max(int(bar_h), bar_h_min), bar_h_max)
+    return bar_h
+
+
+def display_colors(palette, N=16, sort_by_luma=True):
+    """[((r, g, b), count), ...] in bar order: padded to N, optionally sorted dark to light."""
+    colors = palette.as_list() if isinstance(palette, Palette) else list(palette)
+
+    # Pad to N if needed using most frequent colors
+    if 0 < len(colors) < N:
+        colors_sorted_by_freq = sorted(colors, key=lambda x: x[1], reverse=True)
+        while len(colors) < N:
+            colors.append(colors_sorted_by_freq[len(colors) % len(colors_sorted_by_freq)])
+
+    # Sort by luminance for a clean gradient-like arrangement
+    if sort_by_luma:
+        def luminance(rgb):
+            r, g, b = rgb
+            return 0.2126 * r + 0.7152 * g + 0.0722 * b
+        colors = sorted(colors[:N], key=lambda x: luminance(x[0]))
+    else:
+        colors = colors[:N]
+    return colors
+
+
+def render_palette_bar(im: Image.Image, palette, N=16, bar_h_ratio=0.09, bar_h_min=60, bar_h_max=200,
+                       separator=2, border_px=2, bar_bg=(30, 30, 30),
+                       sep_color=(220, 220, 220), border_color=(190, 190, 190),
+                       sort_by_luma=True, swatch_aspect=None, composite=True, posterize=False, trace=None):
+    """
+    Draw `palette` (a Palette or [((r, g, b), count), ...]) as a bar under `im`
+    and return (composite_image, palette_bar_image); composite_image is None
+    when `composite` is False. With posterize=True the image part is
+    remapped to the palette colors (see posterize_image).
+    """
+    im = as_rgb(im, trace)
+    w, h = im.size
+    bar_h = compute_bar_height(w, h, N=N, bar_h_ratio=bar_h_ratio, bar_h_min=bar_h_min, bar_h_max=bar_h_max,
+                               separator=separator, border_px=border_px, swatch_aspect=swatch_aspect)
+    with _stage(trace, 'sort'):
+        colors = display_colors(palette, N, sort_by_luma)
+    with _stage(trace, 'draw', w * bar_h) as st:
+        bar = st.out(Image.fromarray(draw_palette_bar(colors, w, bar_h, N=N, separator=separator,
+                                                      border_px=border_px, bar_bg=bar_bg, sep_color=sep_color,
+                                                      border_color=border_color, swatch_aspect=swatch_aspect)))
+    if not composite:
+        return None, bar
+    if posterize:
+        im = posterize_image(im, palette, trace=trace)
+
+    # Compose final image (original on top, bar at bottom) in a single allocation
+    with _stage(trace, 'composite', w * (h + bar_h)) as st:
+        out = st.out(Image.new("RGB", (w, h + bar_h)))
+        out.paste(im, (0, 0))
+        out.paste(bar, (0, h))
+
+    return out, bar
+
+
+# ------------------------------
+# Image loading
+# ------------------------------
+
+def file_fingerprint(path, level=None) -> str:
+    """Cache key for a decoded level of a file, derived from its identity (path, size, mtime)."""
+    st = os.stat(path)
+    return f"{os.path.abspath(path)}:{st.st_size}:{st.st_mtime_ns}@{level or 'full'}"
+
+
+def file_content_hash(path, chunk=1 << 20) -> str:
+    """blake2b digest of a file's bytes, read in chunks."""
+    hsh = hashlib.blake2b(digest_size=16)
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(chunk), b''):
+            hsh.update(block)
+    return hsh.hexdigest()
+
+
+class _allow_large_images:
+    """Temporarily lift Pillow's decompression-bomb limit (for tiled reads of trusted huge files)."""
+
+    def __enter__(self):
+        self._saved = Image.MAX_IMAGE_PIXELS
+        Image.MAX_IMAGE_PIXELS = None
+
+    def __exit__(self, *exc):
+        Image.MAX_IMAGE_PIXELS = self._saved
+
+
+_RAW_LAYOUTS = {  # rawmode -> (bytes per pixel, channel indices of R, G, B)
+    'RGB': (3, (0, 1, 2)), 'BGR': (3, (2, 1, 0)),
+    'RGBX': (4, (0, 1, 2)), 'RGBA': (4, (0, 1, 2)),
+    'BGRX': (4, (2, 1, 0)), 'BGRA': (4, (2, 1, 0)),
+    'L': (1, (0, 0, 0)),
+}
+
+
+_TIFF_COPY_TAGS = (258, 259, 262, 266, 277, 317, 320, 338, 339, 347, 530, 532)  # tags a chunk decode needs
+
+
+def _tiff_ifd(entries, offset, endian='<'):
+    """
+    One TIFF IFD for `entries` (tag -> (type, values); RATIONAL values as flat
+    numerator, denominator pairs) placed at file offset `offset`, followed
+    by its out-of-line values. No next IFD.
+    """
+    fmt = {1: 'B', 3: 'H', 4: 'I', 5: 'I', 7: 'B'}
+    packed = []
+    for tag in sorted(entries):
+        typ, vals = entries[tag]
+        payload = struct.pack('%s%d%s' % (endian, len(vals), fmt[typ]), *vals)
+        packed.append((tag, typ, len(vals) // 2 if typ == 5 else len(vals), payload))
+    extra = bytearray()
+    extra_base = offset + 2 + 12 * len(packed) + 4
+    ifd = bytearray(struct.pack(endian + 'H', len(packed)))
+    for tag, typ, count, payload in packed:
+        if len(payload) <= 4:
+            ifd += struct.pack(endian + 'HHI', tag, typ, count) + payload.ljust(4, b'\0')
+        else:
+            ifd += struct.pack(endian + 'HHII', tag, typ, count, extra_base + len(extra))
+            extra += payload + (b'\0' if len(payload) & 1 else b'')
+    ifd += struct.pack(endian + 'I', 0)
+    return bytes(ifd + extra)
+
+
+def _tiff_header(endian='<', ifd_offset=8):
+    return (b'II*\0' if endian == '<' else b'MM\0*') + struct.pack(endian + 'I', ifd_offset)
+
+
+def _mini_tiff(width, rows, data, tags, endian='<'):
+    """
+    Wrap one compressed TIFF strip/tile in a minimal single-strip TIFF so that
+    Pillow (via libtiff) can decode it on its own. `tags` maps tag -> (type,
+    values) copied from the source file (BitsPerSample, Compression,
+    ColorMap, ...; see _tiff_ifd) and `endian` is the source's byte order
+    ('<' or '>'), which the chunk data is stored in.
+    """
+    entries = {256: (4, [width]), 257: (4, [rows]), 278: (4, [rows]),
+               273: (4, [0]), 279: (4, [len(data)]), 284: (3, [1])}
+    for tag, (typ, vals) in tags.items():
+        entries[tag] = (typ, list(vals))
+    # the strip offset is a single inline LONG, so patching it doesn't change the IFD's length
+    entries[273] = (4, [8 + len(_tiff_ifd(entries, 8, endian))])
+    return _tiff_header(endian) + _tiff_ifd(entries, 8, endian) + data
+
+
+def _iter_tiff_chunks(im, path):
+    """
+    Decode a TIFF strip by strip (or tile by tile): yields ((x0, y0), RGB
+    image); None if the layout is unsupported, or if the rebuilt chunk
+    header doesn't open with the source's mode and decoder settings (the
+    caller then decodes the file in full).
+    """
+    tags = im.tag_v2
+    if tags.get(284, 1) != 1 or 330 in tags:  # planar-separate or SubIFDs
+        return None
+    w, h = im.size
+    if 324 in tags:
+        cw, ch = int(tags[322]), int(tags[323])
+        offsets, counts = tags[324], tags[325]
+        across = -(-w // cw)
+        boxes = [((i % across) * cw, (i // across) * ch) for i in range(len(offsets))]
+    else:
+        rps = int(tags.get(278, h))
+        cw, ch = w, rps
+        offsets, counts = tags[273], tags[279]
+        boxes = [(0, i * rps) for i in range(len(offsets))]
+    if not len(offsets):
+        return None
+    with open(path, 'rb') as f:
+        endian = '>' if f.read(2) == b'MM' else '<'
+    copy = {}
+    raw = im.tag  # raw typed values, for exact re-encoding
+    for tag in _TIFF_COPY_TAGS:
+        if tag in raw.tagtype and tag in tags:
+            typ = raw.tagtype[tag]
+            vals = tags[tag]
+            if isinstance(vals, bytes):
+                vals = list(vals)
+            elif not isinstance(vals, (tuple, list)):
+                vals = [vals]
+            if typ == 5:
+                vals = [int(x) for v in vals for x in (v.numerator, v.denominator)]
+            elif typ in (1, 3, 4, 7):
+                vals = [int(v) for v in vals]
+            else:
+                return None
+            copy[tag] = (typ, vals)
+
+    def chunk_rows(y0):
+        return min(ch, h - y0) if 324 not in tags else ch
+
+    # Image.open only parses the header, so this checks the rebuilt layout without decoding anything
+    with Image.open(io.BytesIO(_mini_tiff(cw, chunk_rows(boxes[0][1]), b'', copy, endian))) as probe:
+        if (probe.mode != im.mode or probe.tile[0][0] != im.tile[0][0]
+                or probe.tile[0][3][0] != im.tile[0][3][0]):
+            return None
+
+    def gen():
+        with open(path, 'rb') as f:
+            for (x0, y0), off, cnt in zip(boxes, offsets, counts):
+                rows = chunk_rows(y0)
+                f.seek(off)
+                data = f.read(cnt)
+                with Image.open(io.BytesIO(_mini_tiff(cw, rows, data, copy, endian))) as chunk:
+                    chunk = as_rgb(chunk)
+                    # edge tiles are padded; keep only the part inside the image
+                    vis_w, vis_h = min(cw, w - x0), min(rows, h - y0)
+                    if (vis_w, vis_h) != chunk.size:
+                        chunk = chunk.crop((0, 0, vis_w, vis_h))
+                    yield (x0, y0), chunk
+    return gen()
+
+
+def iter_image_tiles(path, tile_pixels=TILE_PIXELS):
+    """
+    Yield the pixels of an image file as (n x 3) uint8 RGB blocks without
+    decoding the whole image where the format allows it (see
+    iter_image_regions). Block order follows the file layout, which is all a
+    histogram needs.
+    """
+    for _pos, block in iter_image_regions(path, tile_pixels):
+        yield block.reshape(-1, 3)
+
+
+def iter_image_regions(path, tile_pixels=TILE_PIXELS):
+    """
+    Yield ((x0, y0), rows x cols x 3 uint8 RGB array) covering an image file,
+    without decoding the whole image where the format allows it:
+
+    - uncompressed single-tile layouts (BMP, PPM, raw TIFF) are read through a
+      memory map, about `tile_pixels` at a time;
+    - strip/tile TIFFs are decoded one strip or tile at a time (any compression
+      libtiff supports), so memory follows the file's own chunk size;
+    - anything else (PNG, JPEG, ...) is decoded in full and then walked in
+      strips, so only the two layouts above keep memory bounded.
+    """
+    with _allow_large_images():
+        im = Image.open(path)
+    w, h = im.size
+    tile = im.tile[0] if len(im.tile) == 1 else None
+    if tile is not None and tile[0] == 'raw':
+        args = tile[3] if isinstance(tile[3], tuple) else (tile[3], 0, 1)
+        rawmode, stride = args[0], args[1] if len(args) > 1 else 0
+        ystep = args[2] if len(args) > 2 else 1  # -1: rows stored bottom-up (BMP)
+        layout = _RAW_LAYOUTS.get(rawmode)
+        if layout is not None and tuple(tile[1]) == (0, 0, w, h):
+            bpp, chans = layout
+            stride = stride or w * bpp
+            mm = np.memmap(path, dtype=np.uint8, mode='r', offset=tile[2], shape=(h, stride))
+            rows = max(1, int(tile_pixels) // max(1, w))
+            for y in range(0, h, rows):
+                block = np.asarray(mm[y:y + rows, :w * bpp]).reshape(-1, w, bpp)
+                if ystep < 0:
+                    yield (0, h - y - len(block)), np.ascontiguousarray(block[::-1, :, chans])
+                else:
+                    yield (0, y), np.ascontiguousarray(block[..., chans])
+            im.close()
+            return
+    if im.format == 'TIFF':
+        chunks = _iter_tiff_chunks(im, path)
+        if chunks is not None:
+            im.close()
+            for (x0, y0), chunk in chunks:
+                for (_x, y), block in _iter_rgb_regions(chunk, tile_pixels):
+                    yield (x0, y0 + y), block
+            return
+    with _allow_large_images():
+        im.load()
+    yield from _iter_rgb_regions(as_rgb(im), tile_pixels)
+
+
+def _iter_rgb_regions(im, max_pixels):
+    """iter_rgb_strips with positions: ((0, y0), rows x w x 3 array)."""
+    w, h = im.size
+    rows = max(1, int(max_pixels) // max(1, w))
+    for y in range(0, h, rows):
+        yield (0, y), np.asarray(as_rgb(im.crop((0, y, w, min(h, y + rows)))), dtype=np.uint8)
+
+
+class ImageSource:
+    """
+    Lazily decoded image file. Only the header is read up front; preview
+    levels are decoded at reduced scale (JPEG DCT scaling via draft(), then a
+    reduce-assisted LANCZOS resize) and cached once per file, while the
+    full-resolution image is decoded only when an export needs it.
+    """
+
+    def __init__(self, path, content_hash=False):
+        self.path = path
+        self.content_hash = content_hash
+        self._digest = None
+        with Image.open(path) as im:
+            self.size = im.size
+            self.format = im.format
+        self._levels = {}  # max side -> Future of the RGB image
+        self._lock = threading.Lock()
+
+    def fingerprint(self, level=None) -> str:
+        """
+        Cache key for a decoded level (max side or size), derived from the
+        file identity, or from its bytes with content_hash=True (survives
+        renames and touch, costs one read of the file).
+        """
+        if not self.content_hash:
+            return file_fingerprint(self.path, level)
+        if self._digest is None:
+            self._digest = file_content_hash(self.path)
+        return f"blake2b:{self._digest}@{level or 'full'}"
+
+    def preview_size(self, maxside):
+        w, h = self.size
+        scale = min(maxside / float(max(w, h)), 1.0)
+        return max(1, int(round(w * scale))), max(1, int(round(h * scale)))
+
+    def full(self, trace=None) -> Image.Image:
+        """Decode the whole image at full resolution (not cached)."""
+        with _stage(trace, 'decode', self.size[0] * self.size[1]) as st:
+            im = Image.open(self.path)
+            im.load()
+            st.out(im)
+        return as_rgb(im, trace)
+
+    def decode(self, min_size=None, trace=None) -> Image.Image:
+        """
+        Decode at the smallest JPEG DCT scale whose size is at least `min_size`;
+        other formats (or min_size=None) decode at full resolution. Not cached.
+        """
+        w, h = self.size
+        if min_size is None or (min_size[0] >= w and min_size[1] >= h) or self.format != "JPEG":
+            return self.full(trace)
+        with _stage(trace, 'decode') as st:
+            im = Image.open(self.path)
+            im.draft("RGB", (max(1, int(min_size[0])), max(1, int(min_size[1]))))
+            im.load()
+            st.count(im.size[0] * im.size[1])
+            st.out(im)
+        return as_rgb(im, trace)
+
+    def preview(self, maxside, trace=None, base_side=None) -> Image.Image:
+        """
+        RGB image whose long side is at most `maxside`, decoded once and
+        cached. Concurrent callers asking for the same level share one
+        decode. `base_side` names a larger level the caller needs as well:
+        unless the file is a JPEG (whose draft decode gets cheaper with the
+        scale) every level costs a full decode, so that level is built first
+        and this one is downsized from it.
+        """
+        from concurrent.futures import Future
+        with self._lock:
+            fut = self._levels.get(maxside)
+            owner = fut is None
+            if owner:
+                fut = self._levels[maxside] = Future()
+        if not owner:
+            return fut.result()
+        try:
+            im = self._build_level(maxside, trace, base_side)
+        except BaseException as e:
+            with self._lock:
+                del self._levels[maxside]  # a later call retries
+            fut.set_exception(e)
+            raise
+        fut.set_result(im)
+        return im
+
+    def _build_level(self, maxside, trace, base_side):
+        tw, th = self.preview_size(maxside)
+        if (tw, th) == self.size:
+            return self.full(trace)
+        base = None
+        if base_side and base_side > maxside and self.format != "JPEG":
+            base = self.preview(base_side, trace)
+        else:
+            with self._lock:
+                # levels in the dict are either done or still being decoded (failures are removed)
+                bigger = {s: f for s, f in self._levels.items() if s > maxside}
+                done = [s for s, f in bigger.items() if f.done()]
+            if done:
+                base = bigger[min(done)].result()
+            elif bigger and self.format != "JPEG":
+                base = bigger[min(bigger)].result()  # wait for that decode instead of repeating it
+        if base is not None:
+            # Downscale from a larger level
+            with _stage(trace, 'resize', tw * th) as st:
+                return st.out(base.resize((tw, th), Image.LANCZOS))
+        im = self.decode((tw, th), trace)
+        if im.size != (tw, th):
+            with _stage(trace, 'resize', tw * th) as st:
+                im = st.out(im.resize((tw, th), Image.LANCZOS, reducing_gap=3.0))
+        return im
+
+
+# ------------------------------
+# Palette remapping
+# ------------------------------
+
+REMAP_LUT_BITS = 6  # bits per channel of the remap lookup grid (64^3 cells)
+
+
+class PaletteLUT:
+    """
+    Exact nearest-palette-color table for every 8-bit RGB value, so remapping
+    a pixel is a single lookup instead of k distance computations.
+
+    The table is built coarse to fine. A (2^bits)^3 grid of cells is labeled
+    by the color nearest each cell's center. A cell whose two nearest colors
+    are closer (in distance from the center) than the cell's diameter lies
+    on a Voronoi boundary. Only those cells are refined, value by value.
+    Everything else takes the center's label, which provably holds for the
+    whole cell. Labels equal a brute-force search (ties go to the lower
+    index), and the table is 16 MB of uint8.
+    """
+
+    def __init__(self, colors, bits=REMAP_LUT_BITS, mem_budget_mb=KMEANS_MEM_BUDGET_MB):
+        self.colors = np.ascontiguousarray(colors, dtype=np.uint8).reshape(-1, 3)
+        self.bits = int(bits)
+        k = len(self.colors)
+        if not 1 <= k <= 256:
+            raise ValueError(f"a remap palette needs 1 to 256 colors, got {k}")
+        n = 1 << self.bits
+        step = 256 >> self.bits
+        c = self.colors.astype(np.float64)
+        c2 = (c * c).sum(axis=1)
+        axis = np.arange(n) * step + (step - 1) / 2.0  # center of the integer values in a cell
+
+        def center_dists(cells):
+            """Distances from the centers of flat cell ids `cells` to every palette color."""
+            centers = axis[np.stack(np.unravel_index(cells, (n, n, n)), axis=-1)]
+            return np.sqrt(np.maximum((centers * centers).sum(axis=1)[:, None] - 2 * centers @ c.T + c2, 0))
+
+        # |p - center| <= r inside a cell, so the center's nearest color wins for all of it unless
+        # the runner-up is within 2r (plus a margin for rounding)
+        slack = np.sqrt(3) * (step - 1) + 1e-3
+        # the coarse pass runs in blocks of cells so the distance temporaries stay within mem_budget_mb
+        # (per cell: float64 distances, their partition and the matmul result)
+        rows = max(1024, int(mem_budget_mb * 1024 * 1024) // (k * 8 * 3 + 64))
+        coarse = np.empty(n ** 3, dtype=np.uint8)
+        boundary, near = [], []
+        for start in range(0, n ** 3, rows):
+            cells = np.arange(start, min(n ** 3, start + rows))
+            d = center_dists(cells)
+            coarse[start:start + len(cells)] = np.argmin(d, axis=1)
+            if k > 1:
+                two = np.partition(d, 1, axis=1)
+                edge = np.flatnonzero(two[:, 1] - two[:, 0] <= slack)
+                boundary.append(cells[edge])
+                # a color can only win in a cell if its center distance is within nearest + 2r
+                near.append((d[edge] <= two[edge, :1] + slack).sum(axis=1))
+            del d
+        boundary = np.concatenate(boundary) if boundary else np.zeros(0, dtype=np.intp)
+        near = np.concatenate(near) if near else np.zeros(0, dtype=np.intp)
+        self.boundary_fraction = len(boundary) / float(n ** 3)
+        table = np.empty((n, step, n, step, n, step), dtype=np.uint8)
+        table[...] = coarse.reshape(n, 1, n, 1, n, 1)
+        del coarse
+        self.table = table.reshape(-1)
+        if not len(boundary):
+            return
+        # refine every integer value of the boundary cells. Cells are grouped by their candidate
+        # count and each group is searched over its own candidates (in index order, so ties
+        # resolve to the lower index like a brute-force argmin). With x = base + off the score
+        # ||c||^2 - 2 x.c splits into a per-cell and a per-offset term; all are integers, exact
+        # in float32.
+        cf = self.colors.astype(np.float32)
+        sub = np.arange(step)
+        offs = np.stack(np.meshgrid(sub, sub, sub, indexing='ij'), axis=-1).reshape(-1, 3)
+        off_score = (-2 * offs.astype(np.float32) @ cf.T).T.copy()  # (k, step^3)
+        off_idx = (offs[:, 0] << 16) | (offs[:, 1] << 8) | offs[:, 2]
+        for m in np.unique(near):
+            group = np.flatnonzero(near == m)
+            # per cell: the (m x step^3) float32 scores and their argmin, plus its center distances
+            chunk = max(1, int(mem_budget_mb * 1024 * 1024) // (step ** 3 * (m * 8 + 16) + k * 8))
+            for i in range(0, len(group), chunk):
+                g = group[i:i + chunk]
+                cand = np.sort(np.argpartition(center_dists(boundary[g]), m - 1, axis=1)[:, :m], axis=1) \
+                    if m < k else np.broadcast_to(np.arange(k), (len(g), k))
+                base = np.stack(np.unravel_index(boundary[g], (n, n, n)), axis=-1) * step
+                cell_score = c2[cand].astype(np.float32) - 2 * (base[:, None, :] * cf[cand]).sum(axis=2)
+                score = cell_score[:, :, None] + off_score[cand]  # (cells, m, step^3)
+                lab = np.take_along_axis(cand, np.argmin(score, axis=1), axis=1)
+                base_idx = (base[:, 0] << 16) | (base[:, 1] << 8) | base[:, 2]
+                self.table[base_idx[:, None] + off_idx[None, :]] = lab
+
+    def labels(self, pixels):
+        """Palette index (uint8) of each pixel of a (..., 3) uint8 array, same leading shape."""
+        px = np.asarray(pixels, dtype=np.uint8)
+        idx = px[..., 0].astype(np.int32) << 16
+        idx |= px[..., 1].astype(np.int32) << 8
+        idx |= px[..., 2]
+        return self.table[idx]
+
+
+_LUTS = OrderedDict()
+_LUTS_LOCK = threading.Lock()
+
+
+def palette_lut(colors, bits=REMAP_LUT_BITS, mem_budget_mb=KMEANS_MEM_BUDGET_MB) -> PaletteLUT:
+    """
+    PaletteLUT for `colors`, memoized for the last few palettes (preview
+    redraws reuse it). `mem_budget_mb` only bounds the build's temporaries.
+    """
+    colors = np.ascontiguousarray(colors, dtype=np.uint8).reshape(-1, 3)
+    key = (colors.tobytes(), int(bits))
+    with _LUTS_LOCK:
+        lut = _LUTS.get(key)
+        if lut is not None:
+            _LUTS.move_to_end(key)
+            return lut
+    lut = PaletteLUT(colors, bits, mem_budget_mb)
+    with _LUTS_LOCK:
+        _LUTS[key] = lut
+        while len(_LUTS) > 8:
+            _LUTS.popitem(last=False)
+    return lut
+
+
+def _palette_colors(palette):
+    if isinstance(palette, Palette):
+        return palette.colors
+    return np.array([c for c, _n in palette], dtype=np.uint8).reshape(-1, 3)
+
+
+def posterize_image(im: Image.Image, palette, bits=REMAP_LUT_BITS, trace=None) -> Image.Image:
+    """
+    `im` remapped to the colors of `palette` (a Palette or [((r, g, b), n)]):
+    a 'P' image whose pixel values are the palette indices (the label map)
+    and whose palette holds the colors.
+    """
+    lut = palette_lut(_palette_colors(palette), bits)
+    im = as_rgb(im, trace)
+    w, h = im.size
+    with _stage(trace, 'remap', w * h) as st:
+        out = st.out(Image.fromarray(lut.labels(np.asarray(im)), 'P'))
+        out.putpalette(lut.colors.tobytes())
+    return out
+
+
+def _write_indexed_png(path, w, h, bands, colors, compress_level=6):
+    """Stream (rows x w) uint8 label bands, top to bottom, to an 8-bit indexed PNG."""
+    with open(path, 'wb') as f:
+        def chunk(tag, data):
+            f.write(struct.pack('>I', len(data)) + tag + data + struct.pack('>I', zlib.crc32(data, zlib.crc32(tag))))
+
+        f.write(b'\x89PNG\r\n\x1a\n')
+        chunk(b'IHDR', struct.pack('>IIBBBBB', w, h, 8, 3, 0, 0, 0))
+        chunk(b'PLTE', np.ascontiguousarray(colors, dtype=np.uint8).tobytes())
+        z = zlib.compressobj(compress_level)
+        for band in bands:
+            framed = np.zeros((len(band), w + 1), dtype=np.uint8)  # filter type 0 (None), then the row
+            framed[:, 1:] = band
+            data = z.compress(framed.tobytes())
+            if data:
+                chunk(b'IDAT', data)
+        chunk(b'IDAT', z.flush())
+        chunk(b'IEND', b'')
+
+
+def _write_indexed_tiff(path, w, h, bands, colors):
+    """
+    Stream (rows x w) uint8 label bands, top to bottom and all but the last
+    of equal height, to an 8-bit palette TIFF with one deflate strip each.
+    """
+    cmap = np.zeros((3, 256), dtype=np.int64)
+    cmap[:, :len(colors)] = np.asarray(colors, dtype=np.int64).T * 257
+    offsets, counts, rows = [], [], h
+    with open(path, 'wb') as f:
+        f.write(_tiff_header(ifd_offset=0))  # patched once the strips are written
+        for band in bands:
+            if not offsets:
+                rows = len(band)
+            data = zlib.compress(np.ascontiguousarray(band).tobytes(), 6)
+            offsets.append(f.tell())
+            counts.append(len(data))
+            f.write(data)
+        if f.tell() & 1:
+            f.write(b'\0')
+        ifd_offset = f.tell()
+        if ifd_offset + 4096 + 8 * len(offsets) >= 1 << 32:
+            raise ValueError(f"{path}: the label data is over the 4 GB classic TIFF limit; write a .png")
+        entries = {256: (4, [w]), 257: (4, [h]), 258: (3, [8]), 259: (3, [8]), 262: (3, [3]),
+                   273: (4, offsets), 277: (3, [1]), 278: (4, [rows]), 279: (4, counts), 284: (3, [1]),
+                   320: (3, cmap.ravel().tolist())}
+        f.write(_tiff_ifd(entries, ifd_offset))
+        f.seek(4)
+        f.write(struct.pack('<I', ifd_offset))
+
+
+def remap_file(path, palette, out=None, labels_out=None, tile_pixels=TILE_PIXELS, bits=REMAP_LUT_BITS,
+               mem_budget_mb=KMEANS_MEM_BUDGET_MB, trace=None):
+    """
+    Remap an image file to `palette` region by region (see
+    iter_image_regions), so for TIFF and uncompressed layouts input memory
+    follows `tile_pixels`. The uint8 label map is written to `labels_out`
+    (.npy), or to a temporary file when only `out` is wanted, with plain
+    file writes, so it never has to fit in memory.
+
+    `out` gets the posterized image, read back from that file about
+    `tile_pixels` at a time: a .png or .tif is streamed as an indexed image,
+    so output memory is bounded as well. Other formats (JPEG, BMP, GIF, ...)
+    are encoded from a whole image in memory, 'P' or RGB for JPEG; they raise
+    ValueError when that would exceed `mem_budget_mb`. Returns the
+    PaletteLUT used.
+    """
+    import tempfile
+    lut = palette_lut(_palette_colors(palette), bits, mem_budget_mb)
+    with _allow_large_images(), Image.open(path) as im:
+        w, h = im.size
+    ext = os.path.splitext(out)[1].lower() if out else ''
+    streamed = ext in ('.png', '.tif', '.tiff')
+    if out and not streamed:
+        need = w * h * (4 if ext in ('.jpg', '.jpeg') else 1)
+        if need > mem_budget_mb * 1024 * 1024:
+            raise ValueError(f"{out}: a {w}x{h} {ext[1:].upper()} needs ~{need / (1024 * 1024):.1f} MB in "
+                             f"memory, over mem_budget_mb={mem_budget_mb:g}; write a .png or .tif to stream it")
+    store = labels_out
+    if not store:
+        fd, store = tempfile.mkstemp(suffix='.npy', dir=os.path.dirname(os.path.abspath(out)))
+        os.close(fd)
+    try:
+        # open_memmap writes the .npy header and sizes the file; the rows go in with seek/write
+        header = np.lib.format.open_memmap(store, mode='w+', dtype=np.uint8, shape=(h, w))
+        base = header.offset
+        del header
+        with open(store, 'r+b') as f:
+            for (x0, y0), block in iter_image_regions(path, tile_pixels):
+                rh, rw = block.shape[:2]
+                with _stage(trace, 'remap', rh * rw):
+                    lab = lut.labels(block)
+                if rw == w:
+                    f.seek(base + y0 * w)
+                    f.write(lab.tobytes())
+                else:
+                    for r in range(rh):
+                        f.seek(base + (y0 + r) * w + x0)
+                        f.write(lab[r].tobytes())
+        if out:
+            rows = max(1, int(tile_pixels) // max(1, w))
+
+            def bands():
+                with open(store, 'rb') as f:
+                    f.seek(base)
+                    for y in range(0, h, rows):
+                        n = min(rows, h - y)
+                        yield np.frombuffer(f.read(n * w), dtype=np.uint8).reshape(n, w)
+
+            if streamed:
+                with _stage(trace, 'encode', w * h):
+                    if ext == '.png':
+                        _write_indexed_png(out, w, h, bands(), lut.colors)
+                    else:
+                        _write_indexed_tiff(out, w, h, bands(), lut.colors)
+            else:
+                img = Image.fromarray(np.concatenate(list(bands())), 'P')
+                img.putpalette(lut.colors.tobytes())
+                if ext in ('.jpg', '.jpeg'):
+                    img = img.convert('RGB')
+                with _allow_large_images():
+                    save_image(img, out, trace=trace)
+    finally:
+        if not labels_out:
+            os.remove(store)
+    return lut
+
+
+# ------------------------------
+# Export helpers (shared by GUI and batch mode)
+# ------------------------------
+
+IMAGE_EXTS = ('.png', '.jpg', '.jpeg', '.bmp', '.tif', '.tiff')
+
+
+def parse_aspect(s) -> float:
+    """Parse a swatch aspect like "4:3" or "1.5" into W/H."""
+    try:
+        if ":" in s:
+            a, b = s.split(":", 1)
+            a = float(a.strip()); b = float(b.strip())
+            return a / b if b != 0 else float(a)
+        return float(s)
+    except Exception:
+        return 10.0  # fallback
+
+
+def compute_export_size(base_w: int, base_h: int, mode='percent', scale_pct=100, long_edge=2048):
+    if mode == 'percent':
+        scale = max(1, int(scale_pct)) / 100.0
+    elif mode == 'longedge':
+        le = max(1, int(long_edge))
+        scale = le / max(base_w, base_h)
+    else:
+        scale = 1.0
+    nw = max(1, int(round(base_w * scale)))
+    nh = max(1, int(round(base_h * scale)))
+    return nw, nh
+
+
+def _scale_px(px, scale):
+    """Scale a line width, keeping non-zero widths at least 1px."""
+    return 0 if px <= 0 else max(1, int(round(px * scale)))
+
+
+def render_export(im: Image.Image, palette, N=16, base_size=None, bar_only=False,
+                  mode='percent', scale_pct=100, long_edge=2048, bar_h_ratio=0.09, bar_h_min=60,
+                  bar_h_max=200, separator=2, border_px=2, bar_bg=(30, 30, 30),
+                  sep_color=(220, 220, 220), border_color=(190, 190, 190),
+                  sort_by_luma=True, swatch_aspect=None, posterize=False, trace=None) -> Image.Image:
+    """
+    Render the composite (or bar only) directly at export resolution.
+
+    Geometry is laid out for `base_size` (the full-resolution size; defaults to
+    im.size) exactly as render_palette_bar would, then scaled: `im` is resampled
+    once to the target width and the bar is rasterized natively at the output
+    size, with separator/border widths scaled accordingly. At 100% the result
+    equals render_palette_bar's output. posterize=True remaps the image
+    after resizing, so the output holds exactly the palette colors.
+    """
+    w, h = base_size or im.size
+    bar_h = compute_bar_height(w, h, N=N, bar_h_ratio=bar_h_ratio, bar_h_min=bar_h_min, bar_h_max=bar_h_max,
+                               separator=separator, border_px=border_px, swatch_aspect=swatch_aspect)
+    ew, eh = compute_export_size(w, bar_h if bar_only else h + bar_h, mode, scale_pct, long_edge)
+    scale = ew / float(w)
+    img_h = 0 if bar_only else max(1, int(round(h * scale)))
+    with _stage(trace, 'sort'):
+        colors = display_colors(palette, N, sort_by_luma)
+    bar_h = max(1, eh - img_h)
+    with _stage(trace, 'draw', ew * bar_h) as st:
+        bar = st.out(draw_palette_bar(colors, ew, bar_h, N=N, separator=_scale_px(separator, scale),
+                                      border_px=_scale_px(border_px, scale), bar_bg=bar_bg, sep_color=sep_color,
+                                      border_color=border_color, swatch_aspect=swatch_aspect))
+    if bar_only:
+        return Image.fromarray(bar)
+    im = as_rgb(im, trace)
+    if im.size != (ew, img_h):
+        # reducing_gap lets Pillow reduce() by an integer factor before LANCZOS
+        with _stage(trace, 'resize', ew * img_h) as st:
+            im = st.out(im.resize((ew, img_h), Image.LANCZOS, reducing_gap=3.0))
+    if posterize:
+        im = posterize_image(im, palette, trace=trace)
+    with _stage(trace, 'composite', ew * (img_h + bar_h)) as st:
+        out = st.out(Image.new("RGB", (ew, img_h + bar_h)))
+        out.paste(im, (0, 0))
+        out.paste(Image.fromarray(bar), (0, img_h))
+    return out
+
+
+QUANT_KEYS = ('method', 'mem_budget_mb', 'seed', 'hist_bits', 'workers', 'hierarchical')
+
+
+def export_image(source: "ImageSource", bar_only=False, mode='percent', scale_pct=100, long_edge=2048,
+                 cache=PALETTE_CACHE, tile_pixels=None, trace=None, **palette_kw) -> Image.Image:
+    """
+    Resize-first export of an ImageSource. The export scale is worked out from
+    the header size, the file is decoded at the smallest scale that still
+    covers the output (JPEG draft), the palette is extracted from that decode
+    and the result is rendered by render_export at the target size.
+    `palette_kw` takes build_palette_bar's parameters.
+
+    For bar-only exports `tile_pixels` switches to extract_palette_tiled, so
+    the image is never decoded as a whole. The cache is consulted before
+    decoding, so a bar-only export with a cached palette (e.g. from a
+    DiskPaletteCache) doesn't decode at all. `trace` (a PipelineTrace)
+    records every stage from decode to composite.
+    """
+    N = palette_kw.pop('N', 16)
+    return export_variants(source, [N], bar_only=bar_only, mode=mode, scale_pct=scale_pct, long_edge=long_edge,
+                           cache=cache, tile_pixels=tile_pixels, trace=trace, **palette_kw)[0][1]
+
+
+def export_variants(source: "ImageSource", Ns, bar_only=False, mode='percent', scale_pct=100, long_edge=2048,
+                    cache=PALETTE_CACHE, tile_pixels=None, trace=None, **palette_kw):
+    """
+    export_image for several palette sizes at once: returns [(N, image), ...]
+    in the order of `Ns`. The file is decoded once (at the largest target)
+    and, with more than one N, quantized once into a PaletteTree that every
+    N is cut from (hierarchical mode; a private in-memory cache holds the
+    tree when `cache` is None).
+    """
+    Ns = [int(n) for n in Ns]
+    quant_kw = {k: palette_kw.pop(k) for k in QUANT_KEYS if k in palette_kw}
+    palette_kw.pop('composite', None)
+    palette_kw.pop('N', None)
+    if len(Ns) > 1:
+        quant_kw['hierarchical'] = True
+        if cache is None:
+            cache = PaletteCache()
+    w, h = source.size
+    geom = {k: palette_kw[k] for k in ('bar_h_ratio', 'bar_h_min', 'bar_h_max', 'separator', 'border_px',
+                                        'swatch_aspect') if k in palette_kw}
+
+    def export_width(n):
+        bar_h = compute_bar_height(w, h, N=n, **geom)
+        return compute_export_size(w, bar_h if bar_only else h + bar_h, mode, scale_pct, long_edge)[0]
+
+    scale = max(export_width(n) for n in Ns) / float(w)
+    im, pals = _export_inputs(source, Ns, scale, bar_only, cache, tile_pixels, trace, quant_kw)
+    out_kw = dict(base_size=(w, h), bar_only=bar_only, mode=mode, scale_pct=scale_pct, long_edge=long_edge,
+                  trace=trace, **palette_kw)
+    return [(n, render_export(im, pal, N=n, **out_kw)) for n, pal in zip(Ns, pals)]
+
+
+def _export_inputs(source, Ns, scale, bar_only, cache, tile_pixels, trace, quant_kw):
+    """
+    Decode `source` for an export at `scale` (skipped for bar-only exports
+    whose palettes are all cached) and find one palette per N: returns
+    (image or None, [palette, ...]).
+    """
+    w, h = source.size
+    if bar_only and tile_pixels:
+        fingerprint = source.fingerprint() if cache is not None else None
+        return None, [extract_palette_tiled(source.path, n, cache=cache, tile_pixels=tile_pixels, trace=trace,
+                                            fingerprint=fingerprint, **quant_kw) for n in Ns]
+    # the decode for a given target size is deterministic, so the target names the level
+    target = (int(np.ceil(w * scale)), int(np.ceil(h * scale)))
+    fingerprint = source.fingerprint(f"{target[0]}x{target[1]}") if cache is not None else None
+    with _stage(trace, 'cache_lookup'):
+        pals = [lookup_palette(cache, fingerprint, n, **quant_kw) for n in Ns]
+    im = None
+    if not bar_only or any(pal is None for pal in pals):
+        im = source.decode(target, trace)
+    pals = [pal if pal is not None else extract_palette(im, n, cache=cache, fingerprint=fingerprint, trace=trace,
+                                                        **quant_kw)
+            for n, pal in zip(Ns, pals)]
+    return im, pals
+
+
+def save_image(img: Image.Image, path, jpeg_quality=100, png_compress=6, trace=None):
+    """Save `img` choosing encoder options from the file extension."""
+    ext = os.path.splitext(path)[1].lower()
+    with _stage(trace, 'encode', img.size[0] * img.size[1]):
+        if ext in (".jpg", ".jpeg"):
+            img.save(path, quality=int(jpeg_quality))
+        elif ext == ".png":
+            cl = max(0, min(9, int(png_compress)))
+            img.save(path, compress_level=cl)
+        else:
+            img.save(path)
+
+
+class ExportTarget(NamedTuple):
+    """
+    One output of a multi-target export: format ('JPEG' or 'PNG'), size
+    (as compute_export_size's mode/scale_pct/long_edge) and encoder level
+    (JPEG quality or PNG compress level; None = 100 / 6).
+    """
+    fmt: str = 'JPEG'
+    mode: str = 'percent'
+    scale_pct: int = 100
+    long_edge: int = 2048
+    level: int = None
+
+    @property
+    def ext(self):
+        return ".png" if self.fmt == 'PNG' else ".jpg"
+
+    @property
+    def tag(self):
+        return f"{self.long_edge}px" if self.mode == 'longedge' else f"{self.scale_pct}pct"
+
+    def output_path(self, path):
+        """`path` with this target's size tag and extension, e.g. x_with_palette_2048px.png."""
+        return f"{os.path.splitext(path)[0]}_{self.tag}{self.ext}"
+
+    def save_kw(self):
+        if self.level is None:
+            return {}
+        return {'png_compress': self.level} if self.fmt == 'PNG' else {'jpeg_quality': self.level}
+
+
+def parse_export_target(spec) -> ExportTarget:
+    """
+    Parse "FMT[:SIZE[:LEVEL]]": FMT is jpeg/jpg/png, SIZE is a percentage
+    ("50%") or a long edge in pixels ("2048" or "2048px"), LEVEL is the JPEG
+    quality or PNG compress level. E.g. "jpeg:100%:95", "png:1024px:9".
+    """
+    parts = [p.strip() for p in spec.strip().split(':')]
+    fmt = {'jpeg': 'JPEG', 'jpg': 'JPEG', 'png': 'PNG'}.get(parts[0].lower())
+    if fmt is None or len(parts) > 3:
+        raise ValueError(f"expected FMT[:SIZE[:LEVEL]] with FMT jpeg or png, got {spec!r}")
+    target = ExportTarget(fmt)
+    size = parts[1].lower() if len(parts) > 1 else ''
+    if size.endswith('%'):
+        target = target._replace(mode='percent', scale_pct=max(1, int(size[:-1])))
+    elif size:
+        target = target._replace(mode='longedge', long_edge=max(1, int(size[:-2] if size.endswith('px') else size)))
+    if len(parts) > 2 and parts[2]:
+        level = int(parts[2])
+        target = target._replace(level=max(0, min(9, level)) if fmt == 'PNG' else max(0, min(100, level)))
+    return target
+
+
+def export_targets(source: "ImageSource", outputs, bar_only=False, cache=PALETTE_CACHE, tile_pixels=None,
+                   progress=None, trace=None, **palette_kw):
+    """
+    Multi-target export: write one render of `source` to every
+    (path, ExportTarget) in `outputs`. The file is decoded and quantized
+    once, at the largest target; each distinct output size is then rendered
+    once by render_export and every target of that size is encoded from it.
+    Rendering (resize + composite) and encoding run on a thread pool (of
+    the quantization's `workers` threads), as Pillow releases the GIL in
+    both. `progress(done, total, path)` is called from the calling thread
+    after each file is written. Returns the paths in the order of `outputs`.
+    """
+    from concurrent.futures import wait, FIRST_COMPLETED
+
+    outputs = [(path, t) for path, t in outputs]
+    N = palette_kw.pop('N', 16)
+    quant_kw = {k: palette_kw.pop(k) for k in QUANT_KEYS if k in palette_kw}
+    palette_kw.pop('composite', None)
+    w, h = source.size
+    bar_h = compute_bar_height(w, h, N=N, **{k: palette_kw[k] for k in (
+        'bar_h_ratio', 'bar_h_min', 'bar_h_max', 'separator', 'border_px', 'swatch_aspect') if k in palette_kw})
+    groups = OrderedDict()  # (export w, h) -> [(path, target)]; equal sizes render identically
+    for path, t in outputs:
+        size = compute_export_size(w, bar_h if bar_only else h + bar_h, t.mode, t.scale_pct, t.long_edge)
+        groups.setdefault(size, []).append((path, t))
+    scale = max(ew for ew, _eh in groups) / float(w)
+    im, (pal,) = _export_inputs(source, [N], scale, bar_only, cache, tile_pixels, trace, quant_kw)
+    if im is not None and not bar_only:
+        im = as_rgb(im, trace)  # once, not in every render thread
+
+    def render(t):
+        return render_export(im, pal, N=N, base_size=(w, h), bar_only=bar_only, mode=t.mode,
+                             scale_pct=t.scale_pct, long_edge=t.long_edge, trace=trace, **palette_kw)
+
+    def encode(img, path, t):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        save_image(img, path, trace=trace, **t.save_kw())
+        return path
+
+    pool = _thread_pool(max(1, int(quant_kw.get('workers') or KMEANS_WORKERS)))
+    pending = {pool.submit(render, targets[0][1]): targets for targets in groups.values()}
+    done = 0
+    try:
+        while pending:
+            finished, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for fut in finished:
+                targets = pending.pop(fut)
+                if targets is None:
+                    done += 1
+                    if progress is not None:
+                        progress(done, len(outputs), fut.result())
+                    continue
+                img = fut.result()
+                for path, t in targets:
+                    pending[pool.submit(encode, img, path, t)] = None
+    finally:
+        for fut in pending:
+            fut.cancel()
+    return [path for path, _t in outputs]
+
 
 # ------------------------------
-# Core image processing routine
+# Headless batch mode
 # ------------------------------
 
-def build_palette_bar(im: Image.Image, N=16, bar_h_ratio=0.09, bar_h_min=60, bar_h_max=200,
-                      separator=2, border_px=2, bar_bg=(30, 30, 30),
-                      sep_color=(220, 220, 220), border_color=(190, 190, 190),
-                      sort_by_luma=True, swatch_aspect=None, method='MedianCut'):
+def iter_image_files(root):
+    """Yield image paths under `root` (recursively, sorted for stable order)."""
+    for dirpath, dirnames, filenames in os.walk(root):
+        dirnames.sort()
+        for name in sorted(filenames):
+            if name.lower().endswith(IMAGE_EXTS):
+                yield os.path.join(dirpath, name)
+
+
+def batch_output_path(src_path, in_root, out_root, fmt='JPEG', bar_only=False):
+    rel_dir = os.path.relpath(os.path.dirname(src_path), in_root)
+    base = os.path.splitext(os.path.basename(src_path))[0]
+    ext = ".png" if fmt == "PNG" else ".jpg"
+    suffix = "_palette_bar" if bar_only else "_with_palette"
+    return os.path.normpath(os.path.join(out_root, rel_dir, f"{base}{suffix}{ext}"))
+
+
+def variant_output_path(path, N):
+    """`path` with an _N<N> suffix before the extension (one file per palette size)."""
+    root, ext = os.path.splitext(path)
+    return f"{root}_N{N}{ext}"
+
+
+def _batch_process_one(src_path, dst_path, palette_kw, export_kw, bar_only, traced=False):
+    """Process pool worker: returns (src_path, in_bytes, error_or_None, stage_records_or_None)."""
+    trace = PipelineTrace() if traced else None
+    try:
+        in_bytes = os.path.getsize(src_path)
+        tile_pixels = export_kw.get('tile_pixels')
+        content_hash = export_kw.get('content_hash', False)
+        if tile_pixels:
+            with _allow_large_images():  # only the header is read; pixels stream tile by tile
+                source = ImageSource(src_path, content_hash=content_hash)
+        else:
+            source = ImageSource(src_path, content_hash=content_hash)
+        # every file is distinct, so only a persistent cache (re-runs) can hit
+        cache = None
+        if export_kw.get('cache_path'):
+            cache = open_disk_cache(export_kw['cache_path'], max_bytes=export_kw['cache_max_bytes'],
+                                    max_age_days=export_kw['cache_max_age_days'])
+        targets = export_kw.get('targets')
+        if targets:
+            export_targets(source, [(t.output_path(dst_path), t) for t in targets], bar_only=bar_only,
+                           cache=cache, tile_pixels=tile_pixels, trace=trace, **palette_kw)
+            return src_path, in_bytes, None, trace and trace.records
+        variants = export_kw.get('variants')
+        images = export_variants(source, variants or [palette_kw.get('N', 16)], bar_only=bar_only,
+                                 mode=export_kw['mode'], scale_pct=export_kw['scale_pct'],
+                                 long_edge=export_kw['long_edge'], cache=cache, tile_pixels=tile_pixels,
+                                 trace=trace, **palette_kw)
+        os.makedirs(os.path.dirname(dst_path) or ".", exist_ok=True)
+        for n, img in images:
+            path = variant_output_path(dst_path, n) if variants else dst_path
+            save_image(img, path, export_kw['jpeg_quality'], export_kw['png_compress'], trace=trace)
+        return src_path, in_bytes, None, trace and trace.records
+    except Exception as e:
+        return src_path, 0, f"{type(e).__name__}: {e}", trace and trace.records
+
+
+def run_batch(in_root, out_root, palette_kw, export_kw, fmt='JPEG', bar_only=False,
+              workers=None, log=print, trace=None):
     """
-    Given a PIL image `im`, return (composite_image, palette_bar_image) where
-    composite = original stacked over palette bar.
+    Render palettes for every image under `in_root` into `out_root` using a
+    process pool. Results are written by the workers as they finish; the
+    number of in-flight jobs is bounded so huge trees don't queue up at once.
+    Returns a summary dict. With a PipelineTrace as `trace`, the workers'
+    stage records are collected into it (tagged with their file) and the
+    summary gains per-stage totals.
     """
-    im = im.convert("RGB")
-    w, h = im.size
-    # Compute bar height from single-swatch aspect if provided
-    if swatch_aspect:
-        try:
-            aspect = float(swatch_aspect)
-        except Exception:
-            aspect = None
-        if aspect and aspect > 0:
-            inner_w = max(1, w - 2 * border_px)
-            total_separators = max(0, (N - 1) * separator)
-            swatch_w = max(1, (inner_w - total_separators) // N)
-            swatch_h = max(1, int(round(swatch_w / aspect)))
-            bar_h = swatch_h + 2 * border_px
+    from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+
+    workers = max(1, int(workers or os.cpu_count() or 1))
+    max_inflight = workers * 4
+    t0 = time.perf_counter()
+    done = failed = 0
+    total_bytes = 0
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        pending = set()
+
+        def drain(return_when):
+            nonlocal done, failed, total_bytes, pending
+            finished, pending = wait(pending, return_when=return_when)
+            for fut in finished:
+                src, nbytes, err, records = fut.result()
+                if records:
+                    for rec in records:
+                        rec['file'] = src
+                    trace.extend(records)
+                if err is None:
+                    done += 1
+                    total_bytes += nbytes
+                    log(f"[ok] {src}")
+                else:
+                    failed += 1
+                    log(f"[fail] {src}: {err}")
+
+        for src in iter_image_files(in_root):
+            dst = batch_output_path(src, in_root, out_root, fmt, bar_only)
+            pending.add(pool.submit(_batch_process_one, src, dst, palette_kw, export_kw, bar_only,
+                                    trace is not None))
+            if len(pending) >= max_inflight:
+                drain(FIRST_COMPLETED)
+        while pending:
+            drain(FIRST_COMPLETED)
+    elapsed = max(time.perf_counter() - t0, 1e-9)
+    summary = {
+        'images': done,
+        'failed': failed,
+        'seconds': elapsed,
+        'images_per_s': done / elapsed,
+        'mb_per_s': total_bytes / (1024 * 1024) / elapsed,
+    }
+    log(f"{done} images ({failed} failed) in {elapsed:.2f}s | "
+        f"{summary['images_per_s']:.2f} images/s | {summary['mb_per_s']:.2f} MB/s")
+    if trace is not None:
+        summary['stages'] = trace.to_dict()['totals']
+        log(f"stages (summed over workers): {trace.summary(limit=10)}")
+    return summary
+
+
+# ------------------------------
+# Palette analysis and swatch files
+# ------------------------------
+
+def analyze_image(source: "ImageSource", N=16, max_side=None, tile_pixels=None, cache=PALETTE_CACHE,
+                  trace=None, **quant_kw) -> Palette:
+    """
+    Analysis-only path: the Palette of `source` without rendering anything.
+    Decodes at full resolution, at most `max_side` on the long side (JPEG
+    draft, much cheaper), or tile by tile with `tile_pixels`. The cache is
+    consulted before decoding, so a cached file isn't decoded at all.
+    """
+    if tile_pixels:
+        fingerprint = source.fingerprint() if cache is not None else None
+        return extract_palette_tiled(source.path, N, cache=cache, tile_pixels=tile_pixels, trace=trace,
+                                     fingerprint=fingerprint, **quant_kw)
+    level = None
+    if max_side and max(source.size) > max_side:
+        level = f"max{int(max_side)}"
+    fingerprint = source.fingerprint(level) if cache is not None else None
+    with _stage(trace, 'cache_lookup'):
+        pal = lookup_palette(cache, fingerprint, N, **quant_kw)
+    if pal is not None:
+        return pal
+    im = source.preview(int(max_side), trace) if level else source.full(trace)
+    return extract_palette(im, N, cache=cache, fingerprint=fingerprint, trace=trace, **quant_kw)
+
+
+def palette_to_gpl(pal: Palette, name="palette") -> str:
+    """GIMP/Inkscape/Krita palette (.gpl) text; each color is named by its hex code and share."""
+    lines = ["GIMP Palette", f"Name: {name}", f"Columns: {min(8, max(1, len(pal.colors)))}", "#"]
+    for (r, g, b), hx, pct in zip(pal.colors.tolist(), pal.hex(), pal.percentages.tolist()):
+        lines.append(f"{r:3d} {g:3d} {b:3d}\t{hx} {pct:.2f}%")
+    return "\n".join(lines) + "\n"
+
+
+def palette_to_ase(pal: Palette, name="palette") -> bytes:
+    """Adobe Swatch Exchange (.ase) bytes: one group named `name` of RGB process colors."""
+    def utf16(text):
+        data = (text + "\0").encode('utf-16-be')
+        return struct.pack(">H", len(data) // 2) + data
+
+    blocks = [(0xC001, utf16(name))]
+    for c, hx in zip(pal.colors.tolist(), pal.hex()):
+        blocks.append((0x0001, utf16(hx) + b"RGB " + struct.pack(">3fH", *(v / 255.0 for v in c), 2)))
+    blocks.append((0xC002, b""))
+    out = [b"ASEF", struct.pack(">HHI", 1, 0, len(blocks))]
+    for kind, body in blocks:
+        out.append(struct.pack(">HI", kind, len(body)) + body)
+    return b"".join(out)
+
+
+def palette_to_json(pal: Palette, name="palette") -> str:
+    return json.dumps({'name': name, 'colors': [
+        {'hex': hx, 'rgb': c, 'count': n, 'percent': round(pct, 4)}
+        for c, hx, n, pct in zip(pal.colors.tolist(), pal.hex(), pal.counts.tolist(), pal.percentages.tolist())
+    ]}, indent=1)
+
+
+SWATCH_FORMATS = {'gpl': palette_to_gpl, 'ase': palette_to_ase, 'json': palette_to_json}
+
+
+def save_swatches(pal: Palette, path, name=None):
+    """Write `pal` as a swatch file, choosing the format from the extension (.gpl, .ase, .json)."""
+    fmt = os.path.splitext(path)[1].lower().lstrip('.')
+    if fmt not in SWATCH_FORMATS:
+        raise ValueError(f"unknown swatch format {fmt!r} (expected one of {', '.join(SWATCH_FORMATS)})")
+    data = SWATCH_FORMATS[fmt](pal, name or os.path.splitext(os.path.basename(path))[0])
+    with open(path, 'wb' if isinstance(data, bytes) else 'w') as f:
+        f.write(data)
+
+
+def iter_inputs(inputs):
+    """(path, root) for every image file named in `inputs` or found under the directories among them."""
+    for item in inputs:
+        if os.path.isdir(item):
+            for path in iter_image_files(item):
+                yield path, item
         else:
-            bar_h = int(h * bar_h_ratio)
-    else:
-        bar_h = int(h * bar_h_ratio)
-    # If swatch_aspect is specified, honor it fully (no upper cap). Capping to bar_h_max
-    # can flatten swatches on wide images and break requested ratios like 1:1.
-    if swatch_aspect:
-        bar_h = max(2 * border_px + 1, int(bar_h))
-    else:
-        bar_h = min(max(int(bar_h), bar_h_min), bar_h_max)
+            yield item, os.path.dirname(item) or "."
 
-    # Quantize / cluster to N colors according to method
-    colors = []
-    method = (method or 'MedianCut')
-    if method == 'KMeans':
-        # --- Simple numpy K-Means on RGB ---
-        arr = np.array(im, dtype=np.uint8)
-        flat = arr.reshape(-1, 3)
-        # random sample to speed up
-        max_sample = 50000
-        if flat.shape[0] > max_sample:
-            idx = np.random.choice(flat.shape[0], max_sample, replace=False)
-            sample = flat[idx]
+
+def _analyze_one(src_path, N, quant_kw, opts):
+    """Process pool worker: returns (src_path, (w, h), Palette or None, error or None)."""
+    try:
+        tile_pixels = opts.get('tile_pixels')
+        if tile_pixels:
+            with _allow_large_images():
+                source = ImageSource(src_path, content_hash=opts.get('content_hash', False))
         else:
-            sample = flat
-        # init centers with random choices
-        rng = np.random.default_rng(42)
-        init_idx = rng.choice(sample.shape[0], min(N, sample.shape[0]), replace=False)
-        centers = sample[init_idx].astype(np.float64)
-        for _ in range(10):
-            # assign
-            d2 = ((sample[:, None, :] - centers[None, :, :]) ** 2).sum(axis=2)
-            labels = d2.argmin(axis=1)
-            # update
-            new_centers = []
-            for k in range(centers.shape[0]):
-                pts = sample[labels == k]
-                if len(pts) == 0:
-                    # re-seed from data
-                    new_centers.append(sample[rng.integers(0, sample.shape[0])])
-                else:
-                    new_centers.append(pts.mean(axis=0))
-            centers = np.vstack(new_centers)
-        # final assignment on full image for counts
-        d2_full = ((flat[:, None, :] - centers[None, :, :]) ** 2).sum(axis=2)
-        labels_full = d2_full.argmin(axis=1)
-        for k in range(centers.shape[0]):
-            cnt = int((labels_full == k).sum())
-            r, g, b = [int(max(0, min(255, round(v)))) for v in centers[k]]
-            colors.append(((r, g, b), cnt))
-        # keep top-N by count
-        colors.sort(key=lambda x: x[1], reverse=True)
-        colors = colors[:N]
-    else:
-        # Pillow quantizers
-        try:
-            from PIL.Image import Quantize
-            if method == 'FastOctree':
-                q = im.quantize(colors=N, method=Quantize.FASTOCTREE)
-            else:
-                q = im.quantize(colors=N, method=Quantize.MEDIANCUT)
-        except Exception:
-            # fallback
-            q = im.quantize(colors=N, method=Image.MEDIANCUT)
-        palette = q.getpalette()[:256 * 3]
-        idx_arr = np.array(q)
-        unique, counts = np.unique(idx_arr, return_counts=True)
-        count_map = dict(zip(unique.tolist(), counts.tolist()))
-        for idx, cnt in count_map.items():
-            r = palette[3 * idx + 0]
-            g = palette[3 * idx + 1]
-            b = palette[3 * idx + 2]
-            colors.append(((r, g, b), int(cnt)))
+            source = ImageSource(src_path, content_hash=opts.get('content_hash', False))
+        cache = None
+        if opts.get('cache_path'):
+            cache = open_disk_cache(opts['cache_path'], max_bytes=opts['cache_max_bytes'],
+                                    max_age_days=opts['cache_max_age_days'])
+        pal = analyze_image(source, N, max_side=opts.get('max_side'), tile_pixels=tile_pixels, cache=cache,
+                            **quant_kw)
+        return src_path, source.size, pal, None
+    except Exception as e:
+        return src_path, None, None, f"{type(e).__name__}: {e}"
 
-    # Pad to N if needed using most frequent colors
-    if 0 < len(colors) < N:
-        colors_sorted_by_freq = sorted(colors, key=lambda x: x[1], reverse=True)
-        while len(colors) < N:
-            colors.append(colors_sorted_by_freq[len(colors) % len(colors_sorted_by_freq)])
 
-    # Sort by luminance for a clean gradient-like arrangement
-    if sort_by_luma:
-        def luminance(rgb):
-            r, g, b = rgb
-            return 0.2126 * r + 0.7152 * g + 0.0722 * b
-        colors = sorted(colors[:N], key=lambda x: luminance(x[0]))
-    else:
-        colors = colors[:N]
+def iter_analyze(paths, N=16, processes=None, opts=None, **quant_kw):
+    """
+    Yield (path, (w, h), Palette or None, error or None) for every path as it
+    completes, analysing on a pool of `processes` (1 = in this process).
+    `quant_kw` takes extract_palette's parameters. In-flight jobs are bounded like run_batch's. `opts` takes
+    max_side, tile_pixels, content_hash and the cache_* settings.
+    """
+    from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
 
-    # Draw palette bar
-    bar = Image.new("RGB", (w, bar_h), bar_bg)
-    draw = ImageDraw.Draw(bar)
+    opts = opts or {}
+    processes = max(1, int(processes or os.cpu_count() or 1))
+    if processes == 1:
+        for path in paths:
+            yield _analyze_one(path, N, quant_kw, opts)
+        return
+    with ProcessPoolExecutor(max_workers=processes) as pool:
+        pending = set()
+        for path in paths:
+            pending.add(pool.submit(_analyze_one, path, N, quant_kw, opts))
+            if len(pending) >= processes * 4:
+                finished, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for fut in finished:
+                    yield fut.result()
+        while pending:
+            finished, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for fut in finished:
+                yield fut.result()
 
-    # Outer border
-    draw.rectangle([0, 0, w - 1, bar_h - 1], outline=border_color, width=border_px)
 
-    # Inner region
-    inner_left = border_px
-    inner_top = border_px
-    inner_right = w - border_px
-    inner_bottom = bar_h - border_px
-    inner_w = inner_right - inner_left
-    inner_h = inner_bottom - inner_top
+ANALYZE_CSV_FIELDS = ('file', 'width', 'height', 'rank', 'r', 'g', 'b', 'hex', 'count', 'percent')
 
-    # Recompute swatch_h from swatch_aspect so the inner height matches exactly
-    if swatch_aspect:
-        try:
-            aspect = float(swatch_aspect)
-        except Exception:
-            aspect = None
-    else:
-        aspect = None
-    total_separators = (N - 1) * separator
-    swatch_w = max(1, (inner_w - total_separators) // N)
-    if aspect and aspect > 0:
-        swatch_h = max(1, int(round(swatch_w / aspect)))
-        inner_bottom = inner_top + swatch_h
-        if inner_bottom > bar_h - border_px:
-            inner_bottom = bar_h - border_px
-    x = inner_left
-    for i, (rgb, _cnt) in enumerate(colors):
-        if i == N - 1:
-            sw_right = inner_right
+
+def run_analyze(inputs, out=None, fmt='ndjson', N=16, processes=None, opts=None, swatch_dir=None,
+                swatch_formats=(), log=None, **quant_kw):
+    """
+    Analyse every image in `inputs` (files and directories) and stream one
+    NDJSON line (or one CSV row per color) to `out` (default stdout) as each
+    image completes. With `swatch_dir`, each palette is also saved there as
+    <name>.<fmt> for every format in `swatch_formats`, mirroring the input
+    tree. Returns a summary dict like run_batch's.
+    """
+    import csv
+    out = out or sys.stdout
+    log = log or (lambda msg: print(msg, file=sys.stderr))
+    roots = dict(iter_inputs(inputs))
+    writer = None
+    if fmt == 'csv':
+        writer = csv.writer(out)
+        writer.writerow(ANALYZE_CSV_FIELDS)
+    t0 = time.perf_counter()
+    done = failed = 0
+    for path, size, pal, err in iter_analyze(list(roots), N=N, processes=processes, opts=opts, **quant_kw):
+        if err is not None:
+            failed += 1
+            log(f"[fail] {path}: {err}")
+            if writer is None:
+                out.write(json.dumps({'file': path, 'error': err}) + "\n")
+            continue
+        done += 1
+        if writer is None:
+            out.write(json.dumps(dict(file=path, width=size[0], height=size[1], **pal.to_record())) + "\n")
         else:
-            sw_right = x + swatch_w
-        draw.rectangle([x, inner_top, sw_right, inner_bottom], fill=tuple(rgb))
-        if i != N - 1 and separator > 0:
-            draw.rectangle([sw_right, inner_top, sw_right + separator - 1, inner_bottom], fill=sep_color)
-        x = sw_right + separator
+            for rank, (c, hx, n, pct) in enumerate(zip(pal.colors.tolist(), pal.hex(), pal.counts.tolist(),
+                                                       pal.percentages.tolist())):
+                writer.writerow((path, size[0], size[1], rank, *c, hx, n, f"{pct:.4f}"))
+        out.flush()
+        if swatch_dir:
+            rel = os.path.relpath(os.path.splitext(path)[0], roots[path])
+            dst = os.path.normpath(os.path.join(swatch_dir, rel))
+            os.makedirs(os.path.dirname(dst) or ".", exist_ok=True)
+            for sf in swatch_formats:
+                save_swatches(pal, f"{dst}.{sf}", name=os.path.basename(path))
+    elapsed = max(time.perf_counter() - t0, 1e-9)
+    log(f"{done} images ({failed} failed) in {elapsed:.2f}s | {done / elapsed:.2f} images/s")
+    return {'images': done, 'failed': failed, 'seconds': elapsed, 'images_per_s': done / elapsed}
 
-    # Compose final image (original on top, bar at bottom)
-    out = Image.new("RGB", (w, h + bar_h), (0, 0, 0))
-    out.paste(im, (0, 0))
-    out.paste(bar, (0, h))
 
-    return out, bar
+# ------------------------------
+# Animations and frame sequences
+# ------------------------------
+
+def iter_frames(path):
+    """
+    Lazily yield (name, RGB image) for every frame of an animated file
+    (GIF, APNG, multi-page TIFF, ...) or every image file in a directory
+    (sorted by path). Only one frame is decoded at a time.
+    """
+    if os.path.isdir(path):
+        for f in iter_image_files(path):
+            with Image.open(f) as im:
+                im.load()
+                yield os.path.relpath(f, path), as_rgb(im)
+        return
+    from PIL import ImageSequence
+    with Image.open(path) as im:
+        for i, frame in enumerate(ImageSequence.Iterator(im)):
+            yield str(i), frame.convert("RGB")
+
+
+def stream_palettes(frames, N=16, method='KMeans', mem_budget_mb=KMEANS_MEM_BUDGET_MB, seed=42,
+                    hist_bits=HIST_BITS, warm_start=True, aggregate=None, workers=None):
+    """
+    Generator of (name, Palette) for each (name, image) in `frames`.
+
+    KMeans runs are warm-started from the previous frame's centers, which is
+    usually close already for consecutive frames. If `aggregate` is a
+    ColorHistogram, each frame's histogram is merged into it, so the palette of
+    the whole sequence can be taken at the end with constant memory.
+    """
+    prev = None
+    for name, im in frames:
+        acc = ColorHistogram(hist_bits)
+        for block in iter_rgb_strips(im):
+            acc.add(block)
+        if aggregate is not None:
+            aggregate.merge(acc)
+        hist_colors, hist_counts = acc.result()
+        init = prev.colors if (warm_start and prev is not None) else None
+        pal = palette_from_histogram(hist_colors, hist_counts, N, method, mem_budget_mb=mem_budget_mb,
+                                     seed=seed, init_centers=init if method == 'KMeans' else None,
+                                     workers=workers)
+        prev = pal
+        yield name, pal
+
+
+def render_palette_timeline(palettes, N=16, width=1024, row_h=16, separator=0, border_px=0,
+                            bar_bg=(30, 30, 30), sep_color=(220, 220, 220), border_color=(190, 190, 190),
+                            sort_by_luma=True) -> Image.Image:
+    """Stack one palette bar per frame (top to bottom) into a "palette timeline" image."""
+    palettes = list(palettes)
+    arr = np.empty((max(1, len(palettes)) * row_h, width, 3), dtype=np.uint8)
+    arr[:] = bar_bg
+    for i, pal in enumerate(palettes):
+        arr[i * row_h:(i + 1) * row_h] = draw_palette_bar(
+            display_colors(pal, N, sort_by_luma), width, row_h, N=N, separator=separator,
+            border_px=border_px, bar_bg=bar_bg, sep_color=sep_color, border_color=border_color)
+    return Image.fromarray(arr)
+
+
+def run_frames(path, out=None, N=16, method='KMeans', mem_budget_mb=KMEANS_MEM_BUDGET_MB, seed=42,
+               hist_bits=HIST_BITS, warm_start=True, timeline=None, timeline_width=1024, row_h=16,
+               workers=None):
+    """
+    Write one JSON line per frame palette to `out` (default stdout), then one
+    line with the aggregated palette; optionally save a palette timeline.
+    """
+    out = out or sys.stdout
+    aggregate = ColorHistogram(hist_bits)
+    kept = [] if timeline else None
+    for name, pal in stream_palettes(iter_frames(path), N, method, mem_budget_mb=mem_budget_mb, seed=seed,
+                                     hist_bits=hist_bits, warm_start=warm_start, aggregate=aggregate,
+                                     workers=workers):
+        out.write(json.dumps(dict(frame=name, **pal.to_dict())) + "\n")
+        out.flush()
+        if kept is not None:
+            kept.append(pal)
+    hist_colors, hist_counts = aggregate.result()
+    agg = palette_from_histogram(hist_colors, hist_counts, N, method, mem_budget_mb=mem_budget_mb, seed=seed,
+                                 workers=workers)
+    out.write(json.dumps(dict(frame=None, aggregate=True, **agg.to_dict())) + "\n")
+    if timeline:
+        render_palette_timeline(kept, N=N, width=timeline_width, row_h=row_h).save(timeline)
+    return agg
 
 
 # ------------------------------
-# GUI
+# Local palette service
 # ------------------------------
 
-class App(tk.Tk):
-    def __init__(self):
-        super().__init__()
-        self.title("调色盘横条生成器 | Palette Bar Generator")
-        self._refresh_job = None
-        self.PREVIEW_MAXSIDE = 1400  # Max long side for preview computation
-
-        # State
-        self.src_image = None          # Original PIL image
-        self.preview_image = None      # Composite PIL image for display
-        self.tk_preview = None         # Tk PhotoImage reference to avoid GC
-        self.current_path = None
-
-        # Controls (left)
-        ctrl = tk.Frame(self)
-        ctrl.pack(side=tk.LEFT, fill=tk.Y, padx=10, pady=10)
-
-        # File selection
-        tk.Button(ctrl, text="选择图片…", command=self.choose_image).pack(fill=tk.X)
-        self.path_label = tk.Label(ctrl, text="未选择", wraplength=260, anchor='w', justify='left')
-        self.path_label.pack(fill=tk.X, pady=(4, 8))
-
-        # Params
-        self.N_var = tk.IntVar(value=16)
-        self.sep_var = tk.IntVar(value=2)
-        self.border_var = tk.IntVar(value=2)
-        self.sort_var = tk.BooleanVar(value=True)
-        # palette method & aspect ratio
-        self.method_var = tk.StringVar(value="MedianCut")
-        self.saspect_var = tk.StringVar(value="1:1")
-
-        self._add_labeled_spin(ctrl, "色块数量 N", self.N_var, 3, 32, 1)
-        # 生成方法
-        mf = tk.Frame(ctrl)
-        mf.pack(fill=tk.X, pady=2)
-        tk.Label(mf, text="生成方法", width=14, anchor='w').pack(side=tk.LEFT)
-        tk.OptionMenu(mf, self.method_var, "MedianCut", "FastOctree", "KMeans", command=lambda *_: self._request_preview()).pack(side=tk.LEFT, fill=tk.X, expand=True)
-        # 色块宽高比（W:H）
-        af = tk.Frame(ctrl)
-        af.pack(fill=tk.X, pady=2)
-        tk.Label(af, text="色块宽高比", width=14, anchor='w').pack(side=tk.LEFT)
-        tk.OptionMenu(af, self.saspect_var, "5:4", "4:3", "3:2", "1:1", "2:3", "3:4", "4:5", command=lambda *_: self._request_preview()).pack(side=tk.LEFT, fill=tk.X, expand=True)
-        # 导出格式
-        self.export_format_var = tk.StringVar(value="JPEG")
-
-        self._add_labeled_spin(ctrl, "分隔线(px)", self.sep_var, 0, 8, 1)
-        self._add_labeled_spin(ctrl, "外边框(px)", self.border_var, 0, 8, 1)
-
-        tk.Checkbutton(ctrl, text="按亮度从暗到亮排序", variable=self.sort_var, command=self._request_preview).pack(anchor='w', pady=(6, 10))
-
-        self.export_scale_var = tk.IntVar(value=100)   # 导出缩放百分比（仅JPEG）
-        self.jpeg_quality_var = tk.IntVar(value=100)   # JPEG质量（1-100）
-
-        # 导出设置（JPEG）
-        sep = tk.Frame(ctrl, height=1, bg="#ddd")
-        sep.pack(fill=tk.X, pady=(8,6))
-
-        # 导出设置行（包含导出格式下拉）
-        self.settings_row = tk.Frame(ctrl)
-        self.settings_row.pack(fill=tk.X)
-        tk.Label(self.settings_row, text="导出格式", width=14, anchor='w').pack(side=tk.LEFT)
-        tk.OptionMenu(self.settings_row, self.export_format_var, "JPEG", "PNG", command=lambda *_: self._on_export_format_change()).pack(side=tk.LEFT, fill=tk.X, expand=True)
-
-        # 导出模式（放在导出缩放之上）
-        self.export_mode_var = tk.StringVar(value="percent")  # percent | longedge
-        self.long_edge_var = tk.IntVar(value=2048)
-
-        self.mode_row = tk.Frame(ctrl)
-        self.mode_row.pack(fill=tk.X, pady=(4,2))
-        tk.Label(self.mode_row, text="缩放模式", width=14, anchor='w').pack(side=tk.LEFT)
-        modes = tk.Frame(self.mode_row)
-        modes.pack(side=tk.LEFT, fill=tk.X, expand=True)
-        tk.Radiobutton(modes, text="百分比", value="percent", variable=self.export_mode_var, command=self._on_export_mode_change).pack(side=tk.LEFT)
-        tk.Radiobutton(modes, text="长边像素", value="longedge", variable=self.export_mode_var, command=self._on_export_mode_change).pack(side=tk.LEFT)
-
-        # 具体像素参数（仅长边像素）
-        self.longedge_row = tk.Frame(ctrl)
-        self.longedge_row.pack(fill=tk.X, pady=2)
-        tk.Label(self.longedge_row, text="长边像素", width=14, anchor='w').pack(side=tk.LEFT)
-        tk.Spinbox(self.longedge_row, from_=256, to=12000, textvariable=self.long_edge_var, increment=64, width=8, command=self._update_export_dim).pack(side=tk.LEFT)
-
-        # 导出缩放与质量滑块
-        self.export_scale_row = self._add_labeled_scale(ctrl, "导出缩放(%)", self.export_scale_var, 25, 200, 5, fmt="{:.0f}", affects_preview=False)
-        # 导出尺寸显示（移动到导出缩放条下方）
-        self.export_dim_label = tk.Label(ctrl, text="导出尺寸：—", anchor='w')
-        self.export_dim_label.pack(fill=tk.X, pady=(6,0))
-        # JPEG 质量（可能被隐藏）
-        self.jpeg_quality_row = self._add_labeled_scale(ctrl, "JPEG质量", self.jpeg_quality_var, 0, 100, 1, fmt="{:.0f}", affects_preview=False)
-
-        # PNG 选项
-        self.png_compress_var = tk.IntVar(value=6)
-        # self.png_label = tk.Label(ctrl, text="PNG 选项", anchor='w')
-        self.png_compress_row = self._add_labeled_scale(ctrl, "压缩等级(0-9)", self.png_compress_var, 0, 9, 1, fmt="{:.0f}", affects_preview=False)
-
-        # 操作按钮
-        self.btns_frame = tk.Frame(ctrl)
-        self.btns_frame.pack(fill=tk.X, pady=(8,6))
-        tk.Button(self.btns_frame, text="预览/刷新", command=self.refresh_preview).pack(side=tk.LEFT, expand=True, fill=tk.X)
-        tk.Button(self.btns_frame, text="保存成品…", command=self.save_composite).pack(side=tk.LEFT, expand=True, fill=tk.X, padx=(6, 0))
-
-        # 独立的“保存仅色条…”按钮
-        tk.Button(ctrl, text="保存仅色条…", command=self.save_bar).pack(fill=tk.X)
-
-        # Preview (right)
-        prev = tk.Frame(self)
-        prev.pack(side=tk.RIGHT, fill=tk.BOTH, expand=True)
-        self.canvas = tk.Canvas(prev, background="#222")
-        self.canvas.pack(fill=tk.BOTH, expand=True)
-        self.canvas.bind("<Configure>", lambda e: self._draw_preview())
-
-        # 初始化导出模式与格式相关控件的可见性
-        self._on_export_mode_change()
-        self._on_export_format_change()
-
-    # ----- UI helpers -----
-    def _add_labeled_spin(self, parent, label, var, frm, to, step):
-        f = tk.Frame(parent)
-        f.pack(fill=tk.X, pady=2)
-        tk.Label(f, text=label, width=14, anchor='w').pack(side=tk.LEFT)
-        sb = tk.Spinbox(f, from_=frm, to=to, textvariable=var, increment=step, width=7, command=self._request_preview)
-        sb.pack(side=tk.LEFT)
-
-    def _add_labeled_scale(self, parent, label, var, frm, to, res, fmt="{:.2f}", affects_preview=True):
-        f = tk.Frame(parent)
-        f.pack(fill=tk.X, pady=2)
-        top = tk.Frame(f)
-        top.pack(fill=tk.X)
-        tk.Label(top, text=label, anchor='w').pack(side=tk.LEFT)
-        val_lbl = tk.Label(top, text=fmt.format(var.get()), anchor='e')
-        val_lbl.pack(side=tk.RIGHT)
-        if affects_preview:
-            cmd = lambda _=None: (val_lbl.config(text=fmt.format(var.get())), self._request_preview())
-        else:
-            cmd = lambda _=None: (val_lbl.config(text=fmt.format(var.get())), self._update_export_dim())
-        s = tk.Scale(f, from_=frm, to=to, resolution=res, orient=tk.HORIZONTAL, variable=var, command=cmd)
-        s.pack(fill=tk.X)
-        return f
-
-    def _on_export_format_change(self):
-        fmt = self.export_format_var.get()
-        # 先隐藏所有相关控件
-        try:
-            if hasattr(self, 'jpeg_quality_row') and self.jpeg_quality_row is not None:
-                self.jpeg_quality_row.pack_forget()
-        except Exception:
-            pass
-        for w in ('png_label', 'png_compress_row'):
-            try:
-                ww = getattr(self, w, None)
-                if ww is not None:
-                    ww.pack_forget()
-            except Exception:
-                pass
-        try:
-            if hasattr(self, 'fmt_spacer_row') and self.fmt_spacer_row is not None:
-                self.fmt_spacer_row.pack_forget()
-        except Exception:
-            pass
-        # 再按顺序显示需要的控件（保证位置在按钮上方，且相对顺序稳定）
-        if fmt == 'JPEG':
-            if hasattr(self, 'jpeg_quality_row') and self.jpeg_quality_row is not None:
-                try:
-                    self.jpeg_quality_row.pack(before=self.mode_row, fill=tk.X, pady=(8,0))
-                except Exception:
-                    self.jpeg_quality_row.pack(fill=tk.X, pady=(8,0))
-        else:  # PNG
-            if hasattr(self, 'png_label') and self.png_label is not None:
-                try:
-                    self.png_label.pack(before=self.mode_row, fill=tk.X, pady=(8,0))
-                except Exception:
-                    self.png_label.pack(fill=tk.X, pady=(8,0))
-            if hasattr(self, 'png_compress_row') and self.png_compress_row is not None:
-                try:
-                    self.png_compress_row.pack(before=self.mode_row, fill=tk.X, pady=2)
-                except Exception:
-                    self.png_compress_row.pack(fill=tk.X, pady=2)
-            # 无优化选项
-        
-    def _on_export_mode_change(self):
-        mode = self.export_mode_var.get()
-        # 统一先隐藏两组控件
-        try:
-            if hasattr(self, 'export_scale_row') and self.export_scale_row is not None:
-                self.export_scale_row.pack_forget()
-        except Exception:
-            pass
+class PaletteService:
+    """
+    Palette computation for a long-running local server (see serve()).
+
+    Requests name an image by its bytes or a file path. The content is hashed
+    on a worker thread (file paths use their identity, as for the GUI), and
+    the resulting key is looked up in an in-process PaletteCache of at most
+    `cache_bytes`. Misses are decoded and quantized on the same pool, and
+    concurrent requests for the same key share one computation instead of
+    each doing the work.
+    """
+
+    def __init__(self, cache_bytes=64 * 1024 * 1024, workers=None, assign_workers=1):
+        from concurrent.futures import ThreadPoolExecutor
+        self.cache = PaletteCache(cache_bytes)
+        self.pool = ThreadPoolExecutor(max_workers=max(1, int(workers or os.cpu_count() or 1)),
+                                       thread_name_prefix="service")
+        self.assign_workers = assign_workers  # requests already run in parallel
+        self._inflight = {}  # cache key -> asyncio.Future
+        self.stats = {'requests': 0, 'computed': 0, 'coalesced': 0, 'errors': 0}
+
+    @staticmethod
+    def _fingerprint(data, path, max_side):
+        if path is not None:
+            return file_fingerprint(path, max_side)
+        hsh = hashlib.blake2b(data, digest_size=16).hexdigest()
+        return f"bytes:{hsh}@{max_side or 'full'}"
+
+    @staticmethod
+    def _decode(data, path, max_side):
+        if path is not None and max_side:
+            return ImageSource(path).preview(max_side)
+        im = Image.open(path if path is not None else io.BytesIO(data))
+        if max_side:
+            im.draft("RGB", (max_side, max_side))
+            im.load()
+            im = as_rgb(im)
+            if max(im.size) > max_side:
+                im.thumbnail((max_side, max_side), Image.LANCZOS, reducing_gap=3.0)
+            return im
+        im.load()
+        return as_rgb(im)
+
+    def _compute(self, data, path, fingerprint, q):
+        im = self._decode(data, path, q['max_side'])
+        return extract_palette(im, q['N'], q['method'], seed=q['seed'], hist_bits=q['hist_bits'],
+                               cache=self.cache, fingerprint=fingerprint, workers=self.assign_workers)
+
+    async def _run(self, key, data, path, fingerprint, q):
+        import asyncio
         try:
-            if hasattr(self, 'longedge_row') and self.longedge_row is not None:
-                self.longedge_row.pack_forget()
+            pal = await asyncio.get_running_loop().run_in_executor(self.pool, self._compute, data, path,
+                                                                   fingerprint, q)
         except Exception:
-            pass
-        # 按模式显示对应控件，并放在导出尺寸标签之前，保证顺序
-        if mode == 'percent':
+            self.stats['errors'] += 1
+            raise
+        finally:
+            del self._inflight[key]
+        self.stats['computed'] += 1
+        return pal
+
+    async def palette(self, q, data=None, path=None):
+        """Return (Palette, how) where how is 'cached', 'coalesced' or 'computed'."""
+        import asyncio
+        loop = asyncio.get_running_loop()
+        self.stats['requests'] += 1
+        fingerprint = await loop.run_in_executor(self.pool, self._fingerprint, data, path, q['max_side'])
+        key = _palette_key(fingerprint, q['N'], q['method'], q['hist_bits'], q['seed'])
+        pal = self.cache.get(key)
+        if pal is not None:
+            return pal, 'cached'
+        task = self._inflight.get(key)
+        if task is None:
+            # a task of its own, so a client hanging up doesn't cancel it for the others
+            task = self._inflight[key] = asyncio.ensure_future(self._run(key, data, path, fingerprint, q))
+            how = 'computed'
+        else:
+            self.stats['coalesced'] += 1
+            how = 'coalesced'
+        return await asyncio.shield(task), how
+
+    def render_bar(self, pal, q):
+        """PNG bytes of the palette drawn as a bar_width x bar_height strip."""
+        bar = draw_palette_bar(display_colors(pal, q['N'], q['sort_by_luma']), q['bar_width'], q['bar_height'],
+                               N=q['N'], separator=q['separator'], border_px=q['border_px'])
+        buf = io.BytesIO()
+        Image.fromarray(bar).save(buf, format="PNG", compress_level=1)
+        return buf.getvalue()
+
+    def close(self):
+        self.pool.shutdown(wait=False, cancel_futures=True)
+
+
+_SERVICE_PARAMS = {  # query parameter -> (parser, default)
+    'N': (int, 16),
+    'method': (str, 'MedianCut'),
+    'seed': (int, 42),
+    'hist_bits': (int, HIST_BITS),
+    'max_side': (int, 0),
+    'bar': (str, ''),
+    'bar_width': (int, 1024),
+    'bar_height': (int, 64),
+    'separator': (int, 2),
+    'border_px': (int, 2),
+    'sort_by_luma': (lambda v: v not in ('0', 'false', 'no'), True),
+}
+
+
+def _service_params(query):
+    from urllib.parse import parse_qs
+    raw = {k: v[-1] for k, v in parse_qs(query).items()}
+    q = {}
+    for name, (parse, default) in _SERVICE_PARAMS.items():
+        q[name] = parse(raw[name]) if name in raw else default
+    if q['method'] not in ('MedianCut', 'FastOctree', 'KMeans'):
+        raise ValueError(f"unknown method {q['method']!r}")
+    if not 1 <= q['N'] <= 256 or not 1 <= q['hist_bits'] <= 8:
+        raise ValueError("N must be in 1..256 and hist_bits in 1..8")
+    if q['max_side'] < 0:
+        raise ValueError("max_side must be >= 0")
+    if q['bar'] not in ('', '0', '1', 'png'):
+        raise ValueError("bar must be 1 (base64 PNG in the JSON) or png (raw PNG response)")
+    q['bar_width'] = max(1, min(q['bar_width'], 16384))
+    q['bar_height'] = max(1, min(q['bar_height'], 4096))
+    q['path'] = raw.get('path')
+    return q
+
+
+_HTTP_REASONS = {200: 'OK', 400: 'Bad Request', 404: 'Not Found', 405: 'Method Not Allowed',
+                 413: 'Payload Too Large', 500: 'Internal Server Error'}
+
+
+async def _service_respond(service, method, target, body, max_body):
+    """Handle one request; returns (status, content_type, payload bytes)."""
+    import asyncio
+    import base64
+    from urllib.parse import urlsplit
+    url = urlsplit(target)
+    if url.path == '/stats' and method == 'GET':
+        stats = dict(service.stats, cache_entries=len(service.cache), cache_hits=service.cache.hits,
+                     cache_misses=service.cache.misses, inflight=len(service._inflight))
+        return 200, 'application/json', json.dumps(stats).encode()
+    if url.path != '/palette':
+        return 404, 'application/json', b'{"error": "not found"}'
+    if body is not None and len(body) > max_body:
+        return 413, 'application/json', b'{"error": "image too large"}'
+    try:
+        q = _service_params(url.query)
+        if method == 'POST' and body:
+            pal, how = await service.palette(q, data=body)
+        elif q['path']:
+            pal, how = await service.palette(q, path=q['path'])
+        else:
+            return 400, 'application/json', b'{"error": "POST image bytes or pass ?path="}'
+    except (ValueError, OSError, Image.UnidentifiedImageError, Image.DecompressionBombError) as e:
+        return 400, 'application/json', json.dumps({'error': f"{type(e).__name__}: {e}"}).encode()
+    except Exception as e:
+        return 500, 'application/json', json.dumps({'error': f"{type(e).__name__}: {e}"}).encode()
+    if q['bar'] in ('1', 'png'):
+        # drawing and PNG-encoding a bar of up to 16384x4096 would stall every other connection
+        png = await asyncio.get_running_loop().run_in_executor(service.pool, service.render_bar, pal, q)
+        if q['bar'] == 'png':
+            return 200, 'image/png', png
+    out = dict(pal.to_dict(), N=q['N'], method=q['method'], source=how)
+    if q['bar'] == '1':
+        out['bar_png'] = base64.b64encode(png).decode('ascii')
+    return 200, 'application/json', json.dumps(out).encode()
+
+
+async def _service_connection(service, reader, writer, max_body):
+    """Minimal HTTP/1.1 loop with keep-alive: GET/POST with Content-Length bodies."""
+    import asyncio
+    try:
+        while True:
             try:
-                self.export_scale_row.pack(before=self.export_dim_label, fill=tk.X, pady=2)
-            except Exception:
-                self.export_scale_row.pack(fill=tk.X, pady=2)
-        else:  # longedge
+                head = await reader.readuntil(b'\r\n\r\n')
+            except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, ConnectionError):
+                return
+            lines = head.decode('latin-1').split('\r\n')
             try:
-                self.longedge_row.pack(before=self.export_dim_label, fill=tk.X, pady=2)
-            except Exception:
-                self.longedge_row.pack(fill=tk.X, pady=2)
-        # 更新尺寸显示
-        self._update_export_dim()
-    def _request_preview(self):
-        if self._refresh_job is not None:
+                method, target, version = lines[0].split(' ', 2)
+            except ValueError:
+                return
+            headers = {}
+            for line in lines[1:]:
+                if ':' in line:
+                    k, v = line.split(':', 1)
+                    headers[k.strip().lower()] = v.strip()
             try:
-                self.after_cancel(self._refresh_job)
-            except Exception:
-                pass
-        self._refresh_job = self.after(120, self.refresh_preview)
+                length = int(headers.get('content-length') or 0)
+            except ValueError:
+                length = -1
+            body = None
+            if length < 0:
+                # the body can't be skipped without a valid length, so the connection is closed
+                status, ctype, payload = 400, 'application/json', b'{"error": "invalid Content-Length"}'
+                keep_alive = False
+            elif length > max_body:
+                status, ctype, payload = 413, 'application/json', b'{"error": "image too large"}'
+                keep_alive = False
+            else:
+                if length:
+                    body = await reader.readexactly(length)
+                status, ctype, payload = await _service_respond(service, method.upper(), target, body, max_body)
+                conn = headers.get('connection', '').lower()
+                keep_alive = conn != 'close' and (version == 'HTTP/1.1' or conn == 'keep-alive')
+            writer.write(f"HTTP/1.1 {status} {_HTTP_REASONS.get(status, '')}\r\n"
+                         f"Content-Type: {ctype}\r\nContent-Length: {len(payload)}\r\n"
+                         f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n".encode() + payload)
+            await writer.drain()
+            if not keep_alive:
+                return
+    except (ConnectionError, asyncio.IncompleteReadError):
+        pass
+    finally:
+        writer.close()
 
-    def _update_export_dim(self):
-        if self.preview_image is None:
-            return
-        ew, eh = self._compute_export_size(self.preview_image.width, self.preview_image.height)
-        self.export_dim_label.config(text=f"导出尺寸：{ew}×{eh}px")
 
-    def _make_preview_source(self) -> Image.Image:
-        im = self.src_image
-        if im is None:
-            return None
-        w, h = im.size
-        long_side = max(w, h)
-        scale = min(self.PREVIEW_MAXSIDE / float(long_side), 1.0)
-        if scale < 1.0:
-            nw = max(1, int(round(w * scale)))
-            nh = max(1, int(round(h * scale)))
-            return im.resize((nw, nh), Image.LANCZOS)
-        return im
+def serve(host='127.0.0.1', port=8765, unix=None, cache_mb=64, workers=None, max_body_mb=256, log=print):
+    """
+    Run the palette service until interrupted, on TCP host:port or on the
+    Unix socket `unix`.
 
-    def _parse_aspect(self, s: str) -> float:
-        try:
-            if ":" in s:
-                a, b = s.split(":", 1)
-                a = float(a.strip()); b = float(b.strip())
-                return a / b if b != 0 else float(a)
-            return float(s)
-        except Exception:
-            return 10.0  # fallback
-
-    def _compute_export_size(self, base_w: int, base_h: int):
-        mode = self.export_mode_var.get()
-        if mode == 'percent':
-            scale = max(1, int(self.export_scale_var.get())) / 100.0
-        elif mode == 'longedge':
-            le = max(1, int(self.long_edge_var.get()))
-            scale = le / max(base_w, base_h)
-        else:
-            scale = 1.0
-        nw = max(1, int(round(base_w * scale)))
-        nh = max(1, int(round(base_h * scale)))
-        return nw, nh
-
-    def _resize_for_export(self, img: Image.Image) -> Image.Image:
-        w, h = img.size
-        nw, nh = self._compute_export_size(w, h)
-        if (nw, nh) != (w, h):
-            return img.resize((nw, nh), Image.LANCZOS)
-        return img
-
-    # ----- Actions -----
-    def choose_image(self):
-        path = filedialog.askopenfilename(title="选择图片", filetypes=[
-            ("Image Files", "*.png *.jpg *.jpeg *.bmp *.tif *.tiff"),
-            ("All Files", "*.*"),
-        ])
-        if not path:
-            return
-        try:
-            self.src_image = Image.open(path).convert("RGB")
-            self.current_path = path
-            self.path_label.config(text=path)
-            self.refresh_preview()
-        except Exception as e:
-            messagebox.showerror("读取失败", f"无法打开图片：\n{e}")
-
-    def refresh_preview(self):
-        if self.src_image is None:
-            return
-        try:
-            src = self._make_preview_source()
-            out, _bar = build_palette_bar(
-                src,
-                N=int(self.N_var.get()),
-                swatch_aspect=self._parse_aspect(self.saspect_var.get()),
-                separator=int(self.sep_var.get()),
-                border_px=int(self.border_var.get()),
-                sort_by_luma=bool(self.sort_var.get()),
-                method=self.method_var.get(),
-            )
-            self.preview_image = out
-            self._update_export_dim()
-            self._draw_preview()
-            self._refresh_job = None
-        except Exception as e:
-            messagebox.showerror("处理失败", str(e))
-
-    def _draw_preview(self):
-        if self.preview_image is None:
-            self.canvas.delete("all")
-            return
-        cw = self.canvas.winfo_width()
-        ch = self.canvas.winfo_height()
-        if cw < 2 or ch < 2:
-            return
-        # Fit preview to canvas while preserving aspect
-        img = self.preview_image
-        iw, ih = img.size
-        scale = min(cw / iw, ch / ih)
-        pw = max(1, int(iw * scale))
-        ph = max(1, int(ih * scale))
-        disp = img.resize((pw, ph), Image.LANCZOS)
-        self.tk_preview = ImageTk.PhotoImage(disp)
-        self.canvas.delete("all")
-        self.canvas.create_image(cw // 2, ch // 2, image=self.tk_preview)
-
-    def save_composite(self):
-        if self.preview_image is None:
-            messagebox.showinfo("提示", "请先选择图片并生成预览。")
-            return
-        default = "output_with_palette.jpg"
-        if self.current_path:
-            base = os.path.splitext(os.path.basename(self.current_path))[0]
-            default = f"{base}_with_palette.jpg"
-        fmt = self.export_format_var.get()
-        if fmt == "PNG":
-            defext = ".png"; ftypes = [("PNG", ".png"), ("All Files", "*.*")]
+        POST /palette?N=16&method=KMeans    body: image file bytes
+        GET  /palette?path=/abs/img.jpg&N=8&bar=1
+        GET  /stats
+
+    Replies are {"colors", "counts", "N", "method", "source"} JSON, where
+    source is cached/coalesced/computed. bar=1 adds a base64 PNG of the bar
+    and bar=png returns the PNG itself. max_side=<px> quantizes a reduced
+    decode instead of the full image.
+    """
+    import asyncio
+    service = PaletteService(cache_bytes=int(cache_mb * 1024 * 1024), workers=workers)
+    max_body = int(max_body_mb * 1024 * 1024)
+
+    async def run():
+        import signal
+        handler = lambda r, w: _service_connection(service, r, w, max_body)  # noqa: E731
+        if unix:
+            server = await asyncio.start_unix_server(handler, path=unix)
+            log(f"palette service on unix:{unix}")
         else:
-            defext = ".jpg"; ftypes = [("JPEG", ".jpg"), ("PNG", ".png"), ("All Files", "*.*")]
-        path = filedialog.asksaveasfilename(title="保存成品", defaultextension=defext,
-                                            initialfile=default, filetypes=ftypes)
-        if not path:
-            return
+            server = await asyncio.start_server(handler, host, port)
+            log(f"palette service on http://{host}:{port}")
+        stop = asyncio.Event()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            try:
+                asyncio.get_running_loop().add_signal_handler(sig, stop.set)
+            except (NotImplementedError, RuntimeError):
+                pass  # e.g. Windows: Ctrl+C still raises KeyboardInterrupt
+        async with server:
+            await stop.wait()
+
+    try:
+        asyncio.run(run())
+    except KeyboardInterrupt:
+        pass
+    finally:
+        service.close()
+        if unix and os.path.exists(unix):
+            os.unlink(unix)
+
+
+# ------------------------------
+# Command line
+# ------------------------------
+
+def _parse_rgb(s):
+    """Parse "r,g,b" or "#rrggbb" into an (r, g, b) tuple."""
+    s = s.strip()
+    if s.startswith('#') and len(s) == 7:
+        return tuple(int(s[i:i + 2], 16) for i in (1, 3, 5))
+    parts = [int(p) for p in s.split(',')]
+    if len(parts) != 3:
+        raise ValueError(f"expected r,g,b or #rrggbb, got {s!r}")
+    return tuple(max(0, min(255, p)) for p in parts)
+
+
+def _add_quant_args(p, method='MedianCut'):
+    p.add_argument('-N', type=int, default=16)
+    p.add_argument('--method', choices=['MedianCut', 'FastOctree', 'KMeans'], default=method)
+    p.add_argument('--mem-budget-mb', type=float, default=KMEANS_MEM_BUDGET_MB,
+                   help="peak memory for KMeans assignment temporaries")
+    p.add_argument('--seed', type=int, default=42, help="KMeans random seed")
+    p.add_argument('--hist-bits', type=int, default=HIST_BITS, choices=range(1, 9), metavar='{1..8}',
+                   help="color histogram bits per channel (8 = exact)")
+    p.add_argument('--threads', type=int, default=None,
+                   help="threads for the KMeans/FastOctree assignment step (default: all cores)")
+
+
+def _add_cache_args(p):
+    p.add_argument('--cache-max-mb', type=float, default=256, help="persistent cache size limit")
+    p.add_argument('--cache-max-age-days', type=float, default=90, help="drop cache entries unused this long")
+
+
+def build_arg_parser():
+    import argparse
+    parser = argparse.ArgumentParser(description="Palette Bar Generator")
+    sub = parser.add_subparsers(dest='command')
+    fr = sub.add_parser('frames', help="per-frame palettes of an animation or a directory of frames")
+    fr.add_argument('input', help="animated GIF/APNG/TIFF, or a directory of frames")
+    fr.add_argument('-o', '--output', default=None, help="JSON lines output file (default: stdout)")
+    fr.add_argument('--timeline', default=None, help="also save a palette timeline image here")
+    fr.add_argument('--timeline-width', type=int, default=1024)
+    fr.add_argument('--row-height', type=int, default=16)
+    fr.add_argument('--no-warm-start', action='store_true', help="cluster every frame from scratch")
+    _add_quant_args(fr, method='KMeans')
+    sv = sub.add_parser('serve', help="run the local palette service (HTTP over TCP or a Unix socket)")
+    sv.add_argument('--host', default='127.0.0.1')
+    sv.add_argument('--port', type=int, default=8765)
+    sv.add_argument('--unix', default=None, metavar='PATH', help="listen on a Unix socket instead of TCP")
+    sv.add_argument('--cache-mb', type=float, default=64, help="in-process palette cache size")
+    sv.add_argument('--workers', type=int, default=None, help="hash/decode/quantize threads (default: CPU count)")
+    sv.add_argument('--max-body-mb', type=float, default=256, help="largest accepted upload")
+    ca = sub.add_parser('cache', help="inspect or maintain the persistent palette cache")
+    ca.add_argument('path', nargs='?', default=None, help="SQLite file (default: the GUI's per-user cache)")
+    ca.add_argument('--check', action='store_true', help="run the integrity check, deleting bad rows")
+    ca.add_argument('--evict', action='store_true', help="apply the age and size limits now")
+    ca.add_argument('--clear', action='store_true', help="delete every entry")
+    _add_cache_args(ca)
+    rm = sub.add_parser('remap', help="posterize an image to its palette and/or write its per-pixel label map")
+    rm.add_argument('input')
+    rm.add_argument('-o', '--output', default=None,
+                    help="posterized image: PNG/TIFF are streamed as indexed images; GIF/BMP (indexed) and "
+                         "JPEG (RGB) are built in memory, limited by --mem-budget-mb")
+    rm.add_argument('--labels', default=None, metavar='NPY',
+                    help="uint8 palette index per pixel (.npy, written through a memory map)")
+    rm.add_argument('--lut-bits', type=int, default=REMAP_LUT_BITS, choices=range(4, 8),
+                    help="coarse grid of the lookup table (finer: fewer boundary cells to refine, slower build)")
+    rm.add_argument('--tile-mpx', type=float, default=TILE_PIXELS / 1e6, help="tile budget in megapixels")
+    _add_quant_args(rm)
+    an = sub.add_parser('analyze', help="palettes only (no rendering), streamed as NDJSON or CSV")
+    an.add_argument('inputs', nargs='+', help="image files and/or directories")
+    an.add_argument('-o', '--output', default=None, help="output file (default: stdout)")
+    an.add_argument('--format', choices=['ndjson', 'csv'], default='ndjson',
+                    help="one JSON line per image, or one CSV row per color")
+    an.add_argument('--swatches', default=None, metavar='DIR', help="also save one swatch file per image here")
+    an.add_argument('--swatch-format', nargs='+', choices=sorted(SWATCH_FORMATS), default=['gpl'])
+    an.add_argument('--max-side', type=int, default=None,
+                    help="analyse a downscaled decode with this long side (default: full resolution)")
+    an.add_argument('--tiled', action='store_true', help="read images tile by tile (bounded memory for strip/tile TIFF and uncompressed files)")
+    an.add_argument('--tile-mpx', type=float, default=TILE_PIXELS / 1e6, help="tile budget in megapixels")
+    an.add_argument('--workers', type=int, default=None, help="process count (default: CPU count)")
+    an.add_argument('--hierarchical', action='store_true', help="cut N from a cached palette tree")
+    an.add_argument('--cache', default=None, metavar='SQLITE', help="persistent palette cache")
+    _add_cache_args(an)
+    an.add_argument('--content-hash', action='store_true',
+                    help="key the cache by file content instead of (path, size, mtime)")
+    _add_quant_args(an)
+    b = sub.add_parser('batch', help="render palettes for a whole directory tree")
+    b.add_argument('in_dir')
+    b.add_argument('out_dir')
+    b.add_argument('--workers', type=int, default=None,
+                   help="process count (default: CPU count); --threads defaults to the cores left per process")
+    b.add_argument('--bar-only', action='store_true', help="save only the palette bar")
+    b.add_argument('--tiled', action='store_true',
+                   help="with --bar-only: read images tile by tile (bounded memory for strip/tile TIFF and "
+                        "uncompressed files; PNG/JPEG are still decoded in full)")
+    b.add_argument('--tile-mpx', type=float, default=TILE_PIXELS / 1e6, help="tile budget in megapixels")
+    b.add_argument('--variants', default=None, metavar='N,N,...',
+                   help="write one output per palette size (e.g. 8,16,32) from a single quantization")
+    b.add_argument('--target', action='append', type=parse_export_target, default=None, metavar='FMT[:SIZE[:LEVEL]]',
+                   help="repeatable; write each image to several formats/sizes from one render, e.g. "
+                        "--target jpeg:100%%:95 --target png:1024px:9 (overrides --format and the size options)")
+    b.add_argument('--hierarchical', action='store_true',
+                   help="cut N from a palette tree (as --variants does; identical for MedianCut)")
+    b.add_argument('--cache', default=None, metavar='SQLITE',
+                   help="persistent palette cache; unchanged files skip quantization (and decoding with "
+                        "--bar-only) on re-runs")
+    _add_cache_args(b)
+    b.add_argument('--content-hash', action='store_true',
+                   help="key the cache by file content instead of (path, size, mtime)")
+    b.add_argument('--trace', default=None, metavar='JSON',
+                   help="record per-stage timings of every image and write them here")
+    # build_palette_bar parameters
+    _add_quant_args(b)
+    b.add_argument('--bar-h-ratio', type=float, default=0.09)
+    b.add_argument('--bar-h-min', type=int, default=60)
+    b.add_argument('--bar-h-max', type=int, default=200)
+    b.add_argument('--separator', type=int, default=2)
+    b.add_argument('--border', type=int, default=2)
+    b.add_argument('--bar-bg', type=_parse_rgb, default=(30, 30, 30))
+    b.add_argument('--sep-color', type=_parse_rgb, default=(220, 220, 220))
+    b.add_argument('--border-color', type=_parse_rgb, default=(190, 190, 190))
+    b.add_argument('--no-sort', action='store_true', help="don't sort swatches by luminance")
+    b.add_argument('--posterize', action='store_true', help="remap the image to the palette colors")
+    b.add_argument('--aspect', default=None, help="swatch aspect W:H, e.g. 1:1")
+    # export options
+    b.add_argument('--format', choices=['JPEG', 'PNG'], default='JPEG')
+    b.add_argument('--export-mode', choices=['percent', 'longedge'], default='percent')
+    b.add_argument('--scale', type=int, default=100, help="export scale in percent")
+    b.add_argument('--long-edge', type=int, default=2048)
+    b.add_argument('--jpeg-quality', type=int, default=100)
+    b.add_argument('--png-compress', type=int, default=6)
+    return parser
+
+
+def main(argv=None):
+    parser = build_arg_parser()
+    args = parser.parse_args(argv)
+    if args.command == 'batch':
+        if args.tiled and not args.bar_only:
+            parser.error("--tiled requires --bar-only (a composite needs the decoded image)")
+        if args.target and args.variants:
+            parser.error("--target and --variants can't be combined")
+        if args.target and len({t.output_path('x') for t in args.target}) < len(args.target):
+            parser.error("each --target needs a distinct format or size")
+        palette_kw = dict(
+            N=args.N,
+            bar_h_ratio=args.bar_h_ratio,
+            bar_h_min=args.bar_h_min,
+            bar_h_max=args.bar_h_max,
+            separator=args.separator,
+            border_px=args.border,
+            bar_bg=args.bar_bg,
+            sep_color=args.sep_color,
+            border_color=args.border_color,
+            sort_by_luma=not args.no_sort,
+            swatch_aspect=parse_aspect(args.aspect) if args.aspect else None,
+            posterize=args.posterize,
+            method=args.method,
+            mem_budget_mb=args.mem_budget_mb,
+            seed=args.seed,
+            hist_bits=args.hist_bits,
+            workers=args.threads or max(1, (os.cpu_count() or 1) // max(1, args.workers or os.cpu_count() or 1)),
+            hierarchical=args.hierarchical,
+        )
+        export_kw = dict(
+            mode=args.export_mode,
+            scale_pct=args.scale,
+            long_edge=args.long_edge,
+            jpeg_quality=args.jpeg_quality,
+            png_compress=args.png_compress,
+            tile_pixels=int(args.tile_mpx * 1e6) if args.tiled else None,
+            cache_path=args.cache,
+            cache_max_bytes=int(args.cache_max_mb * 1024 * 1024),
+            cache_max_age_days=args.cache_max_age_days,
+            content_hash=args.content_hash,
+            variants=[int(n) for n in args.variants.split(',')] if args.variants else None,
+            targets=args.target,
+        )
+        trace = PipelineTrace() if args.trace else None
+        summary = run_batch(args.in_dir, args.out_dir, palette_kw, export_kw,
+                            fmt=args.format, bar_only=args.bar_only, workers=args.workers, trace=trace)
+        if trace is not None:
+            with open(args.trace, 'w') as f:
+                f.write(trace.to_json(indent=1))
+        return 1 if summary['failed'] else 0
+    if args.command == 'remap':
+        if not (args.output or args.labels):
+            parser.error("nothing to write: pass -o and/or --labels")
+        tile_pixels = int(args.tile_mpx * 1e6)
+        pal = extract_palette_tiled(args.input, args.N, args.method, mem_budget_mb=args.mem_budget_mb,
+                                    seed=args.seed, hist_bits=args.hist_bits, cache=None, tile_pixels=tile_pixels,
+                                    workers=args.threads)
+        remap_file(args.input, pal, args.output, labels_out=args.labels, tile_pixels=tile_pixels,
+                   bits=args.lut_bits, mem_budget_mb=args.mem_budget_mb)
+        # label i is pal.colors[i]
+        print(json.dumps(pal.to_record()))
+        return 0
+    if args.command == 'analyze':
+        if args.tiled and args.max_side:
+            parser.error("--tiled and --max-side can't be combined")
+        opts = dict(max_side=args.max_side, tile_pixels=int(args.tile_mpx * 1e6) if args.tiled else None,
+                    content_hash=args.content_hash, cache_path=args.cache,
+                    cache_max_bytes=int(args.cache_max_mb * 1024 * 1024),
+                    cache_max_age_days=args.cache_max_age_days)
+        out = open(args.output, 'w', newline='') if args.output else None
         try:
-            # Recompute at full quality using current params on original (not the resized preview)
-            out, _ = build_palette_bar(
-                self.src_image,
-                N=int(self.N_var.get()),
-                swatch_aspect=self._parse_aspect(self.saspect_var.get()),
-                separator=int(self.sep_var.get()),
-                border_px=int(self.border_var.get()),
-                sort_by_luma=bool(self.sort_var.get()),
-                method=self.method_var.get(),
-            )
-            ext = os.path.splitext(path)[1].lower()
-            out = self._resize_for_export(out)
-            if ext in (".jpg", ".jpeg"):
-                out.save(path, quality=int(self.jpeg_quality_var.get()))
-            elif ext == ".png":
-                cl = max(0, min(9, int(self.png_compress_var.get())))
-                out.save(path, compress_level=cl)
-            else:
-                out.save(path)
-            messagebox.showinfo("已保存", path)
-        except Exception as e:
-            messagebox.showerror("保存失败", str(e))
-
-    def save_bar(self):
-        if self.src_image is None:
-            messagebox.showinfo("提示", "请先选择图片并生成预览。")
-            return
-        default = "palette_bar.png"
-        if self.current_path:
-            base = os.path.splitext(os.path.basename(self.current_path))[0]
-            default = f"{base}_palette_bar.png"
-        fmt = self.export_format_var.get()
-        if fmt == "PNG":
-            defext = ".png"; ftypes = [("PNG", ".png"), ("All Files", "*.*")]
-        else:
-            defext = ".jpg"; ftypes = [("JPEG", ".jpg"), ("PNG", ".png"), ("All Files", "*.*")]
-        path = filedialog.asksaveasfilename(title="保存仅色条", defaultextension=defext,
-                                            initialfile=default, filetypes=ftypes)
-        if not path:
-            return
+            summary = run_analyze(
+                args.inputs, out, fmt=args.format, N=args.N, processes=args.workers, opts=opts,
+                swatch_dir=args.swatches, swatch_formats=args.swatch_format, method=args.method,
+                mem_budget_mb=args.mem_budget_mb, seed=args.seed, hist_bits=args.hist_bits,
+                hierarchical=args.hierarchical,
+                workers=args.threads or max(1, (os.cpu_count() or 1) // max(1, args.workers or os.cpu_count() or 1)))
+        finally:
+            if out is not None:
+                out.close()
+        return 1 if summary['failed'] else 0
+    if args.command == 'cache':
+        cache = DiskPaletteCache(args.path or default_cache_path(), max_bytes=int(args.cache_max_mb * 1024 * 1024),
+                                 max_age_days=args.cache_max_age_days)
+        out = {}
+        if args.clear:
+            cache.clear()
+        if args.evict:
+            out['evicted'] = cache.evict()
+        if args.check:
+            out['check'] = cache.check()
+        out.update(cache.stats())
+        print(json.dumps(out, indent=1))
+        return 1 if args.check and (out['check']['sqlite'] != 'ok' or out['check']['bad_rows']) else 0
+    if args.command == 'serve':
+        serve(args.host, args.port, unix=args.unix, cache_mb=args.cache_mb, workers=args.workers,
+              max_body_mb=args.max_body_mb)
+        return 0
+    if args.command == 'frames':
+        out = open(args.output, 'w') if args.output else None
         try:
-            _out, bar = build_palette_bar(
-                self.src_image,
-                N=int(self.N_var.get()),
-                swatch_aspect=self._parse_aspect(self.saspect_var.get()),
-                separator=int(self.sep_var.get()),
-                border_px=int(self.border_var.get()),
-                sort_by_luma=bool(self.sort_var.get()),
-                method=self.method_var.get(),
-            )
-            ext = os.path.splitext(path)[1].lower()
-            bar = self._resize_for_export(bar)
-            if ext in (".jpg", ".jpeg"):
-                bar.save(path, quality=int(self.jpeg_quality_var.get()))
-            elif ext == ".png":
-                cl = max(0, min(9, int(self.png_compress_var.get())))
-                bar.save(path, compress_level=cl)
-            else:
-                bar.save(path)
-            messagebox.showinfo("已保存", path)
-        except Exception as e:
-            messagebox.showerror("保存失败", str(e))
+            run_frames(args.input, out, N=args.N, method=args.method, mem_budget_mb=args.mem_budget_mb,
+                       seed=args.seed, hist_bits=args.hist_bits, warm_start=not args.no_warm_start,
+                       timeline=args.timeline, timeline_width=args.timeline_width, row_h=args.row_height,
+                       workers=args.threads)
+        finally:
+            if out is not None:
+                out.close()
+        return 0
+    # the GUI imports the core as `main`; reuse this module when run as a script
+    sys.modules.setdefault('main', sys.modules[__name__])
+    try:
+        import gui
+    except ImportError as e:  # e.g. no _tkinter on a headless install
+        parser.error(f"the GUI needs Tk ({e}); the subcommands work without it")
+    return gui.run()
+
+
+def __getattr__(name):
+    # main.App / main.BackgroundEngine still work, importing the Tk front end on demand
+    if name in ('App', 'BackgroundEngine'):
+        import gui
+        return getattr(gui, name)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
 
 
 if __name__ == "__main__":
-    app = App()
-    app.geometry("1200x700")
-    app.mainloop()
+    raise SystemExit(main())
@@ -0,0 +1,133 @@
+"""DiskPaletteCache: round-trip, checksums, recovery from a corrupt file, eviction and stored palette trees."""
+import os
+import sqlite3
+import sys
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import main  # noqa: E402
+
+
+def palette(seed, k=8):
+    rng = np.random.default_rng(seed)
+    return main.Palette(rng.integers(0, 256, (k, 3)).astype(np.uint8), rng.integers(1, 10**9, k).astype(np.int64))
+
+
+def key(i):
+    return main._palette_key(f"/img/{i}.jpg:100:1@full", 8, 'MedianCut', main.HIST_BITS, 42)
+
+
+def test_round_trip(tmp_path):
+    path = str(tmp_path / "sub" / "palettes.sqlite")
+    pal = palette(1)
+    main.DiskPaletteCache(path).put(key(1), pal)
+    fresh = main.DiskPaletteCache(path)  # new memory layer, so this reads the row
+    got = fresh.get(key(1))
+    assert got.colors.dtype == np.uint8 and got.counts.dtype == np.int64
+    assert np.array_equal(got.colors, pal.colors) and np.array_equal(got.counts, pal.counts)
+    assert fresh.get(key(2)) is None
+    assert (fresh.hits, fresh.misses) == (1, 1)
+    assert fresh.check() == {'sqlite': 'ok', 'rows': 1, 'bad_rows': 0}
+
+
+def test_flipped_byte_is_rejected(tmp_path):
+    path = str(tmp_path / "palettes.sqlite")
+    main.DiskPaletteCache(path).put(key(1), palette(1))
+    main.DiskPaletteCache(path).put(key(2), palette(2))
+    with sqlite3.connect(path) as conn:
+        colors, = conn.execute("SELECT colors FROM palettes WHERE key = ?",
+                               (main.DiskPaletteCache._key(key(1)),)).fetchone()
+        flipped = bytes([colors[0] ^ 0x01]) + colors[1:]
+        conn.execute("UPDATE palettes SET colors = ? WHERE key = ?", (flipped, main.DiskPaletteCache._key(key(1))))
+    cache = main.DiskPaletteCache(path)
+    assert cache.get(key(1)) is None
+    assert cache.corrupt == 1
+    assert cache.stats()['entries'] == 1  # the bad row was deleted
+    assert np.array_equal(cache.get(key(2)).colors, palette(2).colors)
+
+
+def test_check_deletes_bad_rows(tmp_path):
+    path = str(tmp_path / "palettes.sqlite")
+    cache = main.DiskPaletteCache(path)
+    for i in range(3):
+        cache.put(key(i), palette(i))
+    with sqlite3.connect(path) as conn:
+        conn.execute("UPDATE palettes SET counts = zeroblob(length(counts)) WHERE key = ?",
+                     (main.DiskPaletteCache._key(key(0)),))
+    assert main.DiskPaletteCache(path).check() == {'sqlite': 'ok', 'rows': 3, 'bad_rows': 1}
+    assert main.DiskPaletteCache(path).stats()['entries'] == 2
+
+
+def test_garbage_file_is_moved_aside(tmp_path):
+    path = str(tmp_path / "palettes.sqlite")
+    with open(path, 'wb') as f:
+        f.write(b"this is not a database" * 200)
+    cache = main.DiskPaletteCache(path)
+    assert os.path.exists(path + ".corrupt")
+    cache.put(key(1), palette(1))
+    assert np.array_equal(main.DiskPaletteCache(path).get(key(1)).colors, palette(1).colors)
+
+
+def test_eviction_by_size_keeps_recently_used(tmp_path):
+    path = str(tmp_path / "palettes.sqlite")
+    cache = main.DiskPaletteCache(path, max_bytes=10**9)
+    for i in range(40):
+        cache.put(key(i), palette(i))
+    with sqlite3.connect(path) as conn:
+        # spread the access times out: key(i) was used i seconds ago, so key(0) is the most recent
+        for i in range(40):
+            conn.execute("UPDATE palettes SET accessed = ? WHERE key = ?",
+                         (time.time() - i, main.DiskPaletteCache._key(key(i))))
+    total = cache.stats()['bytes']
+    small = main.DiskPaletteCache(path, max_bytes=total // 4)  # evicts on open
+    stats = small.stats()
+    assert stats['bytes'] <= total // 4
+    assert 0 < stats['entries'] < 40
+    kept = [i for i in range(40) if small.get(key(i)) is not None]
+    assert kept == list(range(len(kept)))  # the least recently used went first
+
+
+def test_eviction_by_age(tmp_path):
+    path = str(tmp_path / "palettes.sqlite")
+    cache = main.DiskPaletteCache(path)
+    cache.put(key(1), palette(1))
+    cache.put(key(2), palette(2))
+    with sqlite3.connect(path) as conn:
+        conn.execute("UPDATE palettes SET accessed = ? WHERE key = ?",
+                     (time.time() - 10 * 86400, main.DiskPaletteCache._key(key(1))))
+    aged = main.DiskPaletteCache(path, max_age_days=7)
+    assert aged.stats()['entries'] == 1
+    assert aged.get(key(1)) is None and aged.get(key(2)) is not None
+
+
+def test_palette_tree_round_trip(tmp_path):
+    path = str(tmp_path / "palettes.sqlite")
+    rng = np.random.default_rng(3)
+    im = main.Image.fromarray(rng.integers(0, 256, (120, 160, 3)).astype(np.uint8))
+    main.extract_palette_tree(im, cache=main.DiskPaletteCache(path), fingerprint='fp')
+
+    stored = main.DiskPaletteCache(path).get(main._tree_key('fp', main.MAX_TREE_COLORS, 'MedianCut',
+                                                            main.HIST_BITS, 42))
+    assert isinstance(stored, main.PaletteTree)
+    hist = main.ColorHistogram(main.HIST_BITS)
+    hist.add(np.asarray(im).reshape(-1, 3))
+    fresh = main.median_cut_tree(*hist.result(), main.MAX_TREE_COLORS)
+    for n in range(1, main.MAX_TREE_COLORS + 1):
+        cut = stored.cut(n)
+        want = fresh.cut(n)
+        direct = main.extract_palette(im, N=n, cache=None)
+        assert np.array_equal(cut.colors, want.colors) and np.array_equal(cut.counts, want.counts), n
+        assert np.array_equal(cut.colors, direct.colors) and np.array_equal(cut.counts, direct.counts), n
+
+
+def test_kmeans_tree_round_trip(tmp_path):
+    path = str(tmp_path / "palettes.sqlite")
+    rng = np.random.default_rng(8)
+    im = main.Image.fromarray(rng.integers(0, 256, (80, 90, 3)).astype(np.uint8))
+    tree = main.extract_palette_tree(im, method='KMeans', cache=main.DiskPaletteCache(path), fingerprint='fp')
+    stored = main.DiskPaletteCache(path).get(main._tree_key('fp', main.MAX_TREE_COLORS, 'KMeans',
+                                                            main.HIST_BITS, 42))
+    for a, b in zip(tree, stored):
+        assert a.dtype == b.dtype and np.array_equal(a, b)
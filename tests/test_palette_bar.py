@@ -0,0 +1,101 @@
+"""
+draw_palette_bar / render_palette_bar against the original ImageDraw renderer.
+
+The slice-assignment rasterizer is meant to match the ImageDraw version pixel
+for pixel; `reference_render` below is that version, kept verbatim apart from
+taking the display colors from main.display_colors.
+"""
+import itertools
+import os
+import sys
+
+import numpy as np
+import pytest
+from PIL import Image, ImageDraw
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import main  # noqa: E402
+
+BAR_BG, SEP_COLOR, BORDER_COLOR = (30, 30, 30), (220, 220, 220), (190, 190, 190)
+
+
+def reference_render(im, palette, N=16, bar_h_ratio=0.09, bar_h_min=60, bar_h_max=200, separator=2,
+                     border_px=2, sort_by_luma=True, swatch_aspect=None):
+    w, h = im.size
+    bar_h = main.compute_bar_height(w, h, N=N, bar_h_ratio=bar_h_ratio, bar_h_min=bar_h_min,
+                                    bar_h_max=bar_h_max, separator=separator, border_px=border_px,
+                                    swatch_aspect=swatch_aspect)
+    colors = main.display_colors(palette, N, sort_by_luma)
+
+    bar = Image.new("RGB", (w, bar_h), BAR_BG)
+    draw = ImageDraw.Draw(bar)
+    draw.rectangle([0, 0, w - 1, bar_h - 1], outline=BORDER_COLOR, width=border_px)
+
+    inner_left = border_px
+    inner_top = border_px
+    inner_right = w - border_px
+    inner_bottom = bar_h - border_px
+    inner_w = inner_right - inner_left
+    aspect = float(swatch_aspect) if swatch_aspect else None
+    swatch_w = max(1, (inner_w - (N - 1) * separator) // N)
+    if aspect and aspect > 0:
+        swatch_h = max(1, int(round(swatch_w / aspect)))
+        inner_bottom = min(inner_top + swatch_h, bar_h - border_px)
+    x = inner_left
+    for i, (rgb, _cnt) in enumerate(colors):
+        sw_right = inner_right if i == N - 1 else x + swatch_w
+        draw.rectangle([x, inner_top, sw_right, inner_bottom], fill=tuple(rgb))
+        if i != N - 1 and separator > 0:
+            draw.rectangle([sw_right, inner_top, sw_right + separator - 1, inner_bottom], fill=SEP_COLOR)
+        x = sw_right + separator
+
+    out = Image.new("RGB", (w, h + bar_h), (0, 0, 0))
+    out.paste(im, (0, 0))
+    out.paste(bar, (0, h))
+    return out, bar
+
+
+def make_palette(k, seed):
+    rng = np.random.default_rng(seed)
+    return main.Palette(rng.integers(0, 256, (k, 3), dtype=np.uint8),
+                        rng.integers(1, 10_000, k).astype(np.int64))
+
+
+# widths chosen so (inner_w - separators) / N is rarely a whole number
+WIDTHS = (61, 257, 643)
+CASES = list(itertools.product(
+    (1, 3, 7, 16),            # N
+    (None, 1.0, 1.5, 0.75),   # swatch_aspect
+    (0, 1, 3),                # separator
+    (0, 1, 3),                # border_px
+    (True, False),            # sort_by_luma
+))
+
+
+@pytest.mark.parametrize('N, aspect, separator, border_px, sort_by_luma', CASES)
+def test_matches_imagedraw_reference(N, aspect, separator, border_px, sort_by_luma):
+    # fewer colors than N exercises the padding, more exercises the cut
+    palette = make_palette(max(1, N - 2) if N % 2 else N + 3, seed=N)
+    for w in WIDTHS:
+        im = Image.new("RGB", (w, 40), (12, 200, 90))
+        kw = dict(N=N, separator=separator, border_px=border_px, sort_by_luma=sort_by_luma,
+                  swatch_aspect=aspect)
+        try:
+            want_out, want_bar = reference_render(im, palette, **kw)
+        except ValueError:
+            continue  # ImageDraw rejects the degenerate geometry (x1 < x0)
+        out, bar = main.render_palette_bar(im, palette, bar_bg=BAR_BG, sep_color=SEP_COLOR,
+                                           border_color=BORDER_COLOR, **kw)
+        assert bar.size == want_bar.size
+        assert np.array_equal(np.asarray(bar), np.asarray(want_bar)), (w, kw)
+        assert np.array_equal(np.asarray(out), np.asarray(want_out)), (w, kw)
+
+
+def test_draw_palette_bar_array():
+    colors = main.display_colors(make_palette(5, seed=1), 5)
+    im = Image.new("RGB", (101, 30))
+    _, want = reference_render(im, colors, N=5, separator=2, border_px=2, swatch_aspect=1.0)
+    got = main.draw_palette_bar(colors, 101, want.size[1], N=5, separator=2, border_px=2, bar_bg=BAR_BG,
+                                sep_color=SEP_COLOR, border_color=BORDER_COLOR, swatch_aspect=1.0)
+    assert got.dtype == np.uint8 and got.shape == (want.size[1], 101, 3)
+    assert np.array_equal(got, np.asarray(want))
@@ -0,0 +1,51 @@
+"""Quantization results must not depend on the assignment thread count, and seeded KMeans must repeat."""
+import os
+import sys
+
+import numpy as np
+import pytest
+from PIL import Image
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import main  # noqa: E402
+
+
+@pytest.fixture(scope='module')
+def image():
+    # ~150k distinct colors at hist_bits=8, so the assignment runs over several ASSIGN_BLOCK_ROWS shards
+    rng = np.random.default_rng(4)
+    yy, xx = np.mgrid[:400, :400]
+    base = np.stack([xx * 255 // 400, yy * 255 // 400, (xx * yy) % 256], axis=-1)
+    return Image.fromarray(np.clip(base + rng.integers(-40, 40, base.shape), 0, 255).astype(np.uint8))
+
+
+@pytest.mark.parametrize('method', ['MedianCut', 'FastOctree', 'KMeans'])
+def test_extract_palette_independent_of_workers(image, method):
+    kw = dict(N=12, method=method, hist_bits=8, cache=None, seed=7)
+    one = main.extract_palette(image, workers=1, **kw)
+    for workers in (2, 3, 8):
+        many = main.extract_palette(image, workers=workers, **kw)
+        assert np.array_equal(one.colors, many.colors), workers
+        assert np.array_equal(one.counts, many.counts), workers
+
+
+def test_assign_to_centers_independent_of_workers():
+    rng = np.random.default_rng(9)
+    pixels = rng.integers(0, 256, (5 * main.ASSIGN_BLOCK_ROWS + 123, 3)).astype(np.float32)
+    weights = rng.integers(1, 50, len(pixels))
+    centers = rng.integers(0, 256, (20, 3)).astype(np.float32)
+    ref = main.assign_to_centers(pixels, centers, weights=weights, return_labels=True, return_sums=True,
+                                 workers=1)
+    for workers in (2, 4, 7):
+        got = main.assign_to_centers(pixels, centers, weights=weights, return_labels=True, return_sums=True,
+                                     workers=workers)
+        for a, b in zip(ref, got):
+            assert np.array_equal(a, b), workers
+
+
+def test_seeded_kmeans_repeats(image):
+    kw = dict(N=10, method='KMeans', hist_bits=8, cache=None)
+    first = main.extract_palette(image, seed=123, workers=4, **kw)
+    again = main.extract_palette(image, seed=123, workers=1, **kw)
+    assert np.array_equal(first.colors, again.colors)
+    assert np.array_equal(first.counts, again.counts)
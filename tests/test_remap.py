@@ -0,0 +1,104 @@
+"""PaletteLUT against a brute-force nearest-color search, and remap_file's streamed outputs."""
+import os
+import sys
+
+import numpy as np
+import pytest
+from PIL import Image
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import main  # noqa: E402
+
+
+def brute_force(colors, pixels):
+    """Nearest color index per pixel in exact integer arithmetic; ties go to the lower index."""
+    d = ((pixels[:, None, :].astype(np.int64) - colors[None, :, :].astype(np.int64)) ** 2).sum(axis=2)
+    return np.argmin(d, axis=1)
+
+
+def probe_pixels(colors, seed):
+    rng = np.random.default_rng(seed)
+    px = [rng.integers(0, 256, (100_000, 3)), colors.astype(np.int64)]
+    # midpoints between palette colors sit on (or next to) Voronoi boundaries
+    a, b = rng.integers(0, len(colors), (2, 5000))
+    mid = (colors[a].astype(np.int64) + colors[b]) // 2
+    px += [mid, np.clip(mid + rng.integers(-1, 2, mid.shape), 0, 255)]
+    return np.concatenate(px).astype(np.uint8)
+
+
+@pytest.mark.parametrize('k, bits', [(1, 6), (2, 4), (7, 5), (16, 6), (64, 7), (256, 4), (256, 6)])
+def test_lut_matches_brute_force(k, bits):
+    colors = np.random.default_rng(k * 10 + bits).integers(0, 256, (k, 3)).astype(np.uint8)
+    lut = main.PaletteLUT(colors, bits)
+    px = probe_pixels(colors, k)
+    assert np.array_equal(lut.labels(px), brute_force(colors, px))
+
+
+def test_lut_ties_go_to_lower_index():
+    colors = np.array([[10, 10, 10], [200, 50, 90], [10, 10, 10], [0, 0, 0], [20, 20, 20]], dtype=np.uint8)
+    lut = main.PaletteLUT(colors, 5)
+    px = probe_pixels(colors, 1)
+    assert np.array_equal(lut.labels(px), brute_force(colors, px))
+    assert lut.labels(np.array([[15, 15, 15]], dtype=np.uint8))[0] == 0  # equidistant from 0, 2 and 4
+
+
+def test_lut_independent_of_memory_budget():
+    colors = np.random.default_rng(5).integers(0, 256, (48, 3)).astype(np.uint8)
+    full = main.PaletteLUT(colors, 6)
+    small = main.PaletteLUT(colors, 6, mem_budget_mb=0.25)
+    assert np.array_equal(full.table, small.table)
+
+
+def write_tiled_tiff(path, rgb, tile=64):
+    """Uncompressed RGB TIFF in tile x tile tiles (Pillow only writes strips)."""
+    h, w = rgb.shape[:2]
+    across, down = -(-w // tile), -(-h // tile)
+    padded = np.zeros((down * tile, across * tile, 3), dtype=np.uint8)
+    padded[:h, :w] = rgb
+    data = [padded[ty * tile:(ty + 1) * tile, tx * tile:(tx + 1) * tile].tobytes()
+            for ty in range(down) for tx in range(across)]
+    offsets = [8 + sum(len(d) for d in data[:i]) for i in range(len(data))]
+    ifd_offset = 8 + sum(len(d) for d in data)
+    entries = {256: (4, [w]), 257: (4, [h]), 258: (3, [8, 8, 8]), 259: (3, [1]), 262: (3, [2]),
+               277: (3, [3]), 284: (3, [1]), 322: (4, [tile]), 323: (4, [tile]),
+               324: (4, offsets), 325: (4, [len(d) for d in data])}
+    with open(path, 'wb') as f:
+        f.write(main._tiff_header(ifd_offset=ifd_offset) + b''.join(data) + main._tiff_ifd(entries, ifd_offset))
+
+
+@pytest.fixture(params=['png', 'tiled_tiff'])
+def source(request, tmp_path):
+    rng = np.random.default_rng(11)
+    rgb = rng.integers(0, 256, (150, 230, 3), dtype=np.uint8)
+    path = str(tmp_path / ("src.png" if request.param == 'png' else "src.tif"))
+    if request.param == 'png':
+        Image.fromarray(rgb).save(path)
+    else:
+        write_tiled_tiff(path, rgb)
+    with Image.open(path) as im:
+        assert np.array_equal(np.asarray(im.convert('RGB')), rgb)
+    return path, rgb
+
+
+@pytest.mark.parametrize('ext', ['png', 'tif', 'bmp', 'gif'])
+def test_remap_file_matches_posterize(tmp_path, source, ext):
+    path, rgb = source
+    pal = main.extract_palette(Image.fromarray(rgb), 12, cache=None)
+    want = np.asarray(main.posterize_image(Image.fromarray(rgb), pal))
+    out, labels = str(tmp_path / f"out.{ext}"), str(tmp_path / "labels.npy")
+    main.remap_file(path, pal, out, labels_out=labels, tile_pixels=3000)
+    assert np.array_equal(np.load(labels), want)
+    with Image.open(out) as got:
+        assert got.mode == 'P'
+        assert np.array_equal(np.asarray(got), want)
+        assert np.array_equal(np.asarray(got.convert('RGB')), pal.colors[want])
+    assert not [f for f in os.listdir(tmp_path) if f.startswith('tmp')]  # the temporary label file is gone
+
+
+def test_remap_file_refuses_in_memory_output_over_budget(tmp_path, source):
+    path, rgb = source
+    pal = main.extract_palette(Image.fromarray(rgb), 4, cache=None)
+    with pytest.raises(ValueError, match="mem_budget_mb"):
+        main.remap_file(path, pal, str(tmp_path / "out.jpg"), mem_budget_mb=0.01)
+    main.remap_file(path, pal, str(tmp_path / "out.png"), mem_budget_mb=0.01)  # streamed: no limit
+    assert not [f for f in os.listdir(tmp_path) if f.startswith('tmp')]
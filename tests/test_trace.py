@@ -0,0 +1,57 @@
+"""PipelineTrace memory peaks for nested and concurrent stages."""
+import os
+import sys
+import threading
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import main  # noqa: E402
+
+MB = 1 << 20
+
+
+def test_nested_stage_keeps_enclosing_peak():
+    trace = main.PipelineTrace(track_memory=True)
+    try:
+        with trace.stage('outer'):
+            big = np.ones(40 * MB, dtype=np.uint8)
+            del big
+            with trace.stage('inner'):
+                small = np.ones(MB, dtype=np.uint8)
+                del small
+            with trace.stage('after'):
+                pass
+    finally:
+        trace.close()
+    peaks = {r['stage']: r['peak_alloc_bytes'] for r in trace.records}
+    assert peaks['outer'] >= 40 * MB  # the inner stages' resets must not hide it
+    assert MB <= peaks['inner'] < 4 * MB
+    assert peaks['after'] < MB
+
+
+def test_concurrent_stages_keep_their_peaks():
+    trace = main.PipelineTrace(track_memory=True)
+    started, release = threading.Barrier(2), threading.Event()
+
+    def allocate():
+        with trace.stage('big'):
+            buf = np.ones(30 * MB, dtype=np.uint8)
+            del buf
+            started.wait()
+            release.wait()  # the other thread opens and closes its stages meanwhile
+
+    worker = threading.Thread(target=allocate)
+    worker.start()
+    try:
+        started.wait()
+        for _ in range(3):
+            with trace.stage('small'):
+                pass
+        release.set()
+        worker.join()
+    finally:
+        trace.close()
+    peaks = [(r['stage'], r['peak_alloc_bytes']) for r in trace.records]
+    assert [p for s, p in peaks if s == 'big'][0] >= 30 * MB
+    assert all(p < MB for s, p in peaks if s == 'small')